@@ -0,0 +1,394 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Loopback benchmark: seeds a scratch database with thousands of users and
+# groups, starts the real server on it, connects N headless clients and
+# measures login throughput, command latency and how fast an `init` fans a
+# file out to all of them. Results are written as JSON so runs from two
+# commits can be compared with --compare.
+#
+#   python3 bench/benchmark.py --clients 200 --file-size 16M --output before.json
+#   python3 bench/benchmark.py --clients 200 --file-size 16M --compare before.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT, 'server')
+sys.path.insert(0, SERVER_DIR)
+
+from constants import SERVER, PORT, FORMAT
+from protocol import HEADER_SIZE, CONTROL, FILE_START, FILE_DATA, FILE_END, NEED, LAST_REPLY
+from protocol import pack_frame, parse_header, decode_meta
+from db import generate_benchmark_data
+from utils import parse_rate, raise_fd_limit
+
+PASSWORD = 'bench'
+FANOUT_GROUP = 'bench-fanout'
+PAYLOAD_NAME = 'bench-payload.bin'
+COMMANDS = ('my-groups', 'list-groups')
+SERVER_START_TIMEOUT = 30
+CONNECT_RETRIES = 5
+
+# Metrics compared by --compare, with whether a higher value is better.
+HEADLINE_METRICS = (
+    ('login', 'per_second', True),
+    ('login', 'p50_ms', False),
+    ('login', 'p99_ms', False),
+    ('commands', 'per_second', True),
+    ('commands', 'p50_ms', False),
+    ('commands', 'p99_ms', False),
+    ('fanout', 'seconds', False),
+    ('fanout', 'mb_per_second', True),
+    ('fanout', 'p99_ms', False),
+)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples):
+    # Latencies in seconds to a dict of milliseconds.
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p90_ms': round(percentile(samples, 0.90) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+
+class BenchClient:
+    # A headless client speaking the frame protocol directly. It counts file
+    # bytes instead of decrypting and writing them, so the numbers measure the
+    # server rather than the clients.
+
+    def __init__(self, email, password):
+        self.email = email
+        self.password = password
+        self.reader = None
+        self.writer = None
+        self.replies = asyncio.Queue()
+        self.files = {}
+        self.received = {}
+        self.file_bytes = 0
+        self.wire_bytes = 0
+        self.file_done = asyncio.Event()
+        self.reader_task = None
+
+    async def connect(self):
+        for attempt in range(CONNECT_RETRIES):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(SERVER, PORT)
+                return
+            except OSError:
+                if attempt == CONNECT_RETRIES - 1:
+                    raise
+                await asyncio.sleep(0.1 * (attempt + 1))
+
+    def send(self, text):
+        self.writer.write(pack_frame(CONTROL, text.encode(FORMAT)))
+
+    async def login(self):
+        # Returns once the session token has arrived, or raises.
+        await self.connect()
+        self.send(f"{self.email}:{self.password}")
+        self.reader_task = asyncio.create_task(self._read_loop())
+        while True:
+            reply = await self.replies.get()
+            if reply.startswith('session-token '):
+                return
+            if not reply.startswith('Connection Established'):
+                raise RuntimeError(f"login of {self.email} failed: {reply}")
+
+    async def command(self, text):
+        self.send(text)
+        return await self.replies.get()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(HEADER_SIZE)
+                frame_type, flags, file_id, seq, length = parse_header(header)
+                payload = await self.reader.readexactly(length) if length else b''
+                if frame_type == CONTROL:
+                    self.replies.put_nowait(payload.decode(FORMAT))
+                elif frame_type == FILE_START:
+                    self.files[file_id] = decode_meta(payload)
+                elif frame_type == FILE_DATA:
+                    self.wire_bytes += length
+                elif frame_type == FILE_END:
+                    meta = self.files.pop(file_id, None)
+                    if meta is None:
+                        continue
+                    self.received[meta['filename']] = time.monotonic()
+                    self.file_bytes += meta['size'] - meta.get('offset', 0)
+                    # Chunks aren't checked here; report none as failed so the server lets the transfer go.
+                    self.writer.write(pack_frame(NEED, file_id=file_id, seq=(meta.get('chunks', 0) + 7) // 8,
+                                                 flags=LAST_REPLY))
+                    self.send(f"received-file {meta['filename']}")
+                    self.file_done.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.replies.put_nowait('')
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+async def timed(coroutine):
+    start = time.monotonic()
+    await coroutine
+    return time.monotonic() - start
+
+
+async def run_clients(emails, commands, barrier, timeout):
+    # One worker process: its share of the clients runs each phase
+    # concurrently, and the barrier lines the phases up across workers.
+    loop = asyncio.get_running_loop()
+    clients = [BenchClient(email, PASSWORD) for email in emails]
+    result = {'login': [], 'login_failures': 0, 'commands': [], 'command_failures': 0}
+
+    async def login(client):
+        try:
+            result['login'].append(await timed(client.login()))
+        except (OSError, RuntimeError, asyncio.IncompleteReadError):
+            result['login_failures'] += 1
+
+    async def run_commands(client):
+        for i in range(commands):
+            start = time.monotonic()
+            reply = await client.command(COMMANDS[i % len(COMMANDS)])
+            if not reply:
+                result['command_failures'] += commands - i
+                return
+            result['commands'].append(time.monotonic() - start)
+
+    try:
+        result['login_started'] = time.monotonic()
+        await asyncio.gather(*(login(client) for client in clients))
+        result['login_finished'] = time.monotonic()
+        online = [client for client in clients if client.reader_task is not None]
+        await loop.run_in_executor(None, barrier.wait)
+
+        result['commands_started'] = time.monotonic()
+        await asyncio.gather(*(run_commands(client) for client in online))
+        result['commands_finished'] = time.monotonic()
+        await loop.run_in_executor(None, barrier.wait)
+
+        # The driver starts the distribution now; wait for every client's copy.
+        try:
+            await asyncio.wait_for(asyncio.gather(*(client.file_done.wait() for client in online)), timeout)
+        except asyncio.TimeoutError:
+            pass
+        result['received'] = [client.received.get(PAYLOAD_NAME) for client in online]
+        result['file_bytes'] = sum(client.file_bytes for client in online)
+        result['wire_bytes'] = sum(client.wire_bytes for client in online)
+    finally:
+        await asyncio.gather(*(client.close() for client in clients))
+    return result
+
+
+def client_worker(emails, commands, barrier, timeout, results):
+    raise_fd_limit()
+    try:
+        results.put(asyncio.run(run_clients(emails, commands, barrier, timeout)))
+    except Exception as e:
+        barrier.abort()
+        results.put({'error': repr(e)})
+
+
+def wait_for_server(process, timeout=SERVER_START_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            socket.create_connection((SERVER, PORT), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server didn't start listening on {SERVER}:{PORT} within {timeout}s")
+
+
+def write_payload(path, size):
+    # Random bytes, so compression has nothing to win and every byte is sent.
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            file.write(block)
+            remaining -= len(block)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def distribute(command, timeout):
+    # Logs in as the admin, starts the distribution and returns the time the
+    # command was sent together with the server's reply.
+    admin = BenchClient('admin', 'admin')
+    await admin.login()
+    try:
+        started = time.monotonic()
+        reply = await asyncio.wait_for(admin.command(command), timeout)
+        return started, reply
+    finally:
+        await admin.close()
+
+
+def run_benchmark(args, workdir):
+    print(f"Seeding {args.users} users and {args.groups} groups in {workdir}...")
+    emails = generate_benchmark_data(os.path.join(workdir, 'database.db'), args.users, args.groups, PASSWORD,
+                                     FANOUT_GROUP, args.clients, encrypted=not args.plain)
+    write_payload(os.path.join(workdir, PAYLOAD_NAME), args.file_size)
+
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    server = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, 'server.py')], cwd=workdir,
+                              stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_server(server)
+        shares = [emails[i:args.clients:args.processes] for i in range(args.processes)]
+        barrier = multiprocessing.Barrier(args.processes + 1)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=client_worker,
+                                           args=(share, args.commands, barrier, args.timeout, results))
+                   for share in shares]
+        for worker in workers:
+            worker.start()
+        print(f"Logging in {args.clients} clients from {args.processes} process(es)...")
+        barrier.wait(args.timeout)
+        print(f"Running {args.commands} commands per client...")
+        barrier.wait(args.timeout)
+        print(f"Distributing {args.file_size} bytes to {FANOUT_GROUP}...")
+        started, reply = asyncio.run(distribute(f"init {PAYLOAD_NAME} {FANOUT_GROUP}", args.timeout))
+        outcomes = [results.get(timeout=args.timeout * 2) for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+
+    errors = [outcome['error'] for outcome in outcomes if 'error' in outcome]
+    if errors:
+        raise RuntimeError(f"client worker failed: {errors[0]}")
+    return report(args, outcomes, started, reply)
+
+
+def report(args, outcomes, started, reply):
+    logins = [sample for outcome in outcomes for sample in outcome['login']]
+    login_seconds = max(o['login_finished'] for o in outcomes) - min(o['login_started'] for o in outcomes)
+    commands = [sample for outcome in outcomes for sample in outcome['commands']]
+    command_seconds = max(o['commands_finished'] for o in outcomes) - min(o['commands_started'] for o in outcomes)
+    received = [t for outcome in outcomes for t in outcome['received']]
+    completions = [t - started for t in received if t is not None]
+    file_bytes = sum(outcome['file_bytes'] for outcome in outcomes)
+    wire_bytes = sum(outcome['wire_bytes'] for outcome in outcomes)
+    fanout_seconds = max(completions) if completions else None
+
+    login = summarize(logins)
+    login.update(failures=sum(o['login_failures'] for o in outcomes), seconds=round(login_seconds, 3),
+                 per_second=round(len(logins) / login_seconds, 1) if login_seconds else None)
+    command = summarize(commands)
+    command.update(failures=sum(o['command_failures'] for o in outcomes), seconds=round(command_seconds, 3),
+                   per_second=round(len(commands) / command_seconds, 1) if command_seconds else None)
+    fanout = summarize(completions)
+    fanout.update(reply=reply, recipients=len(received), completed=len(completions),
+                  file_size=args.file_size, file_bytes=file_bytes, wire_bytes=wire_bytes,
+                  seconds=round(fanout_seconds, 3) if fanout_seconds else None,
+                  mb_per_second=round(file_bytes / fanout_seconds / 1e6, 2) if fanout_seconds else None)
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'params': {
+            'users': args.users, 'groups': args.groups, 'clients': args.clients, 'processes': args.processes,
+            'commands': args.commands, 'file_size': args.file_size, 'encrypted': not args.plain,
+        },
+        'login': login,
+        'commands': command,
+        'fanout': fanout,
+    }
+
+
+def compare(baseline, current):
+    print(f"\n{'metric':<24}{'baseline':>14}{'current':>14}{'change':>10}")
+    for section, key, higher_is_better in HEADLINE_METRICS:
+        old = baseline.get(section, {}).get(key)
+        new = current.get(section, {}).get(key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        better = change > 0 if higher_is_better else change < 0
+        mark = '' if abs(change) < 1 else (' +' if better else ' -')
+        print(f"{section + '.' + key:<24}{old:>14}{new:>14}{change:>9.1f}%{mark}")
+    if baseline.get('params') != current.get('params'):
+        print("\nWARNING: the two runs used different parameters.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark for the file distribution server.")
+    parser.add_argument('--users', type=int, default=5000, help="users to seed (default 5000)")
+    parser.add_argument('--groups', type=int, default=1000, help="groups to seed (default 1000)")
+    parser.add_argument('--clients', type=int, default=200, help="simulated clients that log in (default 200)")
+    parser.add_argument('--processes', type=int, default=1, help="processes to spread the clients over")
+    parser.add_argument('--commands', type=int, default=20, help="command round trips per client")
+    parser.add_argument('--file-size', type=parse_rate, default=parse_rate('8M'),
+                        help="size of the file distributed to every client, e.g. 64M (default 8M)")
+    parser.add_argument('--plain', action='store_true', help="distribute unencrypted")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds to allow each phase")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--workdir', help="directory for the server's database and files (default: a temporary one)")
+    args = parser.parse_args()
+    args.clients = min(args.clients, args.users)
+    args.processes = max(1, min(args.processes, args.clients))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='fdt-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_benchmark(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import hashlib
+import struct
+
+from constants import CHUNK_SIZE
+
+# Content-defined chunking, shared by client and server; both sides must cut
+# identical files at identical places.
+MIN_CHUNK = 8 * 1024
+MAX_CHUNK = CHUNK_SIZE
+BOUNDARY_BITS = 15  # about one boundary every 32 KiB past MIN_CHUNK
+SCAN_BLOCK = 4 * 1024 * 1024
+
+# Every byte value maps to one pseudo-random bit; a boundary follows any run of
+# BOUNDARY_BITS bytes whose bits spell PATTERN.
+BIT_TABLE = bytes(hashlib.sha256(b'cdc-bit' + bytes([value])).digest()[0] & 1 for value in range(256))
+PATTERN = bytes((hashlib.sha256(b'cdc-pattern').digest()[i // 8] >> (i % 8)) & 1 for i in range(BOUNDARY_BITS))
+
+DIGEST_SIZE = 32
+RECORD = struct.Struct('!32sI')  # chunk hash, chunk length
+
+
+def chunk_spans(data, size):
+    # Yields (offset, length) for each chunk of data, a bytes object or mmap.
+    # A cut depends only on the few bytes just before it, so inserting or
+    # deleting bytes early in a file leaves later boundaries, and chunk
+    # hashes, unchanged. translate() and find() keep the scan in C.
+    bits = b''
+    bits_start = 0
+    start = 0
+    while start < size:
+        end = min(size, start + MAX_CHUNK)
+        if end - start <= MIN_CHUNK:
+            yield start, end - start
+            return
+        window_start = start + MIN_CHUNK - len(PATTERN)
+        if end > bits_start + len(bits):
+            bits_start = window_start
+            bits = data[bits_start:min(size, bits_start + SCAN_BLOCK)].translate(BIT_TABLE)
+        found = bits.find(PATTERN, window_start - bits_start, end - bits_start)
+        cut = bits_start + found + len(PATTERN) if found >= 0 else end
+        yield start, cut - start
+        start = cut
+
+
+def pack_records(records):
+    return b''.join(RECORD.pack(digest, length) for digest, length in records)
+
+
+def unpack_records(payload):
+    return [RECORD.unpack_from(payload, offset) for offset in range(0, len(payload), RECORD.size)]
@@ -1,15 +1,33 @@
 import socket
 import sys
 import threading
-from utils import derive_key_from_password, decrypt_file
+from utils import derive_key_from_password
 import tqdm
-from constants import PORT, SERVER, FORMAT, CHUNK_SIZE
+from constants import PORT, SERVER, RECEIVE_BUFFERS
+from protocol import FrameReader, CONTROL, FILE_START, FILE_DATA, FILE_END, SWARM_MAP, MANIFEST, NEED, SIGNATURE, COPY
+from protocol import DIGESTS, LAST_REPLY, WRITE_FAILED
+from protocol import ProtocolError, BufferPool, send_frame, send_control, decode_meta
+from receiver import StreamingReceiver
+from swarm import SwarmDownload, PeerServer
+from dedup import DedupDownload, ChunkCache
+from delta import DeltaDownload
+from session import load_session, save_session
 
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 client_socket.connect((SERVER, PORT))
 print("Initialising Connection...\n")
 
+# FILE_DATA payloads are read straight into these and passed along the
+# receive pipeline without a copy; see StreamingReceiver.
+buffers = BufferPool(RECEIVE_BUFFERS)
+reader = FrameReader(client_socket, pool=buffers)
+send_lock = threading.Lock()
+swarms = {}
+downloads = {}
+chunk_cache = ChunkCache()
+
 global key
+global receiver
 
 
 def refresh_input_line():
@@ -17,66 +35,190 @@ def refresh_input_line():
     sys.stdout.flush()
 
 
-def verify_credentials(email, password):
-    credentials = f"{email}:{password}"
-    client_socket.sendall(credentials.encode(FORMAT))
-    response = client_socket.recv(1024).decode(FORMAT)
+def read_login_response():
+    frame = reader.read_frame()
+    response = frame.text() if frame is not None else ""
     print(f"Server response: {response}\n")
     if "Connection Established" not in response:
-        return {'connected': False, 'is_admin': False}
-    if "Admin Access Granted" not in response:
-        return {'connected': True, 'is_admin': False}
-    return {'connected': True, 'is_admin': True}
+        return {'connected': False, 'is_admin': False, 'token': None}
+    frame = reader.read_frame()
+    token = None
+    if frame is not None and frame.text().startswith('session-token '):
+        token = frame.text().split()[1]
+    return {'connected': True, 'is_admin': "Admin Access Granted" in response, 'token': token}
+
+
+def verify_credentials(email, password):
+    credentials = f"{email}:{password}"
+    send_control(client_socket, credentials)
+    return read_login_response()
+
+
+def resume_session(session):
+    send_control(client_socket, f"session {session['token']}")
+    return read_login_response()
+
+
+def send_to_server(text):
+    with send_lock:
+        send_control(client_socket, text)
+
+
+def on_file_received(transfer):
+    print(f"[FILE {transfer.filename} RECEIVED SUCCESSFULLY]\n")
+    send_to_server(f"received-file {transfer.filename}")
+    refresh_input_line()
+
+
+def on_checkpoint(transfer, offset, chunk_hash):
+    send_to_server(f"checkpoint {transfer.filename} {offset} {chunk_hash}")
+
+
+def send_need(file_id, seq, bitmap, last, failed=False):
+    flags = (LAST_REPLY if last else 0) | (WRITE_FAILED if failed else 0)
+    with send_lock:
+        send_frame(client_socket, NEED, bitmap, file_id=file_id, seq=seq, flags=flags)
+
+
+def send_signatures(file_id, seq, signatures, last):
+    with send_lock:
+        send_frame(client_socket, SIGNATURE, signatures, file_id=file_id, seq=seq, flags=LAST_REPLY if last else 0)
+
+
+def on_download_complete(download):
+    print(f"[FILE {download.filename} RECEIVED SUCCESSFULLY, {download.reused_bytes} BYTES REUSED LOCALLY]\n")
+    send_to_server(f"received-file {download.filename}")
+    refresh_input_line()
+
+
+def on_delta_complete(delta):
+    print(f"[FILE {delta.filename} RECEIVED SUCCESSFULLY AS A DELTA, {delta.literal_bytes} OF {delta.size} BYTES SENT]\n")
+    send_to_server(f"received-file {delta.filename}")
+    refresh_input_line()
+
+
+def request_swarm_piece(swarm_id, index):
+    send_to_server(f"swarm-piece {swarm_id} {index}")
+
+
+def on_swarm_complete(swarm):
+    print(f"[FILE {swarm.filename} RECEIVED SUCCESSFULLY THROUGH SWARM, {swarm.peer_bytes} BYTES FROM PEERS]\n")
+    send_to_server(f"received-file {swarm.filename}")
+    refresh_input_line()
+
+
+def start_peer_server():
+    peer_server = PeerServer(swarms, client_socket.getsockname()[0])
+    peer_server.start()
+    send_to_server(f"peer-port {peer_server.port}")
+    return peer_server
 
 
 def receive_messages():
+    progress = {}
     while True:
+        frame = None
         try:
-            message = client_socket.recv(1024).decode('utf-8')
-            print(f"[MESSAGE FROM SERVER]: {message}\n")
+            frame = reader.read_frame()
+            if frame is None:
+                break
+
+            if frame.type == CONTROL:
+                print(f"[MESSAGE FROM SERVER]: {frame.text()}\n")
+                continue
+
+            if frame.type == FILE_START:
+                meta = decode_meta(frame.payload)
+                filename = meta['filename']
+                filesize = meta['size']
+                if meta.get('swarm'):
+                    print(f"[JOINING SWARM FOR FILE: {filename}]\n")
+                    swarms[frame.file_id] = SwarmDownload(frame.file_id, meta, key, request_swarm_piece,
+                                                          on_swarm_complete)
+                    continue
+                if meta.get('dedup'):
+                    print(f"[PREPARING TO RECEIVE FILE: {filename} ({meta['chunks']} CHUNKS)]\n")
+                    downloads[frame.file_id] = DedupDownload(frame.file_id, meta, key, chunk_cache, send_need,
+                                                             on_download_complete)
+                    continue
+                if meta.get('delta'):
+                    print(f"[PREPARING TO RECEIVE FILE: {filename} AS A DELTA]\n")
+                    downloads[frame.file_id] = DeltaDownload(frame.file_id, meta, key, send_signatures,
+                                                             on_delta_complete)
+                    continue
+                if meta.get('bundle'):
+                    print(f"[PREPARING TO RECEIVE {meta['files']} FILES: {filename}]\n")
+                else:
+                    print(f"[PREPARING TO RECEIVE FILE: {filename}\n")
+                offset = meta.get('offset', 0)
+                if offset:
+                    print(f"[RESUMING {filename} FROM BYTE {offset}]\n")
+                receiver.start(frame.file_id, filename, filesize, meta['root'], offset, meta.get('encrypted', True),
+                               meta.get('bundle', False))
+                progress[frame.file_id] = tqdm.tqdm(unit='B', unit_scale=True, unit_divisor=1024, total=filesize, initial=offset)
+                continue
 
+            swarm = swarms.get(frame.file_id)
+            if swarm is not None:
+                if frame.type == SWARM_MAP:
+                    swarm.add_map(frame.payload)
+                elif frame.type == FILE_DATA:
+                    swarm.store_piece(frame.seq, frame.payload, frame.flags)
+                continue
+
+            download = downloads.get(frame.file_id)
+            if isinstance(download, DedupDownload):
+                if frame.type == MANIFEST:
+                    download.add_records(frame.payload)
+                elif frame.type == FILE_DATA:
+                    download.store_chunk(frame.seq, frame.payload, frame.flags)
+                elif frame.type == FILE_END:
+                    del downloads[frame.file_id]
+                    download.finish()
+                continue
+            if isinstance(download, DeltaDownload):
+                if frame.type == FILE_DATA:
+                    download.literal(frame.seq, frame.payload, frame.flags)
+                elif frame.type == COPY:
+                    download.copy(frame.seq, frame.payload)
+                elif frame.type == FILE_END:
+                    del downloads[frame.file_id]
+                    download.finish(frame.payload)
+                continue
 
-            message = list(message.split())
-            if message[0] != 'file':
+            transfer = receiver.get(frame.file_id)
+            if transfer is None:
                 continue
 
-            assert len(message) == 4
-            assert message[2] == '-size'
-
-            filename = message[1]
-            filesize = int(message[3])
-            print(f"[PREPARING TO RECEIVE FILE: {filename}\n")
-
-            file_bytes = bytearray()
-            progress = tqdm.tqdm(unit='B', unit_scale=True, unit_divisor=True, total=filesize)
-            done = False
-
-            length = 0
-
-            while not done:
-                data = client_socket.recv(CHUNK_SIZE)
-                if b'<END>' in data:
-                    end_marker_index = data.index(b'<END>')
-                    file_bytes.extend(decrypt_file(data[:end_marker_index], key))
-                    file = open(filename, 'wb')
-                    file.write(file_bytes)
-                    file.close()
-                    remaining_bytes = filesize - length + len(b'<END>')
-                    progress.update(remaining_bytes)
-                    break
-
-                file_bytes.extend(decrypt_file(data, key))
-                length += len(data)
-                progress.update(len(data))
-            progress.close()
-            print('\n')
-            file.close()
-            print(f"[FILE {filename} RECEIVED SUCCESSFULLY]\n")
-            client_socket.send(f"received-file {filename}".encode(FORMAT))
-            refresh_input_line()
+            if frame.type == DIGESTS:
+                receiver.digests(transfer, frame.payload)
+                continue
 
+            if frame.type == FILE_DATA:
+                receiver.data(transfer, frame)
+                # Chunks resent after the stream ended have no bar.
+                bar = progress.get(frame.file_id)
+                if bar is not None:
+                    bar.update(transfer.received - bar.n)
+                continue
+
+            if frame.type == FILE_END:
+                bar = progress.pop(frame.file_id, None)
+                if bar is not None:
+                    bar.close()
+                    print('\n')
+                receiver.finish(transfer)
+
+        except ProtocolError as e:
+            print(f"[PROTOCOL ERROR]: {e}\n")
+            break
         except:
             continue
+        finally:
+            # Frames the receive pipeline didn't take over are done with here.
+            if frame is not None and frame.buffer is not None:
+                buffers.put(frame.buffer)
+    receiver.abort_all()
     client_socket.close()
 
 
@@ -84,7 +226,7 @@ def send_messages():
     try:
         while True:
             request = input(">>> ")
-            client_socket.send(request.encode(FORMAT))
+            send_to_server(request)
             continue
     except Exception as e:
         print("Disconnected from server!\n", e)
@@ -92,16 +234,32 @@ def send_messages():
 
 
 if __name__ == '__main__':
-    email = input("Enter username: ")
-    password = input("Enter password: ")
-    status = verify_credentials(email, password)
+    session = load_session()
+    status = {'connected': False}
+    if session is not None:
+        status = resume_session(session)
 
-    if not status['connected']:
-        print("Connection Failed!\n")
-        client_socket.close()
-        exit(0)
+    if status['connected']:
+        email = session['email']
+        key = bytes.fromhex(session['key'])
+        print(f"Resumed session as {email}\n")
+    else:
+        email = input("Enter username: ")
+        password = input("Enter password: ")
+        status = verify_credentials(email, password)
+
+        if not status['connected']:
+            print("Connection Failed!\n")
+            client_socket.close()
+            exit(0)
+
+        key = derive_key_from_password(password)
 
-    key = derive_key_from_password(password)
+    if status['token']:
+        save_session(email, status['token'], key)
+    receiver = StreamingReceiver(key, on_file_received, on_checkpoint, send_need, pool=buffers)
+    if not status['is_admin']:
+        start_peer_server()
 
     thread_send = threading.Thread(target=send_messages, args=())
     thread_send.start()
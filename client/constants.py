@@ -1,3 +1,4 @@
+import os
 import socket
 
 PORT = 8800
@@ -6,12 +7,26 @@ ADDR = (SERVER, PORT)
 FORMAT = 'utf-8'
 FIXED_SALT = b'\xa3\xd8\x7b\x1c\xe4\x9f\x23\x47\x91\x6e\xc8\x34\x12\xab\xcd\xef'
 
-ADMIN_COMMANDS = ['init', 'create-group', 'delete-group', 'list-users', 'view-requests', 'add', 'remove']
-GENERAL_COMMANDS = ['list-groups', 'join-group', 'received-file', 'my-groups']
+ADMIN_COMMANDS = ['init', 'create-group', 'delete-group', 'list-users', 'view-requests', 'add', 'remove', 'set-encryption', 'init-swarm', 'auth-stats', 'transfer-stats', 'set-rate', 'rate-stats', 'init-dedup', 'init-delta', 'stats', 'trace', 'profile', 'revoke-sessions']
+GENERAL_COMMANDS = ['list-groups', 'join-group', 'received-file', 'my-groups', 'checkpoint', 'peer-port', 'swarm-piece']
 
 CHUNK_SIZE = 128 * 1024
 
 MAX_CONCURRENT_TRANSFERS = 5
 
+REPLY_FRAME_SIZE = 48 * 1024  # the server accepts frames of up to 64 KiB from clients
 
+RECEIVE_BUFFERS = 16  # chunks being received, decrypted or written at once
+DECRYPT_WORKERS = min(4, os.cpu_count() or 1)
+CHECKPOINT_INTERVAL = 64
+MAX_REPAIR_ROUNDS = 3  # must match the server's
 
+SWARM_FETCHERS = 4
+SWARM_PEER_RETRIES = 20
+SWARM_RETRY_DELAY = 0.25
+PEER_TIMEOUT = 5
+
+SESSION_FILE = '.session'
+
+CHUNK_CACHE_DIR = '.chunks'
+CHUNK_CACHE_SIZE = 1024 * 1024 * 1024
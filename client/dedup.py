@@ -0,0 +1,191 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import zlib
+
+from utils import decrypt_file
+from chunking import chunk_spans, unpack_records
+from integrity import bitmap_frames
+from protocol import COMPRESSED
+from constants import CHUNK_CACHE_DIR, CHUNK_CACHE_SIZE, REPLY_FRAME_SIZE
+
+PART_SUFFIX = '.part'
+
+
+class ChunkCache:
+    # Chunks received through deduplicated transfers, stored by sha256 so a
+    # later version of any file can reuse them even after the file itself has
+    # been moved or deleted. The oldest chunks are evicted once the cache
+    # grows beyond max_size.
+
+    def __init__(self, directory=CHUNK_CACHE_DIR, max_size=CHUNK_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest.hex())
+
+    def get(self, digest):
+        try:
+            with open(self.path(digest), 'rb') as file:
+                chunk = file.read()
+        except OSError:
+            return None
+        if hashlib.sha256(chunk).digest() != digest:
+            return None
+        os.utime(self.path(digest))
+        return chunk
+
+    def put(self, digest, chunk):
+        path = self.path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(chunk)
+        os.replace(temp_path, path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self.size += len(chunk)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        try:
+            return [entry for entry in os.scandir(self.directory) if not entry.name.endswith('.tmp')]
+        except OSError:
+            return []
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+def index_file(filename):
+    # Maps the hash of every chunk of an existing local file to its offset.
+    index = {}
+    try:
+        size = os.path.getsize(filename)
+        if not size:
+            return index
+        with open(filename, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, length in chunk_spans(data, size):
+                    index.setdefault(hashlib.sha256(data[offset:offset + length]).digest(), offset)
+    except OSError:
+        pass
+    return index
+
+
+class DedupDownload:
+    # One deduplicated file. Once the whole manifest has arrived, the chunks
+    # we already hold, in the previous version of the file or in the chunk
+    # cache, are copied into the part file and the server is told which ones
+    # are still missing. Those arrive as FILE_DATA frames whose seq is the
+    # chunk's index in the manifest, and each is checked against its hash
+    # before it is written.
+
+    def __init__(self, file_id, meta, key, cache, send_need, on_complete):
+        self.file_id = file_id
+        self.filename = meta['filename']
+        self.size = meta['size']
+        self.encrypted = meta.get('encrypted', True)
+        self.chunk_count = meta['chunks']
+        self.key = key
+        self.cache = cache
+        self.send_need = send_need
+        self.on_complete = on_complete
+        self.records = []
+        self.offsets = []
+        self.missing = set()
+        self.reused_bytes = 0
+        self.failed = False
+        self.part_path = self.filename + PART_SUFFIX
+        self.file = None
+        self.ready = threading.Event()
+        if self.chunk_count == 0:
+            self.add_records(b'')
+
+    def add_records(self, payload):
+        self.records.extend(unpack_records(payload))
+        if len(self.records) == self.chunk_count:
+            threading.Thread(target=self._prepare, daemon=True).start()
+
+    def _prepare(self):
+        offset = 0
+        for _, length in self.records:
+            self.offsets.append(offset)
+            offset += length
+        try:
+            self.file = open(self.part_path, 'w+b')
+            self.file.truncate(self.size)
+            local = index_file(self.filename)
+            source = open(self.filename, 'rb') if local else None
+            try:
+                for index, (digest, length) in enumerate(self.records):
+                    if digest in local:
+                        source.seek(local[digest])
+                        chunk = source.read(length)
+                    else:
+                        chunk = self.cache.get(digest)
+                    if chunk is None or len(chunk) != length:
+                        self.missing.add(index)
+                        continue
+                    self.file.seek(self.offsets[index])
+                    self.file.write(chunk)
+                    self.reused_bytes += length
+            finally:
+                if source is not None:
+                    source.close()
+        except OSError as e:
+            print(f"[ERROR PREPARING {self.filename}]: {e}\n")
+            self.failed = True
+            self.missing = set(range(self.chunk_count))
+        self.ready.set()
+        for start, payload in bitmap_frames(self.missing, self.chunk_count, REPLY_FRAME_SIZE):
+            self.send_need(self.file_id, start, payload, last=False)
+        self.send_need(self.file_id, (self.chunk_count + 7) // 8, b'', last=True)
+
+    def store_chunk(self, index, payload, flags=0):
+        self.ready.wait()
+        if self.failed or index not in self.missing:
+            return
+        chunk = decrypt_file(payload, self.key) if self.encrypted else bytes(payload)
+        if flags & COMPRESSED:
+            chunk = zlib.decompress(chunk)
+        digest, length = self.records[index]
+        if len(chunk) != length or hashlib.sha256(chunk).digest() != digest:
+            print(f"[CHUNK {index} OF {self.filename} FAILED VERIFICATION]\n")
+            self.failed = True
+            return
+        self.file.seek(self.offsets[index])
+        self.file.write(chunk)
+        self.missing.discard(index)
+        self.cache.put(digest, chunk)
+
+    def finish(self):
+        self.ready.wait()
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        if self.failed or self.missing:
+            print(f"[INCOMPLETE DEDUPLICATED TRANSFER OF {self.filename}, {len(self.missing)} CHUNKS MISSING]\n")
+            return
+        os.replace(self.part_path, self.filename)
+        self.on_complete(self)
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import struct
+import threading
+import zlib
+
+from utils import decrypt_file
+from protocol import decode_meta, COMPRESSED
+from constants import CHUNK_SIZE, REPLY_FRAME_SIZE
+
+SIGNATURE = struct.Struct('!II32s')  # adler32, block length, sha256
+COPY_RUN = struct.Struct('!II')  # first block, block count
+PART_SUFFIX = '.part'
+
+
+def unpack_copies(payload):
+    return [COPY_RUN.unpack_from(payload, offset) for offset in range(0, len(payload), COPY_RUN.size)]
+
+
+class DeltaDownload:
+    # One file arriving as a delta against our current copy of it. We send the
+    # server a signature of every block of that copy; it answers with a stream
+    # of literal data (FILE_DATA) and runs of our blocks to reuse (COPY), in
+    # order, which rebuild the new version in the part file. The result must
+    # match the sha256 carried by FILE_END before it replaces the old copy.
+
+    def __init__(self, file_id, meta, key, send_signatures, on_complete):
+        self.file_id = file_id
+        self.filename = meta['filename']
+        self.size = meta['size']
+        self.encrypted = meta.get('encrypted', True)
+        self.block_size = meta['block_size']
+        self.key = key
+        self.send_signatures = send_signatures
+        self.on_complete = on_complete
+        self.seq = 0
+        self.literal_bytes = 0
+        self.failed = False
+        self.part_path = self.filename + PART_SUFFIX
+        self.digest = hashlib.sha256()
+        try:
+            self.basis = open(self.filename, 'rb')
+        except OSError:
+            self.basis = None
+        self.file = open(self.part_path, 'wb')
+        threading.Thread(target=self._signatures, daemon=True).start()
+
+    def _signatures(self):
+        batch = bytearray()
+        offset = 0
+        per_frame = REPLY_FRAME_SIZE // SIGNATURE.size * SIGNATURE.size
+        if self.basis is not None:
+            with open(self.filename, 'rb') as basis:
+                while True:
+                    block = basis.read(self.block_size)
+                    if not block:
+                        break
+                    batch += SIGNATURE.pack(zlib.adler32(block), len(block), hashlib.sha256(block).digest())
+                    if len(batch) >= per_frame:
+                        self.send_signatures(self.file_id, offset, bytes(batch), last=False)
+                        offset += len(batch)
+                        batch.clear()
+        self.send_signatures(self.file_id, offset, bytes(batch), last=True)
+
+    def _next(self, seq):
+        if seq != self.seq:
+            raise ValueError(f"delta instruction {seq} of {self.filename} arrived out of order, expected {self.seq}")
+        self.seq += 1
+        return not self.failed
+
+    def _write(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+
+    def literal(self, seq, payload, flags=0):
+        if not self._next(seq):
+            return
+        data = decrypt_file(payload, self.key) if self.encrypted else payload
+        if flags & COMPRESSED:
+            data = zlib.decompress(data)
+        self._write(data)
+        self.literal_bytes += len(data)
+
+    def copy(self, seq, payload):
+        if not self._next(seq):
+            return
+        for first, count in unpack_copies(payload):
+            if self.basis is None:
+                self.failed = True
+                return
+            self.basis.seek(first * self.block_size)
+            remaining = count * self.block_size
+            while remaining:
+                data = self.basis.read(min(remaining, CHUNK_SIZE))
+                if not data:
+                    break
+                self._write(data)
+                remaining -= len(data)
+
+    def finish(self, payload):
+        expected = decode_meta(payload).get('sha256') if len(payload) else None
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if self.basis is not None:
+            self.basis.close()
+        if self.failed or self.digest.hexdigest() != expected:
+            print(f"[DELTA OF {self.filename} DID NOT REBUILD THE FILE, KEEPING THE OLD COPY]\n")
+            os.remove(self.part_path)
+            return
+        os.replace(self.part_path, self.filename)
+        self.on_complete(self)
@@ -0,0 +1,152 @@
+import json
+import queue
+import struct
+
+from constants import FORMAT, CHUNK_SIZE
+
+# The client's side of the frame protocol: the header, frame types, flags and
+# the blocking reader and writers. server/protocol.py has the same header,
+# types and flags, and the codec the asyncio server uses.
+#
+# Every message on the socket is a frame:
+#   version (1B) | type (1B) | flags (1B) | reserved (1B) | file_id (4B) | seq (4B) | length (4B) | payload
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBBxIII')
+HEADER_SIZE = HEADER.size
+
+CONTROL = 1
+FILE_START = 2
+FILE_DATA = 3
+FILE_END = 4
+SWARM_MAP = 5
+MANIFEST = 6  # chunk records of a deduplicated file, server to client
+NEED = 7  # bitmap of the manifest chunks a client is missing or that failed verification, client to server
+SIGNATURE = 8  # block signatures of a client's copy of a file, client to server
+COPY = 9  # runs of the client's own blocks to copy into a delta, server to client
+DIGESTS = 10  # hashes of the chunks of a file about to be streamed, server to client
+
+FRAME_TYPES = (CONTROL, FILE_START, FILE_DATA, FILE_END, SWARM_MAP, MANIFEST, NEED, SIGNATURE, COPY, DIGESTS)
+
+# FILE_DATA flags
+COMPRESSED = 1  # zlib-compressed before encryption; decompress after decrypting
+
+# NEED and SIGNATURE flags
+LAST_REPLY = 1
+WRITE_FAILED = 2  # on the last NEED of a transfer the client couldn't write; nothing is resent
+
+MAX_PAYLOAD = CHUNK_SIZE + 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_frame(sock, frame_type, payload=b'', file_id=0, seq=0, flags=0):
+    sock.sendall(HEADER.pack(PROTOCOL_VERSION, frame_type, flags, file_id, seq, len(payload)))
+    if payload:
+        sock.sendall(payload)
+
+
+def send_control(sock, text):
+    send_frame(sock, CONTROL, text.encode(FORMAT))
+
+
+def decode_meta(payload):
+    return json.loads(bytes(payload).decode(FORMAT))
+
+
+def parse_header(header):
+    version, frame_type, flags, file_id, seq, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if frame_type not in FRAME_TYPES:
+        raise ProtocolError(f"unknown frame type {frame_type}")
+    return frame_type, flags, file_id, seq, length
+
+
+class Frame:
+    __slots__ = ('type', 'flags', 'file_id', 'seq', 'payload', 'buffer')
+
+    def __init__(self, frame_type, flags, file_id, seq, payload, buffer=None):
+        self.type = frame_type
+        self.flags = flags
+        self.file_id = file_id
+        self.seq = seq
+        self.payload = payload
+        self.buffer = buffer  # the pooled buffer holding payload, if any
+
+    def text(self):
+        return bytes(self.payload).decode(FORMAT)
+
+
+class BufferPool:
+    # A fixed set of reusable buffers. get blocks while every buffer is in
+    # use, which bounds how far a reader can run ahead of the code that
+    # gives the buffers back.
+
+    def __init__(self, count, size=MAX_PAYLOAD):
+        self.free = queue.Queue()
+        for _ in range(count):
+            self.free.put(bytearray(size))
+
+    def get(self, size):
+        buffer = self.free.get()
+        if len(buffer) < size:
+            buffer = bytearray(size)
+        return buffer
+
+    def put(self, buffer):
+        self.free.put(buffer)
+
+
+class FrameReader:
+    # Reads frames with recv_into into buffers owned by the reader. The payload
+    # buffer starts at initial_size and only grows (up to max_payload) when a
+    # larger frame arrives. The payload of a returned frame is a view into that
+    # buffer and is only valid until the next call to read_frame.
+    #
+    # With a pool, FILE_DATA payloads are read into a buffer taken from the
+    # pool instead. It is handed over as frame.buffer and stays valid until
+    # whoever ends up owning it puts it back.
+
+    def __init__(self, sock, max_payload=MAX_PAYLOAD, initial_size=MAX_PAYLOAD, pool=None):
+        self.sock = sock
+        self.max_payload = max_payload
+        self.pool = pool
+        self.header = bytearray(HEADER_SIZE)
+        self.header_view = memoryview(self.header)
+        self._allocate(min(initial_size, max_payload))
+
+    def _allocate(self, size):
+        self.buffer = bytearray(size)
+        self.buffer_view = memoryview(self.buffer)
+
+    def _recv_exact(self, view):
+        received = 0
+        size = len(view)
+        while received < size:
+            n = self.sock.recv_into(view[received:], size - received)
+            if n == 0:
+                return False
+            received += n
+        return True
+
+    def read_frame(self):
+        if not self._recv_exact(self.header_view):
+            return None
+        frame_type, flags, file_id, seq, length = parse_header(self.header)
+        if length > self.max_payload:
+            raise ProtocolError(f"frame payload of {length} bytes exceeds {self.max_payload}")
+        buffer = None
+        if self.pool is not None and frame_type == FILE_DATA:
+            buffer = self.pool.get(length)
+            payload = memoryview(buffer)[:length]
+        else:
+            if length > len(self.buffer):
+                self._allocate(length)
+            payload = self.buffer_view[:length]
+        if length and not self._recv_exact(payload):
+            if buffer is not None:
+                self.pool.put(buffer)
+            return None
+        return Frame(frame_type, flags, file_id, seq, payload, buffer)
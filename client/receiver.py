@@ -0,0 +1,540 @@
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from utils import decrypt_file, chunk_digest
+from constants import CHUNK_SIZE, RECEIVE_BUFFERS, DECRYPT_WORKERS, CHECKPOINT_INTERVAL, MAX_REPAIR_ROUNDS
+from constants import REPLY_FRAME_SIZE
+from protocol import COMPRESSED, BufferPool
+from integrity import DIGEST_SIZE, merkle_root, bitmap_frames
+
+PART_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.ckpt'
+BUNDLE_HEADER = struct.Struct('!Q')
+
+
+def read_checkpoint(path):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ChunkManifest:
+    # The hashes a transfer's chunks are checked against, sent by the server
+    # ahead of the data, and the chunks that have failed the check so far.
+
+    def __init__(self, size, root):
+        self.size = size
+        self.chunk_count = (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.root = root
+        self.digests = bytearray()
+        self.valid = False
+        self.bad = set()
+        self.rounds = 0
+        if not self.chunk_count:
+            self.add(b'')
+
+    def add(self, payload):
+        self.digests += payload
+        if len(self.digests) >= self.chunk_count * DIGEST_SIZE:
+            self.valid = merkle_root(bytes(self.digests)) == self.root
+
+    def check(self, index, chunk):
+        if not self.valid:
+            raise ValueError("the chunk hashes don't match their Merkle root")
+        start = index * DIGEST_SIZE
+        return hashlib.sha256(chunk).digest() == self.digests[start:start + DIGEST_SIZE]
+
+    def chunk_size(self, index):
+        return min(CHUNK_SIZE, self.size - index * CHUNK_SIZE)
+
+
+class Transfer:
+    def __init__(self, file_id, filename, size, root, offset=0, encrypted=True):
+        self.file_id = file_id
+        self.filename = filename
+        self.size = size
+        self.encrypted = encrypted
+        self.manifest = ChunkManifest(size, root)
+        self.repairing = False
+        self.part_path = filename + PART_SUFFIX
+        self.checkpoint_path = self.part_path + CHECKPOINT_SUFFIX
+        self.failed = False
+        if offset and not self._verify_checkpoint(offset):
+            # The server wants to resume from a point we can no longer vouch
+            # for; StreamingReceiver.start asks it to start over instead.
+            offset = 0
+        if offset:
+            self.file = open(self.part_path, 'r+b')
+            self.file.seek(offset)
+            self.file.truncate()
+        else:
+            remove_file(self.checkpoint_path)
+            self.file = open(self.part_path, 'wb')
+        self.seq = offset // CHUNK_SIZE
+        self.received = offset
+        self.written = offset
+
+    def _verify_checkpoint(self, offset):
+        checkpoint = read_checkpoint(self.checkpoint_path)
+        if checkpoint is None or checkpoint.get('offset') != offset or checkpoint.get('root') != self.manifest.root:
+            return False
+        try:
+            with open(self.part_path, 'rb') as file:
+                file.seek(offset - CHUNK_SIZE)
+                return chunk_digest(file.read(CHUNK_SIZE)) == checkpoint.get('chunk_hash')
+        except OSError:
+            return False
+
+    def write(self, chunk, verified=True):
+        self.file.write(chunk)
+        self.written += len(chunk)
+
+    def write_at(self, offset, chunk):
+        # A repaired chunk, over the copy that failed verification.
+        self.file.seek(offset)
+        self.file.write(chunk)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def checkpoint(self, chunk_hash):
+        return {'offset': self.written, 'chunk_hash': chunk_hash, 'root': self.manifest.root}
+
+    def complete(self):
+        self.sync()
+        self.file.close()
+        os.replace(self.part_path, self.filename)
+        remove_file(self.checkpoint_path)
+
+    def close(self):
+        self.file.close()
+
+
+def bundle_path(root, relative_path):
+    # Where a bundle member goes; paths from the server may not leave the root.
+    path = os.path.normpath(os.path.join(root, relative_path))
+    if os.path.isabs(relative_path) or os.path.relpath(path, root).split(os.sep)[0] == os.pardir:
+        raise ValueError(f"bundle member {relative_path} is outside {root}")
+    return path
+
+
+class BundleTransfer:
+    # A directory or glob arriving as one stream: the header, a JSON index of
+    # relative paths and sizes, then every file's contents in index order.
+    # Files are unpacked as the stream arrives; each is written to a part file
+    # and renamed into place once complete. A file holding any chunk that
+    # failed verification stays a part file until the chunk is repaired.
+    # Checkpoints keep the index, so a resumed bundle can find its place
+    # without the header being resent.
+
+    def __init__(self, file_id, filename, size, root, offset=0, encrypted=True):
+        self.file_id = file_id
+        self.filename = filename
+        self.size = size
+        self.encrypted = encrypted
+        self.manifest = ChunkManifest(size, root)
+        self.repairing = False
+        name = hashlib.sha256(filename.encode()).hexdigest()[:16]
+        self.checkpoint_path = f'.bundle-{name}{CHECKPOINT_SUFFIX}'
+        self.failed = False
+        self.tainted = False
+        self.deferred = []
+        self.unsynced = []
+        self._reset()
+        if offset and not self._resume(offset):
+            # As in Transfer, the server is asked to start over.
+            self.close()
+            self._reset()
+            offset = 0
+        if not offset:
+            remove_file(self.checkpoint_path)
+        self.seq = offset // CHUNK_SIZE
+        self.received = offset
+        self.written = offset
+
+    def _reset(self):
+        self.header = bytearray()
+        self.header_size = None
+        self.root = None
+        self.index = None
+        self.files = None
+        self.entry = 0
+        self.remaining = 0
+        self.file = None
+
+    def _set_index(self, index, header_size):
+        root = index['root'] or os.curdir
+        if os.path.dirname(root) or root == os.pardir:
+            raise ValueError(f"bundle root {root} is not a plain directory name")
+        self.root = root
+        self.index = index
+        self.files = [(bundle_path(root, relative_path), size) for relative_path, size in index['files']]
+        self.header_size = header_size
+
+    def _resume(self, offset):
+        checkpoint = read_checkpoint(self.checkpoint_path)
+        if checkpoint is None or checkpoint.get('offset') != offset or 'index' not in checkpoint:
+            return False
+        if checkpoint.get('root') != self.manifest.root:
+            return False
+        try:
+            self._set_index(checkpoint['index'], checkpoint['header_size'])
+            position = self.header_size
+            for entry, (path, size) in enumerate(self.files):
+                if offset < position + size:
+                    # Files before this one are complete; this one may be partly written.
+                    self.entry = entry
+                    if offset > position:
+                        self.remaining = position + size - offset
+                        self.file = open(path + PART_SUFFIX, 'r+b')
+                        self.file.seek(offset - position)
+                        self.file.truncate()
+                        return self.file.tell() == offset - position
+                    return True
+                if os.path.getsize(path) != size:
+                    return False
+                position += size
+            self.entry = len(self.files)
+            return position == offset
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def write(self, chunk, verified=True):
+        if not verified and self.files is None:
+            # Nothing can be unpacked from an index we can't trust.
+            raise ValueError(f"the index of bundle {self.filename} failed verification")
+        view = memoryview(chunk)
+        self.written += len(view)
+        while view:
+            if self.files is None:
+                view = self._read_header(view)
+                continue
+            if self.entry >= len(self.files):
+                raise ValueError(f"bundle {self.filename} is longer than its index")
+            if self.file is None:
+                self._open_entry()
+                continue
+            length = min(len(view), self.remaining)
+            self.file.write(view[:length])
+            view = view[length:]
+            self.remaining -= length
+            self.tainted = self.tainted or not verified
+            if not self.remaining:
+                self._close_entry()
+        if self.files is not None and self.file is None:
+            # Empty files at the end of the stream have no bytes to wait for.
+            while self.entry < len(self.files) and not self.files[self.entry][1]:
+                self._open_entry()
+
+    def _read_header(self, view):
+        needed = BUNDLE_HEADER.size
+        if len(self.header) >= BUNDLE_HEADER.size:
+            needed += BUNDLE_HEADER.unpack_from(self.header)[0]
+        length = min(len(view), needed - len(self.header))
+        self.header += view[:length]
+        if len(self.header) == needed and needed > BUNDLE_HEADER.size:
+            self._set_index(json.loads(bytes(self.header[BUNDLE_HEADER.size:])), needed)
+            self.header = bytearray()
+        return view[length:]
+
+    def _open_entry(self):
+        path, size = self.files[self.entry]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path + PART_SUFFIX, 'wb')
+        self.remaining = size
+        if not size:
+            self._close_entry()
+
+    def _close_entry(self):
+        path, _ = self.files[self.entry]
+        self.file.close()
+        self.file = None
+        if self.tainted:
+            self.deferred.append(path)
+            self.tainted = False
+        else:
+            os.replace(path + PART_SUFFIX, path)
+            self.unsynced.append(path)
+        self.entry += 1
+
+    def write_at(self, offset, chunk):
+        # A repaired chunk, into the part files of the members it spans.
+        view = memoryview(chunk)
+        position = self.header_size
+        for path, size in self.files:
+            start, end = max(offset, position), min(offset + len(view), position + size)
+            if start < end:
+                with open(path + PART_SUFFIX, 'r+b') as file:
+                    file.seek(start - position)
+                    file.write(view[start - offset:end - offset])
+            position += size
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        for path in self.unsynced:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced.clear()
+
+    def checkpoint(self, chunk_hash):
+        if self.files is None:
+            return None
+        return {'offset': self.written, 'chunk_hash': chunk_hash, 'root': self.manifest.root, 'index': self.index,
+                'header_size': self.header_size}
+
+    def complete(self):
+        if self.files is None or self.entry < len(self.files):
+            raise ValueError(f"bundle {self.filename} ended before all of its files arrived")
+        for path in self.deferred:
+            os.replace(path + PART_SUFFIX, path)
+            self.unsynced.append(path)
+        self.deferred.clear()
+        self.sync()
+        remove_file(self.checkpoint_path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Decryption:
+    # A chunk queued for the decrypt workers; result() waits for it and
+    # returns what the work function returned, or raises what it raised.
+
+    def __init__(self, args):
+        self.args = args
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def run(self, function):
+        try:
+            self.value = function(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class StreamingReceiver:
+    # Receiving, decrypting and writing overlap in three stages. The socket
+    # thread reads each chunk into a buffer from `pool` (see FrameReader) and
+    # hands it to data(). One of DECRYPT_WORKERS threads decrypts it in place;
+    # AES and zlib release the GIL, so this runs alongside the next recv. A
+    # single writer thread then writes the chunks in the order they arrived.
+    # Buffers go back to the pool only after they are written. The socket
+    # thread therefore stalls once every buffer is in flight, and memory stays
+    # at `buffers` chunks however large the file is. Completed files are
+    # fsynced and renamed into place atomically before on_complete is called
+    # from the writer thread. Every CHECKPOINT_INTERVAL chunks the part file is
+    # synced, and its verified offset and last chunk hash are recorded and
+    # reported via on_checkpoint.
+    #
+    # The decryptors also check every chunk against the transfer's manifest.
+    # A chunk that fails, or never arrives, is still written so the ones after
+    # it land in the right place, but it holds back checkpoints and the
+    # transfer's completion. At the end of the stream the server is sent a
+    # bitmap of the failed chunks through send_need, resends just those, and
+    # ends the stream again.
+    #
+    # The workers are plain daemon threads rather than a ThreadPoolExecutor:
+    # client.py's main thread returns once its threads are running, and the
+    # executor refuses new work after that.
+
+    def __init__(self, key, on_complete, on_checkpoint, send_need, pool=None, buffers=RECEIVE_BUFFERS,
+                 workers=DECRYPT_WORKERS):
+        self.key = key
+        self.on_complete = on_complete
+        self.on_checkpoint = on_checkpoint
+        self.send_need = send_need
+        self.transfers = {}
+        self.pool = pool if pool is not None else BufferPool(buffers)
+        self.decryptions = queue.Queue()
+        for number in range(workers):
+            threading.Thread(target=self._decrypt_loop, name=f'decrypt-{number}', daemon=True).start()
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def start(self, file_id, filename, size, root, offset=0, encrypted=True, bundle=False):
+        transfer = (BundleTransfer if bundle else Transfer)(file_id, filename, size, root, offset, encrypted)
+        self.transfers[file_id] = transfer
+        if offset:
+            # A resume is answered with the chunks before it that are missing
+            # here: none, or all of them when the transfer had to start over.
+            self._send_bitmap(transfer, range(transfer.seq, offset // CHUNK_SIZE))
+        return transfer
+
+    def get(self, file_id):
+        return self.transfers.get(file_id)
+
+    def digests(self, transfer, payload):
+        transfer.manifest.add(payload)
+
+    def data(self, transfer, frame):
+        # Takes frame.buffer over; frames read without a pool are copied into one.
+        if frame.seq >= transfer.manifest.chunk_count:
+            raise ValueError(f"chunk {frame.seq} of {transfer.filename} is past its end")
+        if not transfer.repairing:
+            if frame.seq < transfer.seq:
+                raise ValueError(f"chunk {frame.seq} of {transfer.filename} arrived out of order, "
+                                 f"expected {transfer.seq}")
+            self._skip_to(transfer, frame.seq)
+            transfer.seq += 1
+        size = len(frame.payload)
+        buffer = frame.buffer
+        if buffer is None:
+            buffer = self.pool.get(size)
+            buffer[:size] = frame.payload
+        chunk = Decryption((transfer, frame.seq, buffer, size, frame.flags))
+        self.decryptions.put(chunk)
+        self.pending.put(('data', transfer, frame.seq, buffer, chunk))
+        # Only now does the buffer belong to the writer, which returns it to the pool.
+        frame.buffer = None
+
+    def _skip_to(self, transfer, seq):
+        # Chunks the server never sent count as failed.
+        while transfer.seq < seq:
+            self.pending.put(('missing', transfer, transfer.seq, None, None))
+            transfer.seq += 1
+
+    def _decrypt_loop(self):
+        while True:
+            self.decryptions.get().run(self._decrypt)
+
+    def _decrypt(self, transfer, index, buffer, size, flags):
+        # Returns the chunk and whether it matches its hash.
+        view = memoryview(buffer)[:size]
+        if transfer.encrypted:
+            decrypt_file(view, self.key, output=view)
+        chunk = zlib.decompress(view) if flags & COMPRESSED else view
+        return chunk, transfer.manifest.check(index, chunk)
+
+    def finish(self, transfer):
+        if not transfer.repairing:
+            self._skip_to(transfer, transfer.manifest.chunk_count)
+        self.pending.put(('finish', transfer, None, None, None))
+
+    def abort_all(self):
+        for transfer in list(self.transfers.values()):
+            del self.transfers[transfer.file_id]
+            self.pending.put(('abort', transfer, None, None, None))
+
+    def _write_loop(self):
+        while True:
+            action, transfer, index, buffer, decrypted = self.pending.get()
+            try:
+                # Wait for the decryptor even when the chunk won't be written:
+                # the buffer can't go back to the pool while it is in use.
+                chunk, verified = decrypted.result() if decrypted is not None else (None, False)
+                if action == 'finish':
+                    self._finish(transfer)
+                elif action == 'abort':
+                    transfer.close()
+                elif transfer.failed:
+                    continue
+                elif action == 'missing':
+                    transfer.manifest.bad.add(index)
+                    self._write_chunk(transfer, bytes(transfer.manifest.chunk_size(index)), False)
+                elif transfer.repairing:
+                    if verified:
+                        transfer.write_at(index * CHUNK_SIZE, chunk)
+                        transfer.manifest.bad.discard(index)
+                else:
+                    if not verified:
+                        transfer.manifest.bad.add(index)
+                    self._write_chunk(transfer, chunk, verified)
+            except Exception as e:
+                transfer.failed = True
+                print(f"[ERROR WRITING {transfer.filename}]: {e}\n")
+            finally:
+                if buffer is not None:
+                    self.pool.put(buffer)
+
+    def _write_chunk(self, transfer, chunk, verified):
+        transfer.write(chunk, verified)
+        transfer.received += len(chunk)
+        if transfer.manifest.bad:
+            # Nothing past a failed chunk can be vouched for until it is repaired.
+            return
+        if (transfer.written // CHUNK_SIZE) % CHECKPOINT_INTERVAL or len(chunk) < CHUNK_SIZE:
+            return
+        chunk_hash = chunk_digest(chunk)
+        checkpoint = transfer.checkpoint(chunk_hash)
+        if checkpoint is None:
+            return
+        transfer.sync()
+        write_checkpoint(transfer.checkpoint_path, checkpoint)
+        self.on_checkpoint(transfer, transfer.written, chunk_hash)
+
+    def _finish(self, transfer):
+        # The server waits at the end of every stream for the chunks to send
+        # again. They are asked for up to MAX_REPAIR_ROUNDS times; a transfer
+        # that still fails, or failed to be written, is dropped unacknowledged
+        # and the server delivers it again later.
+        manifest = transfer.manifest
+        if transfer.failed:
+            # The server is told so rather than sent a bitmap it would take
+            # for every chunk having checked out.
+            self.transfers.pop(transfer.file_id, None)
+            self.send_need(transfer.file_id, 0, b'', last=True, failed=True)
+            transfer.close()
+            return
+        bad = sorted(manifest.bad)
+        if bad and manifest.rounds < MAX_REPAIR_ROUNDS:
+            manifest.rounds += 1
+            transfer.repairing = True
+            print(f"[{len(bad)} CHUNKS OF {transfer.filename} FAILED VERIFICATION, REQUESTING THEM AGAIN]\n")
+            self._send_bitmap(transfer, bad)
+            return
+        self.transfers.pop(transfer.file_id, None)
+        self._send_bitmap(transfer, bad)
+        if bad:
+            print(f"[{len(bad)} CHUNKS OF {transfer.filename} STILL FAIL VERIFICATION, GIVING UP]\n")
+            transfer.close()
+            return
+        transfer.complete()
+        self.on_complete(transfer)
+
+    def _send_bitmap(self, transfer, indexes):
+        count = transfer.manifest.chunk_count
+        for start, payload in bitmap_frames(indexes, count, REPLY_FRAME_SIZE):
+            self.send_need(transfer.file_id, start, payload, last=False)
+        self.send_need(transfer.file_id, (count + 7) // 8, b'', last=True)
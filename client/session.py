@@ -0,0 +1,25 @@
+import json
+import os
+import time
+
+from constants import SESSION_FILE
+
+
+def load_session(path=SESSION_FILE):
+    try:
+        with open(path, 'r') as file:
+            session = json.load(file)
+        # The token ends in <expiry>.<signature>; the server checks the rest.
+        expiry = int(session['token'].split('.')[-2])
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
+    if expiry < time.time():
+        return None
+    return session
+
+
+def save_session(email, token, key, path=SESSION_FILE):
+    # Holds the derived key as well, so treat it like a password: owner-only.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as file:
+        json.dump({'email': email, 'token': token, 'key': key.hex()}, file)
@@ -0,0 +1,212 @@
+import hashlib
+import hmac
+import os
+import queue
+import socket
+import threading
+import time
+import zlib
+
+from utils import encrypt_file, decrypt_file
+from protocol import FrameReader, CONTROL, FILE_DATA, COMPRESSED, send_frame, send_control
+from constants import CHUNK_SIZE, SWARM_FETCHERS, SWARM_PEER_RETRIES, SWARM_RETRY_DELAY, PEER_TIMEOUT
+
+DIGEST_SIZE = 32
+PART_SUFFIX = '.part'
+
+
+class SwarmDownload:
+    # One file arriving through a swarm. The server pushes the pieces of our
+    # own slot; the other pieces come from the peers owning their slots, or
+    # from the server when a peer can't provide them. Every piece is checked
+    # against the piece map before it is written, and once we hold a piece we
+    # serve it to other peers for as long as the client runs.
+
+    def __init__(self, swarm_id, meta, key, request_from_server, on_complete):
+        self.id = swarm_id
+        self.filename = meta['filename']
+        self.size = meta['size']
+        self.piece_count = meta['pieces']
+        self.slot = meta['slot']
+        self.peers = meta['peers']
+        self.key = decrypt_file(bytes.fromhex(meta['swarm_key']), key)
+        self.request_from_server = request_from_server
+        self.on_complete = on_complete
+        self.digests = bytearray()
+        self.have = bytearray(self.piece_count)
+        self.have_count = 0
+        self.complete = False
+        self.peer_bytes = 0
+        self.lock = threading.Lock()
+        self.part_path = self.filename + PART_SUFFIX
+        self.path = self.part_path
+        self.file = open(self.part_path, 'w+b')
+        self.file.truncate(self.size)
+        if self.piece_count == 0:
+            self._finish()
+
+    def add_map(self, payload):
+        self.digests.extend(payload)
+        if len(self.digests) >= self.piece_count * DIGEST_SIZE:
+            self._start_fetchers()
+
+    def owner(self, index):
+        return self.peers[index % len(self.peers)]
+
+    def store_piece(self, index, encrypted_piece, flags=0):
+        if not 0 <= index < self.piece_count or self.have[index]:
+            return self.have[index] if 0 <= index < self.piece_count else False
+        piece = decrypt_file(encrypted_piece, self.key)
+        if flags & COMPRESSED:
+            piece = zlib.decompress(piece)
+        expected = self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+        if hashlib.sha256(piece).digest() != expected:
+            return False
+        with self.lock:
+            if self.have[index]:
+                return True
+            self.file.seek(index * CHUNK_SIZE)
+            self.file.write(piece)
+            self.have[index] = 1
+            self.have_count += 1
+            if self.have_count == self.piece_count:
+                self._finish()
+        return True
+
+    def piece_request(self, index):
+        # Signed with the swarm key, which only members are given, so the
+        # owning peer can tell a member from anyone else who reaches its port.
+        return f"piece {self.id} {index} {self._tag(index)}"
+
+    def is_member_request(self, index, tag):
+        return hmac.compare_digest(self._tag(index), tag)
+
+    def _tag(self, index):
+        return hmac.new(self.key, f"piece {self.id} {index}".encode(), hashlib.sha256).hexdigest()
+
+    def read_piece(self, index):
+        with self.lock:
+            if not 0 <= index < self.piece_count or not self.have[index]:
+                return None
+            self.file.seek(index * CHUNK_SIZE)
+            return encrypt_file(self.file.read(CHUNK_SIZE), self.key)
+
+    def _finish(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.part_path, self.filename)
+        self.path = self.filename
+        # Keep seeding from the finished file.
+        self.file = open(self.filename, 'rb')
+        self.complete = True
+        self.on_complete(self)
+
+    def _start_fetchers(self):
+        missing = queue.Queue()
+        for index in range(self.piece_count):
+            if index % len(self.peers) != self.slot:
+                missing.put((index, 0))
+        for _ in range(SWARM_FETCHERS):
+            threading.Thread(target=self._fetch_loop, args=(missing,), daemon=True).start()
+
+    def _fetch_loop(self, missing):
+        connections = {}
+        try:
+            while not self.complete:
+                try:
+                    index, attempts = missing.get(timeout=SWARM_RETRY_DELAY)
+                except queue.Empty:
+                    return
+                if self.have[index]:
+                    continue
+                peer = self.owner(index)
+                piece = self._fetch_from_peer(connections, peer, index)
+                if piece is not None and self.store_piece(index, piece):
+                    self.peer_bytes += len(piece)
+                    continue
+                if attempts + 1 < SWARM_PEER_RETRIES:
+                    # The owner may simply not have received it from the server yet.
+                    time.sleep(SWARM_RETRY_DELAY)
+                    missing.put((index, attempts + 1))
+                else:
+                    self.request_from_server(self.id, index)
+        finally:
+            for connection in connections.values():
+                if connection is not None:
+                    connection[0].close()
+
+    def _fetch_from_peer(self, connections, peer, index):
+        address = (peer['host'], peer['port'])
+        connection = connections.get(address)
+        try:
+            if connection is None:
+                sock = socket.create_connection(address, timeout=PEER_TIMEOUT)
+                connection = (sock, FrameReader(sock))
+                connections[address] = connection
+            sock, reader = connection
+            send_control(sock, self.piece_request(index))
+            frame = reader.read_frame()
+            if frame is None:
+                raise ConnectionError("peer closed the connection")
+            if frame.type != FILE_DATA or frame.seq != index:
+                return None
+            return bytes(frame.payload)
+        except (OSError, ConnectionError):
+            if connection is not None:
+                connection[0].close()
+            connections.pop(address, None)
+            return None
+
+
+class PeerServer:
+    # Serves pieces of our swarm downloads to other members. It listens only
+    # on host, the address we reach the server from and the one the server
+    # hands out to peers, and answers only requests signed by a member.
+
+    def __init__(self, swarms, host):
+        self.swarms = swarms
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        reader = FrameReader(conn)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    return
+                if frame.type != CONTROL:
+                    continue
+                command = frame.text().split()
+                if len(command) != 4 or command[0] != 'piece':
+                    send_control(conn, 'missing')
+                    continue
+                swarm = self.swarms.get(int(command[1]))
+                index = int(command[2])
+                if swarm is None or not swarm.is_member_request(index, command[3]):
+                    send_control(conn, 'missing')
+                    continue
+                piece = swarm.read_piece(index)
+                if piece is None:
+                    send_control(conn, 'missing')
+                else:
+                    send_frame(conn, FILE_DATA, piece, file_id=swarm.id, seq=index)
+        except Exception:
+            return
+        finally:
+            conn.close()
@@ -0,0 +1,114 @@
+import asyncio
+import concurrent.futures
+import time
+from collections import deque
+
+from utils import verify_password
+from constants import AUTH_WORKERS, MAX_CONCURRENT_LOGINS, MAX_QUEUED_LOGINS, LATENCY_SAMPLES
+from metrics import Histogram
+
+LOGIN_SECONDS = Histogram('fdt_login_seconds', "Login latency: queue wait, bcrypt check and the two together",
+                          labels=('stage',))
+
+
+class LoginRejected(Exception):
+    pass
+
+
+def warm_up():
+    return True
+
+
+class LatencyStats:
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, fraction):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return (f"count={self.count} mean={mean * 1000:.1f}ms p50={self.percentile(0.5) * 1000:.1f}ms "
+                f"p95={self.percentile(0.95) * 1000:.1f}ms p99={self.percentile(0.99) * 1000:.1f}ms "
+                f"max={self.max * 1000:.1f}ms")
+
+
+class LoginAdmission:
+    # bcrypt runs in its own process pool so a reconnect storm can't take the
+    # GIL (or the event loop) away from running transfers. At most
+    # max_concurrent checks are in the pool at once; up to max_queued more
+    # logins wait their turn, and anything beyond that is turned away.
+
+    def __init__(self, workers=AUTH_WORKERS, max_concurrent=MAX_CONCURRENT_LOGINS, max_queued=MAX_QUEUED_LOGINS):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.pool = None
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.queued = 0
+        self.active = 0
+        self.accepted = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_latency = LatencyStats()
+        self.verify_latency = LatencyStats()
+        self.total_latency = LatencyStats()
+
+    async def start(self):
+        # Start the workers up front, before the server spawns any threads.
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.pool, warm_up)
+
+    async def verify(self, password, hashed_password):
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise LoginRejected()
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        started_at = time.perf_counter()
+        self.active += 1
+        try:
+            verified = await loop.run_in_executor(self.pool, verify_password, password, hashed_password)
+        finally:
+            self.active -= 1
+            self.slots.release()
+        finished_at = time.perf_counter()
+        self.wait_latency.record(started_at - queued_at)
+        self.verify_latency.record(finished_at - started_at)
+        self.total_latency.record(finished_at - queued_at)
+        LOGIN_SECONDS.labels('wait').observe(started_at - queued_at)
+        LOGIN_SECONDS.labels('bcrypt').observe(finished_at - started_at)
+        LOGIN_SECONDS.labels('total').observe(finished_at - queued_at)
+        if verified:
+            self.accepted += 1
+        else:
+            self.failed += 1
+        return verified
+
+    def summary(self):
+        return (f"\nlogins: accepted={self.accepted} failed={self.failed} rejected={self.rejected} "
+                f"active={self.active} queued={self.queued}\n"
+                f"queue wait: {self.wait_latency.summary()}\n"
+                f"bcrypt: {self.verify_latency.summary()}\n"
+                f"total: {self.total_latency.summary()}\n")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
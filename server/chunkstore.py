@@ -0,0 +1,135 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+
+from chunking import chunk_spans, pack_records, RECORD
+from constants import FORMAT, CHUNK_STORE_DIR
+from distribution import plain_cache, encrypted_cache, packed_chunk, encrypt_packed
+
+
+class Manifest:
+    # A registered file as the ordered list of its chunks in the store. For
+    # the encryption pipeline it stands in for a FileSource, but its chunk
+    # lengths vary and chunks are cached by content, not by position.
+
+    def __init__(self, store, manifest_id, filename, size, records):
+        self.store = store
+        self.id = manifest_id
+        self.filename = filename
+        self.size = size
+        self.records = records
+        self.chunk_count = len(records)
+
+    def plain_chunk(self, index):
+        return self.store.read_chunk(self.records[index][0])
+
+    def packed_chunk(self, index, plain):
+        return packed_chunk(('packed', self.records[index][0]), plain)
+
+    def cached_encrypted_chunk(self, index, user):
+        return encrypted_cache.get((user['email'], 'chunk', self.records[index][0]))
+
+    def encrypt_chunk(self, index, plain, user):
+        chunk = encrypt_packed(self.packed_chunk(index, plain), user)
+        encrypted_cache.put((user['email'], 'chunk', self.records[index][0]), chunk, len(chunk[1]))
+        return chunk
+
+    def batches(self, batch_size):
+        per_batch = batch_size // RECORD.size
+        for seq, start in enumerate(range(0, self.chunk_count, per_batch)):
+            yield seq, pack_records(self.records[start:start + per_batch])
+
+    def to_json(self):
+        return {'filename': self.filename, 'size': self.size,
+                'chunks': [[digest.hex(), length] for digest, length in self.records]}
+
+
+class ChunkStore:
+    # Content-addressed storage for deduplicated distributions. Each distinct
+    # chunk is stored once, under its sha256, in chunks/<first two hex digits>/.
+    # A manifest names the chunks of one registered file in order and is
+    # kept in manifests/<id>.json. Registering a new build writes only the
+    # chunks the store doesn't already hold, and a manifest stays deliverable
+    # even if the original path changes afterwards.
+
+    def __init__(self, directory=CHUNK_STORE_DIR):
+        self.directory = directory
+        self.manifests = {}
+        self.lock = threading.Lock()
+
+    def chunk_path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.directory, 'chunks', name[:2], name)
+
+    def manifest_path(self, manifest_id):
+        return os.path.join(self.directory, 'manifests', manifest_id + '.json')
+
+    def add_file(self, filename):
+        # Returns the manifest and how many bytes of the file were new to the store.
+        size = os.path.getsize(filename)
+        records = []
+        new_bytes = 0
+        with open(filename, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                for offset, length in chunk_spans(data, size):
+                    chunk = data[offset:offset + length]
+                    digest = hashlib.sha256(chunk).digest()
+                    if self._store_chunk(digest, chunk):
+                        new_bytes += length
+                    records.append((digest, length))
+            finally:
+                if size:
+                    data.close()
+        manifest_id = hashlib.sha256(filename.encode(FORMAT) + b'\0' + pack_records(records)).hexdigest()
+        manifest = Manifest(self, manifest_id, filename, size, records)
+        self._write_atomic(self.manifest_path(manifest_id), json.dumps(manifest.to_json()).encode(FORMAT))
+        with self.lock:
+            self.manifests[manifest_id] = manifest
+        return manifest, new_bytes
+
+    def load(self, manifest_id):
+        with self.lock:
+            manifest = self.manifests.get(manifest_id)
+        if manifest is not None:
+            return manifest
+        try:
+            with open(self.manifest_path(manifest_id), 'rb') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        records = [(bytes.fromhex(digest), length) for digest, length in data['chunks']]
+        manifest = Manifest(self, manifest_id, data['filename'], data['size'], records)
+        with self.lock:
+            self.manifests[manifest_id] = manifest
+        return manifest
+
+    def read_chunk(self, digest):
+        key = ('chunk', digest)
+        chunk = plain_cache.get(key)
+        if chunk is None:
+            with open(self.chunk_path(digest), 'rb') as file:
+                chunk = file.read()
+            plain_cache.put(key, chunk)
+        return chunk
+
+    def _store_chunk(self, digest, chunk):
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return False
+        self._write_atomic(path, chunk)
+        return True
+
+    def _write_atomic(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+
+chunk_store = ChunkStore()
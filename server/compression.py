@@ -0,0 +1,22 @@
+import zlib
+
+from protocol import COMPRESSED
+from constants import COMPRESSION_LEVEL, COMPRESSION_SAMPLE, COMPRESSION_MAX_RATIO
+
+
+def compress_chunk(chunk, level=COMPRESSION_LEVEL):
+    # Returns (frame flags, payload). A sample from the middle of the chunk is
+    # compressed first, so media, archives and other already-compressed data
+    # cost a few microseconds instead of a full zlib pass. Chunks that don't
+    # shrink below COMPRESSION_MAX_RATIO of their size are sent as they are.
+    if not level:
+        return 0, chunk
+    if len(chunk) > 2 * COMPRESSION_SAMPLE:
+        start = (len(chunk) - COMPRESSION_SAMPLE) // 2
+        sample = chunk[start:start + COMPRESSION_SAMPLE]
+        if len(zlib.compress(sample, level)) > COMPRESSION_SAMPLE * COMPRESSION_MAX_RATIO:
+            return 0, chunk
+    compressed = zlib.compress(chunk, level)
+    if len(compressed) > len(chunk) * COMPRESSION_MAX_RATIO:
+        return 0, chunk
+    return COMPRESSED, compressed
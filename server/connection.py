@@ -0,0 +1,146 @@
+import asyncio
+from collections import deque
+
+from protocol import HEADER, HEADER_SIZE, PROTOCOL_VERSION, CONTROL, Frame, ProtocolError, parse_header
+from constants import FORMAT, CONTROL_MAX_PAYLOAD, OUTBOUND_QUEUE_SIZE, CLOSE_TIMEOUT
+from tracing import tracer
+
+
+class Connection:
+    # One connected client on the asyncio server: frames in through the
+    # StreamReader, frames out through the StreamWriter.
+    #
+    # A single writer task owns the outbound side. CONTROL frames wait in
+    # their own queue and always go before queued file data, so a command
+    # reply never lands behind a stream of chunks. Data frames wait for room
+    # in a bounded queue. When a client reads slowly, only its own transfers
+    # stall; they don't hold a worker or a send slot.
+
+    def __init__(self, reader, writer, max_payload=CONTROL_MAX_PAYLOAD, queue_size=OUTBOUND_QUEUE_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.max_payload = max_payload
+        self.addr = writer.get_extra_info('peername')
+        self.queue_size = queue_size
+        self.control = deque()
+        self.data = deque()
+        self.pending = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.error = None
+        self.sender = asyncio.create_task(self._write_loop())
+
+    async def read_frame(self):
+        try:
+            header = await self.reader.readexactly(HEADER_SIZE)
+            frame_type, flags, file_id, seq, length = parse_header(header)
+            if length > self.max_payload:
+                raise ProtocolError(f"frame payload of {length} bytes exceeds {self.max_payload}")
+            payload = await self.reader.readexactly(length) if length else b''
+        except (EOFError, ConnectionError):
+            return None
+        return Frame(frame_type, flags, file_id, seq, payload)
+
+    async def writable(self):
+        # Waits until there is room for another data frame. Time spent here
+        # is time the client's socket can't keep up.
+        if len(self.data) >= self.queue_size and self.error is None:
+            with tracer.span('socket'):
+                while len(self.data) >= self.queue_size and self.error is None:
+                    self.space.clear()
+                    await self.space.wait()
+        if self.error is not None:
+            raise ConnectionError(f"connection to {self.addr} failed: {self.error}")
+
+    def _enqueue(self, queue, item):
+        queue.append(item)
+        self.idle.clear()
+        self.pending.set()
+
+    async def send_frame(self, frame_type, payload=b'', file_id=0, seq=0, flags=0):
+        header = HEADER.pack(PROTOCOL_VERSION, frame_type, flags, file_id, seq, len(payload))
+        if frame_type == CONTROL:
+            if self.error is not None:
+                raise ConnectionError(f"connection to {self.addr} failed: {self.error}")
+            self._enqueue(self.control, ('frame', header, payload))
+            return
+        await self.writable()
+        self._enqueue(self.data, ('frame', header, payload))
+
+    async def send_file_frame(self, frame_type, file, offset, length, file_id=0, seq=0, flags=0):
+        # Header through the stream, payload straight from the file with
+        # sendfile. The file has to stay open until the frame is written; see
+        # after_queued.
+        header = HEADER.pack(PROTOCOL_VERSION, frame_type, flags, file_id, seq, length)
+        await self.writable()
+        self._enqueue(self.data, ('file', header, file, offset, length))
+
+    def after_queued(self, callback):
+        # Runs callback once every data frame queued so far has been written,
+        # or dropped because the connection failed.
+        if self.error is not None:
+            callback()
+            return
+        self._enqueue(self.data, ('call', callback))
+
+    async def send_control(self, text):
+        await self.send_frame(CONTROL, text.encode(FORMAT))
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if self.control:
+                    item = self.control.popleft()
+                elif self.data:
+                    item = self.data.popleft()
+                    self.space.set()
+                else:
+                    self.idle.set()
+                    self.pending.clear()
+                    await self.pending.wait()
+                    continue
+                if item[0] == 'call':
+                    item[1]()
+                elif item[0] == 'frame':
+                    _, header, payload = item
+                    if payload:
+                        self.writer.writelines((header, payload))
+                    else:
+                        self.writer.write(header)
+                    await self.writer.drain()
+                else:
+                    _, header, file, offset, length = item
+                    self.writer.write(header)
+                    await self.writer.drain()
+                    await loop.sendfile(self.writer.transport, file, offset, length)
+        except asyncio.CancelledError:
+            self.error = self.error or 'closed'
+        except Exception as e:
+            self.error = e
+        finally:
+            for item in self.data:
+                if item[0] == 'call':
+                    item[1]()
+            self.data.clear()
+            self.control.clear()
+            self.space.set()
+            self.idle.set()
+
+    async def close(self):
+        # Give queued replies (e.g. a login refusal) a chance to go out first.
+        try:
+            await asyncio.wait_for(self.idle.wait(), CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        self.error = self.error or 'closed'
+        self.sender.cancel()
+        if self.writer.is_closing():
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
@@ -1,3 +1,4 @@
+import os
 import socket
 
 PORT = 8800
@@ -6,12 +7,64 @@ ADDR = (SERVER, PORT)
 FORMAT = 'utf-8'
 FIXED_SALT = b'\xa3\xd8\x7b\x1c\xe4\x9f\x23\x47\x91\x6e\xc8\x34\x12\xab\xcd\xef'
 
-ADMIN_COMMANDS = ['init', 'create-group', 'delete-group', 'list-users', 'view-requests', 'add', 'remove']
-GENERAL_COMMANDS = ['list-groups', 'join-group', 'received-file', 'my-groups']
+ADMIN_COMMANDS = ['init', 'create-group', 'delete-group', 'list-users', 'view-requests', 'add', 'remove', 'set-encryption', 'init-swarm', 'auth-stats', 'transfer-stats', 'set-rate', 'rate-stats', 'init-dedup', 'init-delta', 'stats', 'trace', 'profile', 'revoke-sessions']
+GENERAL_COMMANDS = ['list-groups', 'join-group', 'received-file', 'my-groups', 'checkpoint', 'peer-port', 'swarm-piece']
 
 CHUNK_SIZE = 128 * 1024
 
-MAX_CONCURRENT_TRANSFERS = 5
+COMPRESSION_LEVEL = 1  # zlib level for chunks that compress well; 0 turns compression off
+COMPRESSION_SAMPLE = 4 * 1024
+COMPRESSION_MAX_RATIO = 0.9
 
+MAX_CONCURRENT_TRANSFERS = 256
+PRIORITY_RESERVE = 32
+TRANSFER_PRIORITIES = {'high': 8, 'normal': 4, 'bulk': 1}
+SMALL_FILE_SIZE = 8 * 1024 * 1024
+MIN_SEND_CONCURRENCY = 8
+MAX_SEND_CONCURRENCY = 512
+SCHEDULER_INTERVAL = 1.0
 
+GLOBAL_RATE_LIMIT = 0  # bytes per second, 0 for unlimited
+RECIPIENT_RATE_LIMIT = 0
+RATE_BURST_SECONDS = 0.05
+RATE_WINDOW = 1.0
 
+PLAIN_CACHE_SIZE = 256 * 1024 * 1024
+ENCRYPTED_CACHE_SIZE = 128 * 1024 * 1024
+ENCRYPTED_DISK_CACHE_DIR = 'encrypted_cache'
+ENCRYPTED_DISK_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+CHUNK_STORE_DIR = 'chunk_store'
+DIGEST_CACHE_DIR = 'digest_cache'
+DIGEST_CACHE_SIZE = 64 * 1024 * 1024  # chunk hashes kept in memory; 32 bytes per chunk
+DELTA_CACHE_SIZE = 16 * 1024 * 1024  # computed deltas kept in memory, reused for recipients with the same copy
+REPLY_TIMEOUT = 120  # how long to wait for a client's chunk bitmap or block signatures
+MAX_REPAIR_ROUNDS = 3  # times chunks that failed verification are sent again before giving up
+
+DB_WORKERS = 4  # each worker reads through its own connection; writes are serialized
+AUTH_WORKERS = os.cpu_count() or 1
+CRYPTO_WORKERS = os.cpu_count() or 1
+IO_WORKERS = 4
+DELTA_WORKERS = 2
+DIGEST_WORKERS = 2  # hash new files outside the io pool, so other transfers' reads aren't held up
+
+MAX_CONCURRENT_LOGINS = AUTH_WORKERS * 2
+MAX_QUEUED_LOGINS = 8192
+LATENCY_SAMPLES = 1024
+
+METRICS_HOST = '127.0.0.1'  # the Prometheus endpoint is only reachable locally
+METRICS_PORT = 9800  # 0 turns the endpoint off; the `stats` command still works
+
+TRACE_DIR = 'traces'  # where `trace stop` and `profile stop` write their files
+TRACE_MAX_SPANS = 500000  # the oldest spans are dropped beyond this
+PROFILE_INTERVAL = 0.005
+
+SESSION_SECRET_FILE = 'session.key'
+SESSION_TTL = 12 * 60 * 60
+
+PIPELINE_DEPTH = CRYPTO_WORKERS + 2
+
+STREAM_LIMIT = 16 * 1024
+LISTEN_BACKLOG = 4096
+CONTROL_MAX_PAYLOAD = 64 * 1024
+OUTBOUND_QUEUE_SIZE = 16  # data frames per connection
+CLOSE_TIMEOUT = 5
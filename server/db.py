@@ -1,69 +1,140 @@
 import sqlite3
-from utils import hash_password, verify_password
+import threading
+from contextlib import contextmanager
+from utils import hash_password
 from utils import derive_key_from_password
+from metrics import Histogram, instrument_methods
 
 DB_FILE = "database.db"
+BUSY_TIMEOUT = 5  # seconds to wait for a lock held by another process before failing
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',  # durable enough under WAL, without an fsync per commit
+    'PRAGMA cache_size = -65536',  # 64 MiB page cache per connection
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+)
 
 
 def raise_db_error(message):
     print("DB ERROR: ", message)
 
 
+def connect(db_file):
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
 class Database:
+    # The database runs in WAL mode. All writes go through one connection,
+    # self.conn, one transaction at a time under write_lock; every thread
+    # reads through its own read-only connection, and under WAL those reads
+    # never wait for the writer. Each connection keeps its prepared
+    # statements cached, so the fixed SQL below is compiled once per connection.
     conn = None
 
     def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
         try:
-            self.conn = sqlite3.connect(db_file, check_same_thread=False)
+            self.conn = connect(db_file)
+            self.conn.execute('PRAGMA journal_mode = WAL')
         except sqlite3.Error as e:
             print(e)
 
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = connect(self.db_file)
+            conn.execute('PRAGMA query_only = ON')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def writer(self):
+        # Commits when the block finishes and rolls back if it raises.
+        with self.write_lock, self.conn:
+            yield self.conn
+
     def initiate_tables(self):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                              (id INTEGER PRIMARY KEY , 
-                               email VARCHAR(255) UNIQUE NOT NULL, 
-                               password VARCHAR(255), 
-                               private_key VARCHAR(255),
-                               is_admin BOOLEAN DEFAULT false)
-                               ''')
-
-            cursor.execute('''CREATE TABLE IF NOT EXISTS groups 
-                            (id INTEGER PRIMARY KEY ,
-                            group_name VARCHAR(100) UNIQUE NOT NULL,
-                            description TEXT)
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''CREATE TABLE IF NOT EXISTS users
+                                  (id INTEGER PRIMARY KEY ,
+                                   email VARCHAR(255) UNIQUE NOT NULL,
+                                   password VARCHAR(255),
+                                   private_key VARCHAR(255),
+                                   is_admin BOOLEAN DEFAULT false,
+                                   session_generation INTEGER DEFAULT 0)
+                                   ''')
+
+                cursor.execute('''CREATE TABLE IF NOT EXISTS groups
+                                (id INTEGER PRIMARY KEY ,
+                                group_name VARCHAR(100) UNIQUE NOT NULL,
+                                description TEXT,
+                                encrypted BOOLEAN DEFAULT true)
+                                ''')
+
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS groups_users
+                    (user_id INTEGER,
+                    group_id INTEGER,
+                    FOREIGN KEY (user_id) REFERENCES users(id),
+                    FOREIGN KEY (group_id) REFERENCES groups(id),
+                    PRIMARY KEY (user_id, group_id))
+                    ''')
+
+                cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS pending_files (
+                            user_id INTEGER,
+                            filename VARCHAR(255),
+                            offset INTEGER DEFAULT 0,
+                            chunk_hash VARCHAR(64),
+                            encrypted BOOLEAN DEFAULT true,
+                            manifest VARCHAR(64),
+                            delta BOOLEAN DEFAULT false,
+                            FOREIGN KEY (user_id) REFERENCES users(id)
+                            PRIMARY KEY (user_id, filename))
                             ''')
 
-            self.conn.commit()
-
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS groups_users 
-                (user_id INTEGER,
-                group_id INTEGER,
-                FOREIGN KEY (user_id) REFERENCES users(id),
-                FOREIGN KEY (group_id) REFERENCES groups(id),
-                PRIMARY KEY (user_id, group_id))
-                ''')
-
-            cursor.execute('''
-                        CREATE TABLE IF NOT EXISTS pending_files (
-                        user_id INTEGER,
-                        filename VARCHAR(255), 
-                        FOREIGN KEY (user_id) REFERENCES users(id)
-                        PRIMARY KEY (user_id, filename))
-                        ''')
+                cursor.execute('PRAGMA table_info(pending_files)')
+                columns = [column[1] for column in cursor.fetchall()]
+                if 'offset' not in columns:
+                    cursor.execute('ALTER TABLE pending_files ADD COLUMN offset INTEGER DEFAULT 0')
+                if 'chunk_hash' not in columns:
+                    cursor.execute('ALTER TABLE pending_files ADD COLUMN chunk_hash VARCHAR(64)')
+                if 'encrypted' not in columns:
+                    cursor.execute('ALTER TABLE pending_files ADD COLUMN encrypted BOOLEAN DEFAULT true')
+                if 'manifest' not in columns:
+                    cursor.execute('ALTER TABLE pending_files ADD COLUMN manifest VARCHAR(64)')
+                if 'delta' not in columns:
+                    cursor.execute('ALTER TABLE pending_files ADD COLUMN delta BOOLEAN DEFAULT false')
+
+                cursor.execute('PRAGMA table_info(users)')
+                columns = [column[1] for column in cursor.fetchall()]
+                if 'session_generation' not in columns:
+                    cursor.execute('ALTER TABLE users ADD COLUMN session_generation INTEGER DEFAULT 0')
+
+                cursor.execute('PRAGMA table_info(groups)')
+                columns = [column[1] for column in cursor.fetchall()]
+                if 'encrypted' not in columns:
+                    cursor.execute('ALTER TABLE groups ADD COLUMN encrypted BOOLEAN DEFAULT true')
+
+                cursor.execute('''
+                            CREATE TABLE IF NOT EXISTS group_join_requests
+                            (user_id INTEGER,
+                            group_id INTEGER,
+                            FOREIGN KEY (user_id) REFERENCES users(id),
+                            FOREIGN KEY (group_id) REFERENCES groups(id),
+                            PRIMARY KEY (user_id, group_id))
+                            ''')
 
-            cursor.execute('''
-                        CREATE TABLE IF NOT EXISTS group_join_requests 
-                        (user_id INTEGER,
-                        group_id INTEGER,
-                        FOREIGN KEY (user_id) REFERENCES users(id),
-                        FOREIGN KEY (group_id) REFERENCES groups(id),
-                        PRIMARY KEY (user_id, group_id))
-                        ''')
-
-            self.conn.commit()
+                cursor.execute('CREATE INDEX IF NOT EXISTS groups_users_group_id ON groups_users (group_id)')
         except sqlite3.Error as e:
             print(e)
 
@@ -71,19 +142,20 @@ class Database:
 
     def insert_user(self, email, password):
         try:
-            cursor = self.conn.cursor()
+            cursor = self.reader().cursor()
             cursor.execute('SELECT COUNT(*) FROM users WHERE email = ?', (email,))
             email_exists = cursor.fetchone()[0] > 0
             if email_exists:
                 return False
 
+            # Hash before taking the write lock; a racing insert of the same
+            # email still fails on the UNIQUE constraint.
             hashed_password = hash_password(password)
             key = derive_key_from_password(password)
             user_data = (email, hashed_password, key)
             sql = f''' INSERT INTO users(email, password, private_key) VALUES( ?, ?, ?) '''
-            cursor = self.conn.cursor()
-            cursor.execute(sql, user_data)
-            self.conn.commit()
+            with self.writer() as conn:
+                conn.execute(sql, user_data)
             return True
         except Exception as e:
             raise_db_error(e)
@@ -91,15 +163,14 @@ class Database:
 
     def insert_group(self, group_name, description=""):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM groups WHERE group_name = ?', (group_name,))
-            group_exists = cursor.fetchone()[0] > 0
-            if group_exists:
-                return False
-            sql = '''INSERT INTO groups(group_name, description) VALUES(?, ?)'''
-            cursor = self.conn.cursor()
-            cursor.execute(sql, (group_name, description))
-            self.conn.commit()
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT COUNT(*) FROM groups WHERE group_name = ?', (group_name,))
+                group_exists = cursor.fetchone()[0] > 0
+                if group_exists:
+                    return False
+                sql = '''INSERT INTO groups(group_name, description) VALUES(?, ?)'''
+                cursor.execute(sql, (group_name, description))
             return True
         except Exception as e:
             raise_db_error(e)
@@ -107,59 +178,87 @@ class Database:
 
     def add_user_to_group(self, email, group_name):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-            result = cursor.fetchone()
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
+                result = cursor.fetchone()
 
-            if result is None:
-                return False
+                if result is None:
+                    return False
 
-            user_id = result[0]
+                user_id = result[0]
 
-            cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
-            result = cursor.fetchone()
-            if result is None:
-                return False
+                cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
+                result = cursor.fetchone()
+                if result is None:
+                    return False
 
-            group_id = result[0]
-            cursor.execute('''
-                DELETE FROM group_join_requests
-                WHERE user_id = ? AND group_id = ?
-            ''', (user_id, group_id))
+                group_id = result[0]
+                cursor.execute('''
+                    DELETE FROM group_join_requests
+                    WHERE user_id = ? AND group_id = ?
+                ''', (user_id, group_id))
 
-            cursor.execute('''
-                INSERT OR IGNORE INTO groups_users (user_id, group_id)
-                VALUES (?, ?)
-            ''', (user_id, group_id))
+                cursor.execute('''
+                    INSERT OR IGNORE INTO groups_users (user_id, group_id)
+                    VALUES (?, ?)
+                ''', (user_id, group_id))
+            return True
+        except Exception as e:
+            raise_db_error(e)
+            return False
 
-            self.conn.commit()
+    def add_pending_files(self, user_ids, filename, encrypted=True, manifest=None, delta=False):
+        try:
+            with self.writer() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO pending_files (user_id, filename, offset, chunk_hash, encrypted, manifest,
+                                                          delta)
+                    VALUES (?, ?, 0, NULL, ?, ?, ?)
+                ''', [(user_id, filename, encrypted, manifest, delta) for user_id in user_ids])
             return True
         except Exception as e:
             raise_db_error(e)
             return False
 
-    def add_pending_file(self, email, filename):
+    def update_pending_progress(self, email, filename, offset, chunk_hash):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-            result = cursor.fetchone()
-            if result is None:
-                return False
-            user_id = result[0]
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE pending_files SET offset = ?, chunk_hash = ?
+                    WHERE user_id = (SELECT id FROM users WHERE email = ?) AND filename = ?
+                ''', (offset, chunk_hash, email, filename))
+            return cursor.rowcount > 0
+        except Exception as e:
+            raise_db_error(e)
+            return False
 
-            cursor.execute('''
-                                INSERT OR IGNORE INTO pending_files (user_id, filename)
-                                VALUES (?, ?)
-                                ''', (user_id, filename))
+    def set_group_encryption(self, group_name, encrypted):
+        try:
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('UPDATE groups SET encrypted = ? WHERE group_name = ?', (encrypted, group_name))
+            return cursor.rowcount > 0
+        except Exception as e:
+            raise_db_error(e)
+            return False
 
-            self.conn.commit()
-            return True
+    def revoke_sessions(self, email):
+        # Session tokens carry the generation they were issued under; bumping
+        # it invalidates every token the user holds.
+        try:
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('UPDATE users SET session_generation = session_generation + 1 WHERE email = ?',
+                               (email,))
+            return cursor.rowcount > 0
         except Exception as e:
             raise_db_error(e)
             return False
 
     def create_super_user(self):
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
         cursor.execute('SELECT COUNT(*) FROM users WHERE email = ?', ("admin",))
         admin_exists = cursor.fetchone()[0] > 0
         if admin_exists:
@@ -169,43 +268,41 @@ class Database:
         key = derive_key_from_password(password)
         user_data = ("admin", hashed_password, key, True)
         sql = f''' INSERT INTO users(email, password, private_key, is_admin) VALUES( ?, ?, ?, ?) '''
-        cursor = self.conn.cursor()
-        cursor.execute(sql, user_data)
-        self.conn.commit()
+        with self.writer() as conn:
+            cursor = conn.execute(sql, user_data)
         return cursor.lastrowid
 
     def create_join_request(self, email, group_name):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-            result = cursor.fetchone()
-
-            if result is None:
-                return False
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
+                result = cursor.fetchone()
 
-            user_id = result[0]
+                if result is None:
+                    return False
 
-            cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
-            result = cursor.fetchone()
+                user_id = result[0]
 
-            if result is None:
-                return False
+                cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
+                result = cursor.fetchone()
 
-            group_id = result[0]
+                if result is None:
+                    return False
 
-            cursor.execute('''
-                                SELECT 1 FROM groups_users WHERE user_id = ? AND group_id = ?
-                                ''', (user_id, group_id))
+                group_id = result[0]
 
-            if cursor.fetchone() is not None:
-                return False
+                cursor.execute('''
+                                    SELECT 1 FROM groups_users WHERE user_id = ? AND group_id = ?
+                                    ''', (user_id, group_id))
 
-            cursor.execute('''
-                                INSERT OR IGNORE INTO group_join_requests (user_id, group_id)
-                                VALUES (?, ?)
-                                ''', (user_id, group_id))
+                if cursor.fetchone() is not None:
+                    return False
 
-            self.conn.commit()
+                cursor.execute('''
+                                    INSERT OR IGNORE INTO group_join_requests (user_id, group_id)
+                                    VALUES (?, ?)
+                                    ''', (user_id, group_id))
             return True
 
         except:
@@ -213,164 +310,69 @@ class Database:
 
     """ ---QUERY--- """
 
-    def get_users_list(self):
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT (email) FROM users")
-            users = cursor.fetchall()
-            result = []
-            for user in users:
-                result.append(user[0])
-            return result
-        except Exception as e:
-            raise_db_error(e)
-            return []
-
-    def get_groups_list(self):
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT (group_name) FROM groups")
-            groups = cursor.fetchall()
-            result = []
-            for group in groups:
-                result.append(group[0])
-            return result
-        except Exception as e:
-            raise_db_error(e)
-            return []
-
-    def verify_user(self, email, password):
+    def get_password_hash(self, email):
         try:
-            cursor = self.conn.cursor()
+            cursor = self.reader().cursor()
             cursor.execute('''SELECT password  FROM users WHERE email = ?''', (email,))
             data = cursor.fetchone()
             if not data:
-                return False
-            hashed_password = data[0]
-            if hashed_password:
-                if verify_password(password, hashed_password):
-                    return True
-                else:
-                    return False
-            else:
-                return False
+                return None
+            return data[0]
         except Exception as e:
             raise_db_error(e)
-            return False
+            return None
 
-    def is_admin(self, email):
+    def get_user_record(self, email):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''SELECT is_admin FROM users WHERE email = ?''', (email,))
-            data = cursor.fetchone()
-            if data:
-                return data[0]
-            else:
-                return False
+            cursor = self.reader().cursor()
+            cursor.execute('SELECT id, email, is_admin, private_key, session_generation FROM users WHERE email = ?',
+                           (email,))
+            return cursor.fetchone()
         except Exception as e:
             raise_db_error(e)
-            return False
+            return None
 
-    def get_user_private_key(self, email):
+    def get_group_record(self, group_name):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''SELECT private_key FROM users WHERE email = ?''', (email,))
-            key = cursor.fetchone()[0]
-            return key
+            cursor = self.reader().cursor()
+            cursor.execute('SELECT id, group_name, encrypted FROM groups WHERE group_name = ?', (group_name,))
+            return cursor.fetchone()
         except Exception as e:
             raise_db_error(e)
-            return "invalid email"
-
-    def get_all_users_from_groups(self, groups):
+            return None
+
+    def load_directory(self):
+        # Every user, group and membership, for the server's in-memory directory.
+        cursor = self.reader().cursor()
+        cursor.execute('SELECT id, email, is_admin, private_key, session_generation FROM users')
+        users = cursor.fetchall()
+        cursor.execute('SELECT id, group_name, encrypted FROM groups')
+        groups = cursor.fetchall()
+        cursor.execute('SELECT user_id, group_id FROM groups_users')
+        memberships = cursor.fetchall()
+        return users, groups, memberships
+
+    def get_pending_files(self, email):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM groups WHERE group_name IN ({seq})'.format(
-                seq=','.join(['?'] * len(groups))),
-                tuple(groups)
-            )
-
-            result = cursor.fetchall()
-            if not result:
-                return []
-
-            group_ids = [group_id[0] for group_id in result]
-
-            cursor.execute('''
-                SELECT DISTINCT user_id
-                FROM groups_users
-                WHERE group_id IN ({seq})
-            '''.format(seq=','.join(['?'] * len(group_ids))),
-                           tuple(group_ids)
-                           )
-
-            result = cursor.fetchall()
-            if not result:
-                return []
-            user_ids = [user_id[0] for user_id in result]
+            cursor = self.reader().cursor()
             cursor.execute('''
-                SELECT (email)
-                FROM users
-                WHERE id IN ({seq})
-            '''.format(seq=','.join(['?'] * len(user_ids))),
-                           tuple(user_ids)
-                           )
-            result = cursor.fetchall()
-            emails = [user[0] for user in result]
-            return emails
+                SELECT pending_files.filename, pending_files.offset, pending_files.chunk_hash,
+                       pending_files.encrypted, pending_files.manifest, pending_files.delta
+                FROM pending_files
+                JOIN users ON pending_files.user_id = users.id
+                WHERE users.email = ?
+            ''', (email,))
+            return [
+                {"filename": row[0], "offset": row[1] or 0, "chunk_hash": row[2], "encrypted": row[3] != 0,
+                 "manifest": row[4], "delta": bool(row[5])}
+                for row in cursor.fetchall()
+            ]
         except Exception as e:
             raise_db_error(e)
             return []
 
-    def get_pending_filenames(self, email):
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-            result = cursor.fetchone()
-
-            if result is None:
-                print("User not found.")
-                return []
-
-            user_id = result[0]
-            cursor.execute('''
-                SELECT filename
-                FROM pending_files
-                WHERE user_id = ?
-            ''', (user_id,))
-
-            filenames = cursor.fetchall()
-
-            filenames = [filename[0] for filename in filenames]
-
-            return filenames
-        except:
-            return []
-
-    def get_user_groups(self, email):
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-            result = cursor.fetchone()
-
-            if result is None:
-                return []
-
-            user_id = result[0]
-            cursor.execute('''
-                SELECT groups.group_name
-                FROM groups
-                JOIN groups_users ON groups.id = groups_users.group_id
-                WHERE groups_users.user_id = ?
-            ''', (user_id,))
-
-            result = cursor.fetchall()
-            groups = [group_name[0] for group_name in result]
-            return groups
-        except:
-            return []
-
     def get_join_requests(self):
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
         cursor.execute('''
             SELECT users.email, groups.group_name
             FROM group_join_requests
@@ -389,19 +391,19 @@ class Database:
 
     def remove_pending_file(self, email, filename):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-            result = cursor.fetchone()
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
+                result = cursor.fetchone()
 
-            if result is None:
-                return True
+                if result is None:
+                    return True
 
-            user_id = result[0]
-            cursor.execute('''
-                DELETE FROM pending_files
-                WHERE user_id = ? AND filename = ?
-            ''', (user_id, filename))
-            self.conn.commit()
+                user_id = result[0]
+                cursor.execute('''
+                    DELETE FROM pending_files
+                    WHERE user_id = ? AND filename = ?
+                ''', (user_id, filename))
             return True
         except Exception as e:
             raise_db_error(e)
@@ -409,27 +411,26 @@ class Database:
 
     def remove_user_from_group(self, email, group_name):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-            result = cursor.fetchone()
-            if result is None:
-                return True
-
-            user_id = result[0]
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
+                result = cursor.fetchone()
+                if result is None:
+                    return True
 
-            cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
-            result = cursor.fetchone()
-            if result is None:
-                return True
+                user_id = result[0]
 
-            group_id = result[0]
+                cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
+                result = cursor.fetchone()
+                if result is None:
+                    return True
 
-            cursor.execute('''
-                DELETE FROM groups_users
-                WHERE user_id = ? AND group_id = ?
-            ''', (user_id, group_id))
+                group_id = result[0]
 
-            self.conn.commit()
+                cursor.execute('''
+                    DELETE FROM groups_users
+                    WHERE user_id = ? AND group_id = ?
+                ''', (user_id, group_id))
             return True
         except Exception as e:
             raise_db_error(e)
@@ -437,22 +438,26 @@ class Database:
 
     def delete_group(self, group_name):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
-            result = cursor.fetchone()
+            with self.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT id FROM groups WHERE group_name = ?', (group_name,))
+                result = cursor.fetchone()
 
-            if result is None:
-                return True
+                if result is None:
+                    return True
 
-            group_id = result[0]
-            cursor.execute('DELETE FROM groups_users WHERE group_id = ?', (group_id,))
-            cursor.execute('DELETE FROM groups WHERE id = ?', (group_id,))
-            self.conn.commit()
+                group_id = result[0]
+                cursor.execute('DELETE FROM groups_users WHERE group_id = ?', (group_id,))
+                cursor.execute('DELETE FROM groups WHERE id = ?', (group_id,))
             return True
         except:
             return False
 
 
+DB_QUERY_SECONDS = Histogram('fdt_db_query_seconds', "Time spent in each Database method", labels=('method',))
+instrument_methods(Database, DB_QUERY_SECONDS, exclude=('reader', 'writer'))
+
+
 def generate_dummy_data():
     conn = Database()
     conn.initiate_tables()
@@ -480,5 +485,32 @@ def generate_dummy_data():
     print(f"{relations_count} relations generated.")
     print("DATABASE DUMMY ENTRIES GENERATED SUCCESSFULLY!")
 
+
+def generate_benchmark_data(db_file, users, groups, password, fanout_group, fanout_users, encrypted=True):
+    # Like generate_dummy_data, but at scale: bench{i}@example.com for every
+    # user, all sharing one password so bcrypt runs once instead of per user.
+    # Every user belongs to one of the bench groups; the first fanout_users
+    # also belong to fanout_group.
+    conn = Database(db_file)
+    conn.initiate_tables()
+    conn.create_super_user()
+
+    hashed_password = hash_password(password)
+    key = derive_key_from_password(password)
+    emails = [f"bench{i}@example.com" for i in range(users)]
+    group_names = [f"bench-group{i}" for i in range(groups)]
+    with conn.writer() as db:
+        db.executemany('INSERT OR IGNORE INTO users(email, password, private_key) VALUES(?, ?, ?)',
+                       ((email, hashed_password, key) for email in emails))
+        db.executemany('INSERT OR IGNORE INTO groups(group_name, description, encrypted) VALUES(?, ?, ?)',
+                       ((name, "benchmark", encrypted) for name in group_names + [fanout_group]))
+        user_ids = dict(db.execute("SELECT email, id FROM users WHERE email LIKE 'bench%'"))
+        group_ids = dict(db.execute("SELECT group_name, id FROM groups WHERE description = 'benchmark'"))
+        memberships = [(user_ids[email], group_ids[group_names[i % groups]]) for i, email in enumerate(emails)]
+        memberships += [(user_ids[email], group_ids[fanout_group]) for email in emails[:fanout_users]]
+        db.executemany('INSERT OR IGNORE INTO groups_users(user_id, group_id) VALUES(?, ?)', memberships)
+    return emails
+
+
 if __name__ == "__main__":
     generate_dummy_data()
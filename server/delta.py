@@ -0,0 +1,178 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import zlib
+
+from utils import encrypt_file
+from compression import compress_chunk
+from constants import CHUNK_SIZE
+
+# rsync-style delta transfer. The client describes its copy of a file as a
+# list of block signatures, the server finds those blocks anywhere in the new
+# version and sends only what lies between them.
+MIN_BLOCK = 2 * 1024
+MAX_BLOCK = 64 * 1024
+SIGNATURE = struct.Struct('!II32s')  # adler32, block length, sha256
+COPY_RUN = struct.Struct('!II')  # first block, block count
+ADLER_MOD = 65521
+# Bytes the rolling search may step over before the delta is given up on and
+# the file sent whole; past this it costs more than it saves.
+MAX_CHANGED = 8 * 1024 * 1024
+
+
+def block_size_for(size):
+    # About sqrt(size) bytes per block, like rsync: the signature and the
+    # expected literal overhead grow at the same rate.
+    return max(MIN_BLOCK, min(MAX_BLOCK, math.isqrt(size) // 1024 * 1024))
+
+
+def unpack_signatures(payload):
+    return [SIGNATURE.unpack_from(payload, offset)
+            for offset in range(0, len(payload) - SIGNATURE.size + 1, SIGNATURE.size)]
+
+
+def pack_copies(runs):
+    return b''.join(COPY_RUN.pack(first, count) for first, count in runs)
+
+
+def unpack_copies(payload):
+    return [COPY_RUN.unpack_from(payload, offset) for offset in range(0, len(payload), COPY_RUN.size)]
+
+
+class BlockTable:
+    def __init__(self, signatures, block_size):
+        self.blocks = {}
+        self.tail_length = 0
+        for index, (weak, length, strong) in enumerate(signatures):
+            self.blocks.setdefault(weak, []).append((length, strong, index))
+            if length < block_size:
+                self.tail_length = length
+
+    def __contains__(self, weak):
+        return weak in self.blocks
+
+    def find(self, weak, window):
+        candidates = self.blocks.get(weak)
+        if not candidates:
+            return None
+        strong = None
+        for length, digest, index in candidates:
+            if length != len(window):
+                continue
+            if strong is None:
+                strong = hashlib.sha256(window).digest()
+            if digest == strong:
+                return index
+        return None
+
+
+def compute_delta(filename, signature_payload, block_size, max_literal=CHUNK_SIZE, max_changed=MAX_CHANGED):
+    # Returns the instructions that rebuild filename from the client's blocks,
+    # ('copy', first_block, block_count) or ('literal', offset, length) with
+    # literals of at most max_literal bytes, and the sha256 of the whole file.
+    # Unchanged stretches cost one adler32 and one sha256 per block, both in C;
+    # the byte-by-byte rolling search only runs where the file has changed.
+    # Once more than max_changed bytes have changed, the whole file is sent as
+    # literals instead.
+    table = BlockTable(unpack_signatures(signature_payload), block_size)
+    instructions = []
+    size = os.path.getsize(filename)
+    changed = 0
+
+    def literal(start, end):
+        nonlocal changed
+        changed += end - start
+        for offset in range(start, end, max_literal):
+            instructions.append(('literal', offset, min(max_literal, end - offset)))
+
+    def copy(index):
+        if instructions and instructions[-1][0] == 'copy':
+            _, first, count = instructions[-1]
+            if first + count == index:
+                instructions[-1] = ('copy', first, count + 1)
+                return
+        instructions.append(('copy', index, 1))
+
+    with open(filename, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            digest = hashlib.sha256(data).hexdigest()
+            position = 0
+            literal_start = 0
+            whole = False
+            while table.blocks and position + block_size <= size:
+                window = data[position:position + block_size]
+                weak = zlib.adler32(window)
+                index = table.find(weak, window)
+                if index is None:
+                    a = weak & 0xffff
+                    b = weak >> 16
+                    end = min(size - block_size, literal_start + max_changed - changed)
+                    while position < end:
+                        outgoing = data[position]
+                        incoming = data[position + block_size]
+                        a = (a - outgoing + incoming) % ADLER_MOD
+                        b = (b - block_size * outgoing + a - 1) % ADLER_MOD
+                        position += 1
+                        weak = a | b << 16
+                        if weak in table:
+                            index = table.find(weak, data[position:position + block_size])
+                            if index is not None:
+                                break
+                    if index is None:
+                        whole = position < size - block_size
+                        break
+                literal(literal_start, position)
+                copy(index)
+                position += block_size
+                literal_start = position
+            # The client's last block may be shorter than the others and still
+            # match our tail.
+            tail_length = table.tail_length
+            index = None
+            if whole:
+                del instructions[:]
+                literal_start = 0
+            elif tail_length and size - literal_start >= tail_length:
+                tail = data[size - tail_length:size]
+                index = table.find(zlib.adler32(tail), tail)
+            if index is None:
+                literal(literal_start, size)
+            else:
+                literal(literal_start, size - tail_length)
+                copy(index)
+        finally:
+            if size:
+                data.close()
+    return instructions, digest
+
+
+class Literals:
+    # The literal stretches of a delta as a chunk source for the encryption
+    # pipeline; chunk i is the i-th literal instruction.
+
+    def __init__(self, filename, instructions):
+        self.filename = filename
+        self.spans = [(offset, length) for kind, offset, length in instructions if kind == 'literal']
+        self.chunk_count = len(self.spans)
+        self.size = sum(length for _, length in self.spans)
+        self.fd = os.open(filename, os.O_RDONLY)
+
+    def plain_chunk(self, index):
+        offset, length = self.spans[index]
+        return os.pread(self.fd, length, offset)
+
+    def packed_chunk(self, index, plain):
+        return compress_chunk(plain)
+
+    def cached_encrypted_chunk(self, index, user):
+        return None
+
+    def encrypt_chunk(self, index, plain, user):
+        flags, payload = self.packed_chunk(index, plain)
+        return flags, encrypt_file(payload, user['key'])
+
+    def close(self):
+        os.close(self.fd)
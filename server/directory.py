@@ -0,0 +1,164 @@
+import threading
+
+
+class Directory:
+    # An in-memory copy of users, groups and memberships sitting in front of
+    # Database. It is loaded once at startup. Each change is written through:
+    # it is committed to the database first and then applied here, so lookups
+    # and fan-out never need SQL. The server is assumed to be the only writer
+    # of these tables. A user added from outside, e.g. by db.py, is picked up
+    # with load_user when they first log in.
+
+    def __init__(self, database):
+        self.database = database
+        self.lock = threading.Lock()
+        self.users = {}        # email -> {'id', 'email', 'is_admin', 'key', 'session_generation'}
+        self.emails = {}       # user id -> email
+        self.groups = {}       # group name -> {'id', 'name', 'encrypted'}
+        self.group_names = {}  # group id -> group name
+        self.members = {}      # group id -> set of user ids
+        self.memberships = {}  # user id -> set of group ids
+
+    def load(self):
+        users, groups, memberships = self.database.load_directory()
+        with self.lock:
+            self.users.clear()
+            self.emails.clear()
+            self.groups.clear()
+            self.group_names.clear()
+            self.members.clear()
+            self.memberships.clear()
+            for row in users:
+                self._add_user(row)
+            for row in groups:
+                self._add_group(row)
+            for user_id, group_id in memberships:
+                self._join(user_id, group_id)
+
+    def _add_user(self, row):
+        user_id, email, is_admin, key, session_generation = row
+        self.users[email] = {'id': user_id, 'email': email, 'is_admin': bool(is_admin), 'key': key,
+                             'session_generation': session_generation or 0}
+        self.emails[user_id] = email
+        self.memberships.setdefault(user_id, set())
+
+    def _add_group(self, row):
+        group_id, group_name, encrypted = row
+        self.groups[group_name] = {'id': group_id, 'name': group_name, 'encrypted': encrypted != 0}
+        self.group_names[group_id] = group_name
+        self.members.setdefault(group_id, set())
+
+    def _join(self, user_id, group_id):
+        self.members.setdefault(group_id, set()).add(user_id)
+        self.memberships.setdefault(user_id, set()).add(group_id)
+
+    """ ---QUERY--- """
+
+    def get_user(self, email):
+        with self.lock:
+            return self.users.get(email)
+
+    def load_user(self, email):
+        row = self.database.get_user_record(email)
+        if row is None:
+            return None
+        with self.lock:
+            self._add_user(row)
+            return self.users[email]
+
+    def get_users_list(self):
+        with self.lock:
+            return list(self.users)
+
+    def get_groups_list(self):
+        with self.lock:
+            return list(self.groups)
+
+    def get_user_groups(self, email):
+        with self.lock:
+            user = self.users.get(email)
+            if user is None:
+                return []
+            return [self.group_names[group_id] for group_id in sorted(self.memberships[user['id']])]
+
+    def groups_require_encryption(self, groups):
+        # Files go out in plain text only when every target group is a trusted one.
+        with self.lock:
+            return not all(
+                group_name in self.groups and not self.groups[group_name]['encrypted']
+                for group_name in groups
+            )
+
+    def recipients(self, groups):
+        # (user id, email) for everyone in any of the groups.
+        with self.lock:
+            user_ids = set().union(*(
+                self.members[self.groups[group_name]['id']]
+                for group_name in groups if group_name in self.groups
+            ))
+            return [(user_id, self.emails[user_id]) for user_id in user_ids]
+
+    """ ---WRITE-THROUGH--- """
+
+    def insert_user(self, email, password):
+        if not self.database.insert_user(email, password):
+            return False
+        return self.load_user(email) is not None
+
+    def insert_group(self, group_name, description=""):
+        if not self.database.insert_group(group_name, description):
+            return False
+        row = self.database.get_group_record(group_name)
+        if row is not None:
+            with self.lock:
+                self._add_group(row)
+        return True
+
+    def delete_group(self, group_name):
+        if not self.database.delete_group(group_name):
+            return False
+        with self.lock:
+            group = self.groups.pop(group_name, None)
+            if group is not None:
+                del self.group_names[group['id']]
+                for user_id in self.members.pop(group['id'], ()):
+                    self.memberships[user_id].discard(group['id'])
+        return True
+
+    def add_user_to_group(self, email, group_name):
+        if not self.database.add_user_to_group(email, group_name):
+            return False
+        user = self.get_user(email) or self.load_user(email)
+        with self.lock:
+            group = self.groups.get(group_name)
+            if user is not None and group is not None:
+                self._join(user['id'], group['id'])
+        return True
+
+    def remove_user_from_group(self, email, group_name):
+        if not self.database.remove_user_from_group(email, group_name):
+            return False
+        with self.lock:
+            user = self.users.get(email)
+            group = self.groups.get(group_name)
+            if user is not None and group is not None:
+                self.members[group['id']].discard(user['id'])
+                self.memberships[user['id']].discard(group['id'])
+        return True
+
+    def revoke_sessions(self, email):
+        if not self.database.revoke_sessions(email):
+            return False
+        with self.lock:
+            user = self.users.get(email)
+            if user is not None:
+                user['session_generation'] += 1
+        return True
+
+    def set_group_encryption(self, group_name, encrypted):
+        if not self.database.set_group_encryption(group_name, encrypted):
+            return False
+        with self.lock:
+            if group_name in self.groups:
+                self.groups[group_name]['encrypted'] = encrypted
+        return True
@@ -0,0 +1,480 @@
+import bisect
+import glob
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+from utils import encrypt_file
+from compression import compress_chunk
+from integrity import DIGEST_SIZE, merkle_root
+from constants import FORMAT, CHUNK_SIZE, PLAIN_CACHE_SIZE, ENCRYPTED_CACHE_SIZE
+from constants import ENCRYPTED_DISK_CACHE_DIR, ENCRYPTED_DISK_CACHE_SIZE, DIGEST_CACHE_DIR, DIGEST_CACHE_SIZE
+
+
+class ChunkCache:
+    # Thread-safe LRU bounded by the total size of the values. Values are bytes
+    # unless the caller gives their size.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+plain_cache = ChunkCache(PLAIN_CACHE_SIZE)
+encrypted_cache = ChunkCache(ENCRYPTED_CACHE_SIZE)
+
+# Size charged to a cached compression decision with no payload of its own.
+DECISION_SIZE = 64
+
+
+def packed_chunk(key, plain):
+    # The (frame flags, payload) a chunk is sent as. Whether and how well it
+    # compresses doesn't depend on the recipient, so the result is computed
+    # once and shared through plain_cache. For a chunk sent uncompressed only
+    # the decision is kept, never the chunk itself, which may be a view of a
+    # memory map that must be closable.
+    packed = plain_cache.get(key)
+    if packed is None:
+        flags, payload = compress_chunk(plain)
+        if flags:
+            plain_cache.put(key, (flags, payload), len(payload))
+        else:
+            plain_cache.put(key, (0, None), DECISION_SIZE)
+        return flags, payload
+    flags, payload = packed
+    return (flags, payload) if flags else (0, plain)
+
+
+def encrypt_packed(packed, user):
+    flags, payload = packed
+    return flags, encrypt_file(payload, user['key'])
+
+sources = {}
+sources_lock = threading.Lock()
+
+
+class FileSource:
+    # The bytes of one file being distributed, shared by every recipient and
+    # by every name the file is sent under; transfers carry the name they were
+    # asked for themselves, since two names can share a source. The file is
+    # memory-mapped, so chunks are handed to the encryptors as views of
+    # the page cache without a userspace copy, and every recipient reads the
+    # same pages. If the file cannot be mapped, chunks are read once and shared
+    # through plain_cache instead.
+
+    def __init__(self, path, identity):
+        self.path = path
+        self.identity = identity
+        self.size = identity[2]
+        self.chunk_count = (self.size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.refs = 0
+        self.file = None
+        self.map = None
+        self.lock = threading.Lock()
+        self.disk_reads = 0
+
+    def _open(self):
+        if self.file is not None:
+            return
+        self.file = open(self.path, 'rb')
+        if self.size:
+            try:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                self.map = None
+
+    def plain_chunk(self, index):
+        if self.map is None:
+            with self.lock:
+                self._open()
+        if self.map is not None:
+            start = index * CHUNK_SIZE
+            return memoryview(self.map)[start:start + CHUNK_SIZE]
+        key = (self.identity, index)
+        chunk = plain_cache.get(key)
+        if chunk is not None:
+            return chunk
+        with self.lock:
+            # Another recipient may have read it while we waited for the lock.
+            chunk = plain_cache.get(key)
+            if chunk is not None:
+                return chunk
+            self.file.seek(index * CHUNK_SIZE)
+            chunk = self.file.read(CHUNK_SIZE)
+            self.disk_reads += 1
+        plain_cache.put(key, chunk)
+        return chunk
+
+    def packed_chunk(self, index, plain):
+        return packed_chunk(('packed', self.identity, index), plain)
+
+    def cached_encrypted_chunk(self, index, user):
+        # (frame flags, encrypted payload), or None.
+        return encrypted_cache.get((user['email'], self.identity, index))
+
+    def encrypt_chunk(self, index, plain, user):
+        chunk = encrypt_packed(self.packed_chunk(index, plain), user)
+        encrypted_cache.put((user['email'], self.identity, index), chunk, len(chunk[1]))
+        return chunk
+
+    def encrypted_chunk(self, index, user):
+        chunk = self.cached_encrypted_chunk(index, user)
+        if chunk is not None:
+            return chunk
+        return self.encrypt_chunk(index, self.plain_chunk(index), user)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                try:
+                    self.map.close()
+                except BufferError:
+                    # An encryptor still holds a view; the map is freed with it.
+                    pass
+                self.map = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Per chunk of a cached file: payload length, frame flags.
+LAYOUT_ENTRY = struct.Struct('!IB')
+
+
+# A bundle stream starts with the length of its JSON index.
+BUNDLE_HEADER = struct.Struct('!Q')
+
+
+def is_bundle(name):
+    # A file that exists under this exact name is sent as itself, even if its
+    # name looks like a glob, e.g. report[1].pdf.
+    if os.path.isfile(name):
+        return False
+    return os.path.isdir(name) or glob.has_magic(name)
+
+
+def bundle_files(name):
+    # The files a directory or glob stands for, as (relative path, path) in a
+    # stable order, and the name of the directory they are relative to.
+    if os.path.isdir(name):
+        base = os.path.normpath(name)
+        paths = []
+        for directory, subdirectories, filenames in os.walk(base):
+            subdirectories.sort()
+            paths.extend(os.path.join(directory, filename) for filename in sorted(filenames))
+    else:
+        parts = os.path.normpath(name).split(os.sep)
+        literal = list(itertools.takewhile(lambda part: not glob.has_magic(part), parts[:-1]))
+        base = os.sep.join(literal) or (os.sep if os.path.isabs(name) else os.curdir)
+        paths = sorted(glob.glob(name, recursive=True))
+    files = [(os.path.relpath(path, base), path) for path in paths if os.path.isfile(path)]
+    return os.path.basename(os.path.abspath(base)), files
+
+
+class BundleSource(FileSource):
+    # A directory or glob sent as one stream: the header, a JSON index of
+    # relative paths and sizes, then the contents of every file in index
+    # order. Chunks are CHUNK_SIZE slices of that stream, so resume, caching,
+    # compression and encryption work on a bundle as on a single file, with
+    # one FILE_START, one FILE_END and one acknowledgement for the whole set.
+
+    def __init__(self, name, identity, root, files):
+        super().__init__(name, identity)
+        index = {'root': root, 'files': [[relative_path, size] for relative_path, _, size in files]}
+        index = json.dumps(index).encode(FORMAT)
+        self.header = BUNDLE_HEADER.pack(len(index)) + index
+        self.paths = [path for _, path, _ in files]
+        self.starts = []
+        offset = len(self.header)
+        for _, _, size in files:
+            self.starts.append(offset)
+            offset += size
+        self.size = offset
+        self.file_count = len(files)
+        self.chunk_count = (self.size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    def plain_chunk(self, index):
+        key = (self.identity, index)
+        chunk = plain_cache.get(key)
+        if chunk is not None:
+            return chunk
+        start = index * CHUNK_SIZE
+        end = min(self.size, start + CHUNK_SIZE)
+        chunk = bytearray()
+        if start < len(self.header):
+            chunk += self.header[start:end]
+        position = bisect.bisect_right(self.starts, start + len(chunk)) - 1
+        while start + len(chunk) < end and position < len(self.paths):
+            file_start = self.starts[position]
+            file_end = self.starts[position + 1] if position + 1 < len(self.starts) else self.size
+            offset = start + len(chunk) - file_start
+            length = min(end, file_end) - (start + len(chunk))
+            if length > 0:
+                with open(self.paths[position], 'rb') as file:
+                    file.seek(offset)
+                    data = file.read(length)
+                if len(data) != length:
+                    raise OSError(f"{self.paths[position]} changed while it was being sent")
+                chunk += data
+                self.disk_reads += 1
+            position += 1
+        chunk = bytes(chunk)
+        plain_cache.put(key, chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+class EncryptedDiskCache:
+    # Whole files already encrypted for one recipient, kept on disk so a
+    # redelivery can be served with sendfile instead of being encrypted again.
+    # Compressed chunks make the payloads vary in length, so each file has an
+    # index of its chunk lengths and flags next to it. Bounded by total size;
+    # the least recently used files are removed first.
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def path(self, user, source):
+        name = hashlib.sha256(repr((user['email'], source.identity)).encode()).hexdigest()
+        return os.path.join(self.directory, name + '.enc')
+
+    def lookup(self, user, source):
+        # Returns the cached file's path and its layout, a list of
+        # (offset, length, flags) per chunk, or None.
+        if self.max_bytes <= 0:
+            return None
+        path = self.path(user, source)
+        try:
+            with open(index_path(path), 'rb') as file:
+                index = file.read()
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        if len(index) != source.chunk_count * LAYOUT_ENTRY.size:
+            return None
+        layout = []
+        offset = 0
+        for length, flags in LAYOUT_ENTRY.iter_unpack(index):
+            layout.append((offset, length, flags))
+            offset += length
+        if offset != size:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path, layout
+
+    def begin(self, user, source):
+        if self.max_bytes <= 0 or source.size > self.max_bytes:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        return EncryptedCacheWriter(self, self.path(user, source))
+
+    def evict(self):
+        with self.lock:
+            try:
+                entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                           if name.endswith('.enc')]
+                entries = [(os.stat(path), path) for path in entries]
+            except OSError:
+                return
+            total = sum(stat.st_size for stat, _ in entries)
+            for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= stat.st_size
+                    os.remove(index_path(path))
+                except OSError:
+                    pass
+
+
+def index_path(path):
+    return path[:-len('.enc')] + '.idx'
+
+
+class EncryptedCacheWriter:
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+        self.index = bytearray()
+
+    def write(self, chunk, flags=0):
+        self.file.write(chunk)
+        self.index += LAYOUT_ENTRY.pack(len(chunk), flags)
+
+    def commit(self):
+        self.file.close()
+        fd, temp_index = tempfile.mkstemp(dir=self.cache.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(self.index)
+        os.replace(temp_index, index_path(self.path))
+        os.replace(self.temp_path, self.path)
+        self.cache.evict()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+encrypted_disk_cache = EncryptedDiskCache(ENCRYPTED_DISK_CACHE_DIR, ENCRYPTED_DISK_CACHE_SIZE)
+
+
+class ChunkDigests:
+    # The integrity manifest of a source: the hash of each of its chunks and
+    # their Merkle root. Recipients check every chunk against it as it arrives.
+
+    def __init__(self, digests):
+        self.digests = digests
+        self.root = merkle_root(digests)
+
+    def batches(self, batch_size):
+        per_batch = batch_size // DIGEST_SIZE * DIGEST_SIZE
+        for seq, start in enumerate(range(0, len(self.digests), per_batch)):
+            yield seq, self.digests[start:start + per_batch]
+
+
+class DigestCache:
+    # Hashing a source means reading all of it, so its ChunkDigests are kept by
+    # identity, the (path, mtime, size) of the file or of every bundle member:
+    # in memory, and in a file of their own on disk that outlives the server.
+    # At 32 bytes per chunk these files stay small and are never evicted.
+    # get() may read the whole source; callers run it off the io executor and
+    # make sure only one call per source is running.
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.memory = ChunkCache(max_bytes)
+
+    def path(self, source):
+        name = hashlib.sha256(repr(source.identity).encode()).hexdigest()
+        return os.path.join(self.directory, name + '.sha256')
+
+    def cached(self, source):
+        return self.memory.get(source.identity)
+
+    def get(self, source):
+        digests = self.memory.get(source.identity)
+        if digests is None:
+            digests = ChunkDigests(self._load(source) or self._compute(source))
+            self.memory.put(source.identity, digests, len(digests.digests))
+        return digests
+
+    def _load(self, source):
+        try:
+            with open(self.path(source), 'rb') as file:
+                digests = file.read()
+        except OSError:
+            return None
+        if len(digests) != source.chunk_count * DIGEST_SIZE:
+            return None
+        return digests
+
+    def _compute(self, source):
+        digests = b''.join(hashlib.sha256(source.plain_chunk(index)).digest() for index in range(source.chunk_count))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(digests)
+            os.replace(temp_path, self.path(source))
+        except OSError:
+            pass
+        return digests
+
+
+digest_cache = DigestCache(DIGEST_CACHE_DIR, DIGEST_CACHE_SIZE)
+
+
+def file_identity(filename):
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_mtime_ns, stat.st_size
+
+
+def acquire_source(filename):
+    # A FileSource, or a BundleSource when filename is a directory or a glob.
+    files = None
+    if is_bundle(filename):
+        root, files = bundle_files(filename)
+        files = [(relative_path, path, file_identity(path)) for relative_path, path in files]
+        digest = hashlib.sha256(repr([identity for _, _, identity in files]).encode(FORMAT)).hexdigest()
+        identity = (os.path.abspath(filename), digest, sum(identity[2] for _, _, identity in files))
+    else:
+        identity = file_identity(filename)
+    with sources_lock:
+        source = sources.get(identity)
+        if source is None:
+            if files is None:
+                source = FileSource(filename, identity)
+            else:
+                source = BundleSource(filename, identity, root,
+                                      [(relative_path, path, identity[2]) for relative_path, path, identity in files])
+            sources[identity] = source
+        source.refs += 1
+        return source
+
+
+def retain_source(source):
+    with sources_lock:
+        source.refs += 1
+        return source
+
+
+def release_source(source):
+    with sources_lock:
+        source.refs -= 1
+        if source.refs > 0:
+            return
+        if sources.get(source.identity) is source:
+            del sources[source.identity]
+    source.close()
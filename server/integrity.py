@@ -0,0 +1,38 @@
+import hashlib
+
+# Integrity manifests, shared by client and server: the SHA-256 of every
+# CHUNK_SIZE chunk of a file's plaintext stream, and a Merkle root over them
+# that vouches for the whole list. Leaves and inner nodes are hashed with
+# different prefixes, so a node can't be passed off as a chunk hash.
+DIGEST_SIZE = 32
+LEAF = b'\x00'
+NODE = b'\x01'
+
+
+def merkle_root(digests):
+    # digests is the concatenated chunk hashes; returns the root as hex.
+    level = [hashlib.sha256(LEAF + digests[start:start + DIGEST_SIZE]).digest()
+             for start in range(0, len(digests), DIGEST_SIZE)]
+    if not level:
+        return hashlib.sha256(LEAF).hexdigest()
+    while len(level) > 1:
+        # An odd node out is carried up to the next level unchanged.
+        paired = [hashlib.sha256(NODE + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0].hex()
+
+
+def bitmap_frames(indexes, count, frame_size):
+    # (byte offset, payload) pieces of a bitmap of `count` bits with `indexes`
+    # set, as sent in NEED frames; the caller ends it with an empty last frame.
+    bitmap = bytearray((count + 7) // 8)
+    for index in indexes:
+        bitmap[index // 8] |= 1 << (index % 8)
+    for start in range(0, len(bitmap), frame_size):
+        yield start, bytes(bitmap[start:start + frame_size])
+
+
+def bitmap_indexes(bitmap, count):
+    return [index for index in range(count) if index // 8 < len(bitmap) and bitmap[index // 8] >> (index % 8) & 1]
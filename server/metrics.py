@@ -0,0 +1,201 @@
+import asyncio
+import bisect
+import functools
+import math
+import threading
+import time
+
+from constants import FORMAT
+
+# Counters, gauges and histograms in the Prometheus text exposition format,
+# served over HTTP by serve_metrics and to admins by the `stats` command.
+# Metrics are updated from the event loop and from executor threads, so
+# every metric guards its values with a lock. A metric built with a function
+# is read from that function at scrape time instead, for state the server
+# already keeps, like the size of `online`.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, prefix=''):
+        lines = []
+        for metric in self.metrics:
+            if metric.name.startswith(prefix):
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), function=None, registry=registry):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        return LabelledMetric(self, tuple(str(value) for value in values))
+
+    def samples(self):
+        # (label values, value) pairs; a function returns either one value or
+        # a dict keyed by label values.
+        if self.function is None:
+            with self.lock:
+                return list(self.values.items())
+        value = self.function()
+        if isinstance(value, dict):
+            return [(key if isinstance(key, tuple) else (key,), value) for key, value in value.items()]
+        return [((), value)]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.samples()):
+            lines.append(f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}")
+        return lines
+
+
+class LabelledMetric:
+    __slots__ = ('metric', 'key')
+
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def __getattr__(self, name):
+        return functools.partial(getattr(self.metric, name), key=self.key)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, key=()):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, key=()):
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, key=()):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, key=()):
+        self.inc(-amount, key=key)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=registry):
+        super().__init__(name, help, labels, registry=registry)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, key=()):
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, function, *args, key=()):
+        # Calls function and records how long it took.
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.observe(time.perf_counter() - started, key=key)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            samples = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        for key, (counts, total, count) in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, key, [('le', format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def timed_method(function, histogram, key):
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started, key=key)
+    return timed
+
+
+def instrument_methods(cls, histogram, exclude=()):
+    # Times every public method of cls into histogram, labelled by method name.
+    for name, function in list(vars(cls).items()):
+        if not name.startswith('_') and name not in exclude and callable(function):
+            setattr(cls, name, timed_method(function, histogram, (name,)))
+    return cls
+
+
+async def handle_scrape(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+        parts = request_line.decode(FORMAT, 'replace').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+            status, body = '200 OK', registry.render().encode(FORMAT)
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode(FORMAT) + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host, port):
+    return await asyncio.start_server(handle_scrape, host, port)
@@ -0,0 +1,55 @@
+import asyncio
+from collections import deque
+
+from constants import PIPELINE_DEPTH
+from metrics import Histogram
+from tracing import tracer
+
+ENCRYPT_SECONDS = Histogram('fdt_chunk_encrypt_seconds', "Time to compress (when worthwhile) and encrypt one chunk")
+
+
+async def read_and_encrypt(source, index, user, io_executor, crypto_executor):
+    # Returns (frame flags, payload); chunks that compress well are compressed
+    # before they are encrypted.
+    chunk = source.cached_encrypted_chunk(index, user)
+    if chunk is not None:
+        return chunk
+    loop = asyncio.get_running_loop()
+    plain = await loop.run_in_executor(io_executor, tracer.wrap('read', source.plain_chunk), index)
+    return await loop.run_in_executor(crypto_executor, tracer.wrap('encrypt', ENCRYPT_SECONDS.time),
+                                      source.encrypt_chunk, index, plain, user)
+
+
+async def encrypted_chunks(source, user, io_executor, crypto_executor, start=0, indexes=None, depth=PIPELINE_DEPTH):
+    # Reader -> compressor/encryptor pool -> socket writer. Up to `depth` chunks
+    # are being read or encrypted ahead of the one the caller is writing, and
+    # they are yielded strictly in order. zlib and AES in pycryptodome release
+    # the GIL, so the encryptor threads run on separate cores. Chunks from `start` onwards are
+    # produced unless an explicit iterable of `indexes` is given.
+    if indexes is None:
+        indexes = range(start, source.chunk_count)
+    indexes = iter(indexes)
+    in_flight = deque()
+    exhausted = False
+    try:
+        while not exhausted or in_flight:
+            while not exhausted and len(in_flight) < depth:
+                index = next(indexes, None)
+                if index is None:
+                    exhausted = True
+                    break
+                in_flight.append(asyncio.ensure_future(
+                    read_and_encrypt(source, index, user, io_executor, crypto_executor)))
+            if in_flight:
+                yield await in_flight.popleft()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def plain_chunks(source, io_executor, crypto_executor, indexes):
+    # (frame flags, payload) for recipients that get the file unencrypted.
+    loop = asyncio.get_running_loop()
+    for index in indexes:
+        plain = await loop.run_in_executor(io_executor, tracer.wrap('read', source.plain_chunk), index)
+        yield await loop.run_in_executor(crypto_executor, tracer.wrap('compress', source.packed_chunk), index, plain)
@@ -0,0 +1,76 @@
+import json
+import struct
+
+from constants import FORMAT, CHUNK_SIZE
+
+# The server's side of the frame protocol: the header, frame types, flags and
+# codec. The blocking reader and writers the client uses live only in
+# client/protocol.py; everything above ProtocolError is the same in both.
+#
+# Every message on the socket is a frame:
+#   version (1B) | type (1B) | flags (1B) | reserved (1B) | file_id (4B) | seq (4B) | length (4B) | payload
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBBxIII')
+HEADER_SIZE = HEADER.size
+
+CONTROL = 1
+FILE_START = 2
+FILE_DATA = 3
+FILE_END = 4
+SWARM_MAP = 5
+MANIFEST = 6  # chunk records of a deduplicated file, server to client
+NEED = 7  # bitmap of the manifest chunks a client is missing or that failed verification, client to server
+SIGNATURE = 8  # block signatures of a client's copy of a file, client to server
+COPY = 9  # runs of the client's own blocks to copy into a delta, server to client
+DIGESTS = 10  # hashes of the chunks of a file about to be streamed, server to client
+
+FRAME_TYPES = (CONTROL, FILE_START, FILE_DATA, FILE_END, SWARM_MAP, MANIFEST, NEED, SIGNATURE, COPY, DIGESTS)
+
+# FILE_DATA flags
+COMPRESSED = 1  # zlib-compressed before encryption; decompress after decrypting
+
+# NEED and SIGNATURE flags
+LAST_REPLY = 1
+WRITE_FAILED = 2  # on the last NEED of a transfer the client couldn't write; nothing is resent
+
+MAX_PAYLOAD = CHUNK_SIZE + 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_frame(frame_type, payload=b'', file_id=0, seq=0, flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, flags, file_id, seq, len(payload)) + payload
+
+
+def encode_meta(meta):
+    return json.dumps(meta).encode(FORMAT)
+
+
+def decode_meta(payload):
+    return json.loads(bytes(payload).decode(FORMAT))
+
+
+def parse_header(header):
+    version, frame_type, flags, file_id, seq, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if frame_type not in FRAME_TYPES:
+        raise ProtocolError(f"unknown frame type {frame_type}")
+    return frame_type, flags, file_id, seq, length
+
+
+class Frame:
+    __slots__ = ('type', 'flags', 'file_id', 'seq', 'payload')
+
+    def __init__(self, frame_type, flags, file_id, seq, payload):
+        self.type = frame_type
+        self.flags = flags
+        self.file_id = file_id
+        self.seq = seq
+        self.payload = payload
+
+    def text(self):
+        return bytes(self.payload).decode(FORMAT)
+
@@ -0,0 +1,239 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+from constants import TRANSFER_PRIORITIES, SMALL_FILE_SIZE, MAX_CONCURRENT_TRANSFERS, PRIORITY_RESERVE
+from constants import MIN_SEND_CONCURRENCY, MAX_SEND_CONCURRENCY, SCHEDULER_INTERVAL
+from metrics import Counter
+from tracing import tracer
+
+RECIPIENT_BYTES = Counter('fdt_recipient_bytes_sent_total', "File bytes granted to each recipient",
+                          labels=('recipient',))
+
+# Priority classes from highest to lowest weight.
+PRIORITY_ORDER = sorted(TRANSFER_PRIORITIES, key=TRANSFER_PRIORITIES.get, reverse=True)
+TOP_PRIORITY = PRIORITY_ORDER[0]
+
+
+class Distribution:
+    # One init (or one user's redeliveries), sharing a priority class. Its
+    # weight is split evenly between the recipients it is currently sending to.
+
+    def __init__(self, name, priority):
+        self.name = name
+        self.priority = priority
+        self.flows = 0
+        self.queued = 0
+        self.bytes_sent = 0
+
+
+class Flow:
+    # A single file on its way to a single recipient.
+
+    def __init__(self, distribution, recipient, groups, priority):
+        self.distribution = distribution
+        self.recipient = recipient
+        self.groups = groups
+        self.priority = priority
+        self.finish = 0.0
+        self.bytes_sent = 0
+
+    @property
+    def weight(self):
+        return TRANSFER_PRIORITIES[self.priority] / max(1, self.distribution.flows)
+
+
+class TransferScheduler:
+    # Decides which transfers run and which of them may send their next chunk.
+    #
+    # Admission: transfers are admitted by priority class and then arrival.
+    # The lowest class may hold max_active slots; each class above it may
+    # hold `reserve` more than the class below. Higher classes, including
+    # every small file, still get in while bulk transfers hold all of theirs.
+    #
+    # Chunks: every chunk asks for a grant. Grants follow weighted fair
+    # queueing with start-time tags. Each waiting chunk gets the tag
+    # max(virtual time, flow's last finish) + size / flow weight, and the
+    # smallest tag goes next. So distributions share bandwidth by class
+    # weight, and the recipients of one distribution share its portion.
+    #
+    # Concurrency: the number of chunks in flight at once is tuned by hill
+    # climbing on measured throughput every `interval` seconds, while there
+    # is a backlog to measure against.
+    #
+    # With a shaper, each chunk first waits until the rate limits for its
+    # recipient and their groups allow it, so a throttled transfer never
+    # holds a slot another transfer could use.
+
+    def __init__(self, shaper=None, max_active=MAX_CONCURRENT_TRANSFERS, reserve=PRIORITY_RESERVE,
+                 min_limit=MIN_SEND_CONCURRENCY, max_limit=MAX_SEND_CONCURRENCY, interval=SCHEDULER_INTERVAL):
+        self.shaper = shaper
+        self.max_active = max_active
+        self.reserve = reserve
+        self.active = 0
+        self.admission = []
+        self.distributions = {}
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min_limit
+        self.in_flight = 0
+        self.ready = []
+        self.virtual_time = 0.0
+        self.counter = itertools.count()
+        self.interval = interval
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_rate = 0.0
+        self.rate = 0.0
+        self.direction = 1
+        self.bytes_sent = 0
+
+    """ ---DISTRIBUTIONS--- """
+
+    def distribution(self, name, priority='normal'):
+        return Distribution(name, priority)
+
+    def _drop_if_idle(self, distribution):
+        if distribution.flows == 0 and distribution.queued == 0:
+            self.distributions.pop(id(distribution), None)
+
+    """ ---ADMISSION--- """
+
+    def _capacity(self, priority):
+        return self.max_active + self.reserve * PRIORITY_ORDER[::-1].index(priority)
+
+    @asynccontextmanager
+    async def transfer(self, distribution, recipient, size, groups=()):
+        priority = distribution.priority
+        # Small files jump to the top class on their own, so they never wait
+        # behind the share of a bulk distribution.
+        if size <= SMALL_FILE_SIZE:
+            priority = TOP_PRIORITY
+        self.distributions[id(distribution)] = distribution
+        distribution.queued += 1
+        try:
+            await self._admit(priority)
+        except BaseException:
+            distribution.queued -= 1
+            self._drop_if_idle(distribution)
+            raise
+        distribution.queued -= 1
+        flow = Flow(distribution, recipient, groups, priority)
+        distribution.flows += 1
+        try:
+            yield flow
+        finally:
+            distribution.flows -= 1
+            self.active -= 1
+            self._drop_if_idle(distribution)
+            self._admit_waiting()
+
+    async def _admit(self, priority):
+        if not self.admission and self.active < self._capacity(priority):
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.admission, (PRIORITY_ORDER.index(priority), next(self.counter), priority, future))
+        self._admit_waiting()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.active -= 1
+                self._admit_waiting()
+            raise
+
+    def _admit_waiting(self):
+        while self.admission:
+            _, _, priority, future = self.admission[0]
+            if future.done():
+                heapq.heappop(self.admission)
+                continue
+            if self.active >= self._capacity(priority):
+                return
+            heapq.heappop(self.admission)
+            self.active += 1
+            future.set_result(None)
+
+    """ ---CHUNK GRANTS--- """
+
+    @asynccontextmanager
+    async def grant(self, flow, size):
+        if self.shaper is not None:
+            with tracer.span('throttle'):
+                await self.shaper.throttle(flow.recipient, flow.groups, size)
+        with tracer.span('grant'):
+            await self._acquire(flow, size)
+        try:
+            yield
+        finally:
+            self._release(flow, size)
+
+    async def _acquire(self, flow, size):
+        start = max(self.virtual_time, flow.finish)
+        flow.finish = start + size / flow.weight
+        if not self.ready and self.in_flight < self.limit:
+            self.in_flight += 1
+            self.virtual_time = start
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.ready, (flow.finish, next(self.counter), start, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.in_flight -= 1
+                self._dispatch()
+            raise
+
+    def _release(self, flow, size):
+        self.in_flight -= 1
+        flow.bytes_sent += size
+        flow.distribution.bytes_sent += size
+        self.bytes_sent += size
+        RECIPIENT_BYTES.labels(flow.recipient).inc(size)
+        self.window_bytes += size
+        self._adjust()
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.ready and self.in_flight < self.limit:
+            _, _, start, future = heapq.heappop(self.ready)
+            if future.done():
+                continue
+            self.in_flight += 1
+            self.virtual_time = max(self.virtual_time, start)
+            future.set_result(None)
+
+    def _adjust(self):
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < self.interval:
+            return
+        self.rate = self.window_bytes / elapsed
+        if self.ready:
+            # Keep moving while throughput improves; turn around when it drops.
+            if self.rate < self.last_rate * 0.95:
+                self.direction = -self.direction
+            step = max(1, self.limit // 4)
+            self.limit = min(self.max_limit, max(self.min_limit, self.limit + self.direction * step))
+        self.last_rate = self.rate
+        self.window_start = now
+        self.window_bytes = 0
+
+    """ ---INTROSPECTION--- """
+
+    def summary(self):
+        lines = [
+            f"\ntransfers: active={self.active} queued={len(self.admission)} "
+            f"(limit {self.max_active}, +{self.reserve} per class above {PRIORITY_ORDER[-1]})",
+            f"chunks: in-flight={self.in_flight} waiting={len(self.ready)} concurrency={self.limit} "
+            f"throughput={self.rate / (1024 * 1024):.1f}MiB/s sent={self.bytes_sent}",
+        ]
+        for distribution in self.distributions.values():
+            lines.append(f"{distribution.name} [{distribution.priority}]: sending={distribution.flows} "
+                         f"queued={distribution.queued} sent={distribution.bytes_sent}")
+        return '\n'.join(lines) + '\n'
@@ -1,168 +1,818 @@
-import socket
-import threading
+import asyncio
+import hashlib
 import logging
 import os
 import concurrent.futures
-from time import sleep
+import itertools
 
 from db import Database
-from utils import encrypt_file, parse_request, numerize_list
-from constants import PORT, SERVER, ADDR, FORMAT, MAX_CONCURRENT_TRANSFERS, CHUNK_SIZE
-
-import zipfile
-
+from directory import Directory
+from utils import chunk_digest, parse_request, numerize_list, raise_fd_limit
+from constants import PORT, SERVER, CHUNK_SIZE
+from constants import DB_WORKERS, CRYPTO_WORKERS, IO_WORKERS, DELTA_WORKERS, STREAM_LIMIT, LISTEN_BACKLOG, REPLY_TIMEOUT
+from constants import DIGEST_WORKERS, MAX_REPAIR_ROUNDS, DELTA_CACHE_SIZE
+from constants import METRICS_HOST, METRICS_PORT
+from protocol import CONTROL, FILE_START, FILE_DATA, FILE_END, SWARM_MAP, MANIFEST, NEED, SIGNATURE, COPY, DIGESTS
+from protocol import LAST_REPLY, WRITE_FAILED
+from protocol import MAX_PAYLOAD, encode_meta
+from connection import Connection
+from auth import LoginAdmission, LoginRejected, warm_up
+from session import SessionManager
+from distribution import acquire_source, retain_source, release_source, encrypted_disk_cache, is_bundle, BundleSource
+from distribution import digest_cache, ChunkCache
+from integrity import bitmap_indexes
+from pipeline import encrypted_chunks, plain_chunks, read_and_encrypt
+from chunkstore import chunk_store
+from delta import Literals, block_size_for, compute_delta, pack_copies, COPY_RUN
+from swarm import Swarm
+from scheduler import TransferScheduler
+from shaping import BandwidthShaper, format_limit
+from metrics import Counter, Gauge, registry, serve_metrics
+from tracing import tracer, profiler, write_trace, write_profile
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 database = Database()
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(ADDR)
+database.initiate_tables()
+directory = Directory(database)
+directory.load()
 
 online = {}
 
-executor = concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENT_TRANSFERS)
-
-
-def apply_pending_files(conn, user):
+# sqlite, disk reads and AES all block, so they run on bounded pools off the event loop;
+# bcrypt gets its own process pool behind login admission control, and so does
+# the pure-Python rolling checksum search of delta transfers.
+login_admission = LoginAdmission()
+sessions = SessionManager()
+db_executor = concurrent.futures.ThreadPoolExecutor(DB_WORKERS, thread_name_prefix='db')
+crypto_executor = concurrent.futures.ThreadPoolExecutor(CRYPTO_WORKERS, thread_name_prefix='crypto')
+io_executor = concurrent.futures.ThreadPoolExecutor(IO_WORKERS, thread_name_prefix='io')
+delta_executor = concurrent.futures.ProcessPoolExecutor(DELTA_WORKERS)
+digest_executor = concurrent.futures.ThreadPoolExecutor(DIGEST_WORKERS, thread_name_prefix='digest')
+
+shaper = BandwidthShaper()
+scheduler = TransferScheduler(shaper)
+transfer_tasks = set()
+
+file_ids = itertools.count(1)
+
+swarms = {}
+client_replies = {}
+digest_jobs = {}
+delta_cache = ChunkCache(DELTA_CACHE_SIZE)
+delta_jobs = {}
+
+# Read at scrape time from the state the server keeps anyway.
+Gauge('fdt_online_connections', "Connected non-admin clients", function=lambda: len(online))
+Gauge('fdt_transfers_active', "Transfers holding a scheduler slot", function=lambda: scheduler.active)
+Gauge('fdt_transfers_queued', "Transfers waiting for a scheduler slot", function=lambda: len(scheduler.admission))
+Gauge('fdt_chunks_in_flight', "Chunks granted and not yet handed to a connection",
+      function=lambda: scheduler.in_flight)
+Gauge('fdt_chunk_concurrency', "Chunks the scheduler currently allows in flight", function=lambda: scheduler.limit)
+Gauge('fdt_send_rate_bytes', "File bytes per second over the scheduler's last interval",
+      function=lambda: scheduler.rate)
+Counter('fdt_bytes_sent_total', "File bytes granted to all recipients", function=lambda: scheduler.bytes_sent)
+Counter('fdt_logins_total', "Password logins by outcome", labels=('outcome',),
+        function=lambda: {'accepted': login_admission.accepted, 'failed': login_admission.failed,
+                          'rejected': login_admission.rejected})
+Gauge('fdt_logins_waiting', "Password logins queued or being checked", labels=('state',),
+      function=lambda: {'queued': login_admission.queued, 'active': login_admission.active})
+
+CHUNKS_RESENT = Counter('fdt_chunks_resent_total', "Chunks sent again because the recipient's copy failed verification")
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, tracer.wrap('db', lambda: func(*args, **kwargs), func.__name__))
+
+
+async def verify_user(email, password):
+    hashed_password = await run_db(database.get_password_hash, email)
+    if not hashed_password:
+        return False
+    return await login_admission.verify(password, hashed_password)
+
+
+def start_transfer(coroutine):
+    task = asyncio.create_task(coroutine)
+    transfer_tasks.add(task)
+    task.add_done_callback(transfer_tasks.discard)
+    return task
+
+
+async def apply_pending_files(conn, user):
     try:
         logging.info(f"[CHECKING PENDING FILES FOR {user['email']}]")
-        pending_files = database.get_pending_filenames(user['email'])
-        for filename in pending_files:
-            sleep(0.5)
-            send_file_to_client(conn, filename, user)
+        pending_files = await run_db(database.get_pending_files, user['email'])
+        distribution = scheduler.distribution(f"redelivery to {user['email']}")
+        loop = asyncio.get_running_loop()
+        for pending in pending_files:
+            if pending['manifest']:
+                manifest = await loop.run_in_executor(io_executor, chunk_store.load, pending['manifest'])
+                if manifest is None:
+                    logging.error(f"[MANIFEST {pending['manifest']} FOR {pending['filename']} IS MISSING]")
+                    continue
+                await send_dedup_to_client(conn, manifest, user, distribution, encrypted=pending['encrypted'])
+                continue
+            if pending['delta']:
+                await send_delta_to_client(conn, pending['filename'], user, distribution, encrypted=pending['encrypted'])
+                continue
+            source = await loop.run_in_executor(io_executor, acquire_source, pending['filename'])
+            # A redelivery is likely to be retried again, so keep its ciphertext on disk.
+            await send_file_to_client(conn, pending['filename'], source, user, distribution, pending['offset'],
+                                      pending['chunk_hash'], encrypted=pending['encrypted'], cache_encrypted=True)
     except:
         return
 
 
-def remove_connection(email):
+def remove_connection(email, conn=None):
     if email in online.keys():
+        if conn is not None and online[email]['conn'] is not conn:
+            return False
         del online[email]
+        finish_swarm_member(email)
+        shaper.forget(email)
         return True
 
 
+async def source_digests(source):
+    # The source's ChunkDigests. Recipients that start together await the
+    # same hashing job rather than each tying up a thread.
+    digests = digest_cache.cached(source)
+    if digests is not None:
+        return digests
+    job = digest_jobs.get(source.identity)
+    if job is None:
+        job = digest_jobs[source.identity] = asyncio.get_running_loop().run_in_executor(
+            digest_executor, digest_cache.get, source)
+        job.add_done_callback(lambda _: digest_jobs.pop(source.identity, None))
+    return await asyncio.shield(job)
+
+
+async def file_delta(filename, signatures, block_size):
+    # Recipients holding the same copy send the same signatures, so a delta is
+    # computed once per version of the file and signature list, and recipients
+    # asking for it meanwhile wait on that one computation.
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size, block_size, hashlib.sha256(signatures).digest())
+    delta = delta_cache.get(key)
+    if delta is not None:
+        return delta
+    job = delta_jobs.get(key)
+    if job is None:
+        job = delta_jobs[key] = asyncio.get_running_loop().run_in_executor(
+            delta_executor, compute_delta, filename, signatures, block_size)
+        job.add_done_callback(lambda _: delta_jobs.pop(key, None))
+    delta = await asyncio.shield(job)
+    instructions, _ = delta
+    # Each instruction tuple takes about 64 bytes.
+    delta_cache.put(key, delta, 64 * (len(instructions) + 1))
+    return delta
+
+
+async def resume_chunk(source, offset, chunk_hash):
+    # Resume after the last chunk the client checkpointed, provided that chunk
+    # still hashes the same; a changed source file restarts from zero.
+    start = offset // CHUNK_SIZE
+    if start <= 0 or start > source.chunk_count or not chunk_hash:
+        return 0
+    loop = asyncio.get_running_loop()
+    plain = await loop.run_in_executor(io_executor, source.plain_chunk, start - 1)
+    if chunk_digest(plain) != chunk_hash:
+        return 0
+    return start
+
+
+async def send_from_file(conn, file_id, path, source, start, flow, layout=None):
+    # Chunks are CHUNK_SIZE slices of the file unless a layout of
+    # (offset, length, flags) per chunk says otherwise.
+    file = open(path, 'rb')
+    try:
+        for seq in range(start, source.chunk_count):
+            if layout is None:
+                offset = seq * CHUNK_SIZE
+                length = min(CHUNK_SIZE, source.size - offset)
+                flags = 0
+            else:
+                offset, length, flags = layout[seq]
+            await conn.writable()
+            async with scheduler.grant(flow, length):
+                await conn.send_file_frame(FILE_DATA, file, offset, length, file_id=file_id, seq=seq, flags=flags)
+    finally:
+        conn.after_queued(file.close)
+
 
-def send_file_to_client(conn, filename, user):
+async def send_chunks(conn, file_id, chunks, indexes, flow):
+    # Sends the (frame flags, payload) pairs from chunks as the chunks at indexes.
     try:
-        logging.info(f"[SENDING {filename} TO {user['email']}]")
-        file_size = os.path.getsize(filename)
-        # sleep(0.5)
-        conn.send(f"file {filename} -size {str(file_size)}".encode(FORMAT))
-        with open(filename, 'rb') as file:
-            while True:
-                chunk = file.read(CHUNK_SIZE)
-                if not chunk:
-                    conn.sendall(b'<END>')
-                    break
-                encrypted_chunk = encrypt_file(chunk, user['key'])
-                conn.sendall(encrypted_chunk)
+        positions = iter(indexes)
+        async for flags, chunk in chunks:
+            await conn.writable()
+            async with scheduler.grant(flow, len(chunk)):
+                await conn.send_frame(FILE_DATA, chunk, file_id=file_id, seq=next(positions), flags=flags)
+    finally:
+        await chunks.aclose()
+
+
+async def send_plain(conn, file_id, source, indexes, flow):
+    await send_chunks(conn, file_id, plain_chunks(source, io_executor, crypto_executor, indexes), indexes, flow)
+
+
+async def send_encrypted(conn, file_id, source, user, start, cache, flow):
+    loop = asyncio.get_running_loop()
+    cache_writer = encrypted_disk_cache.begin(user, source) if cache and start == 0 else None
+    chunks = encrypted_chunks(source, user, io_executor, crypto_executor, start=start)
+    try:
+        seq = start
+        async for flags, encrypted_chunk in chunks:
+            await conn.writable()
+            async with scheduler.grant(flow, len(encrypted_chunk)):
+                await conn.send_frame(FILE_DATA, encrypted_chunk, file_id=file_id, seq=seq, flags=flags)
+            if cache_writer is not None:
+                await loop.run_in_executor(io_executor, cache_writer.write, encrypted_chunk, flags)
+            seq += 1
+    except:
+        if cache_writer is not None:
+            cache_writer.discard()
+        raise
+    finally:
+        await chunks.aclose()
+    if cache_writer is not None:
+        await loop.run_in_executor(io_executor, cache_writer.commit)
+
+
+async def send_file_to_client(conn, filename, source, user, distribution, offset=0, chunk_hash=None, encrypted=True,
+                              cache_encrypted=False):
+    file_id = None
+    try:
+        groups = directory.get_user_groups(user['email'])
+        async with scheduler.transfer(distribution, user['email'], source.size, groups) as flow:
+            start = await resume_chunk(source, offset, chunk_hash)
+            if start:
+                logging.info(f"[RESUMING {filename} TO {user['email']} AT CHUNK {start}]")
+            else:
+                logging.info(f"[SENDING {filename} TO {user['email']}]")
+            file_id = next(file_ids)
+            tracer.begin_transfer(file_id, filename, user['email'])
+            with tracer.span('digests'):
+                digests = await source_digests(source)
+            resume = await_reply(conn, file_id) if start else None
+            meta = {'filename': filename, 'size': source.size, 'offset': start * CHUNK_SIZE,
+                    'encrypted': encrypted, 'chunks': source.chunk_count, 'root': digests.root}
+            if isinstance(source, BundleSource):
+                meta['bundle'] = True
+                meta['files'] = source.file_count
+            await conn.send_frame(FILE_START, encode_meta(meta), file_id=file_id)
+            for seq, batch in digests.batches(MAX_PAYLOAD):
+                await conn.send_frame(DIGESTS, batch, file_id=file_id, seq=seq)
+            if start:
+                # The client answers a resume with the chunks before it that it
+                # no longer has; if there are any, it has started over.
+                with tracer.span('resume'):
+                    bitmap = await asyncio.wait_for(resume, REPLY_TIMEOUT)
+                if bitmap_indexes(bitmap, start):
+                    logging.warning(f"[{user['email']} CANNOT RESUME {filename}, SENDING IT FROM THE START]")
+                    start = 0
+            verdict = await_reply(conn, file_id)
+            if not encrypted and isinstance(source, BundleSource):
+                await send_plain(conn, file_id, source, range(start, source.chunk_count), flow)
+            elif not encrypted:
+                await send_from_file(conn, file_id, source.path, source, start, flow)
+            else:
+                cached = encrypted_disk_cache.lookup(user, source)
+                if cached is not None:
+                    logging.info(f"[SERVING {filename} TO {user['email']} FROM ENCRYPTED CACHE]")
+                    cached_path, layout = cached
+                    await send_from_file(conn, file_id, cached_path, source, start, flow, layout)
+                else:
+                    await send_encrypted(conn, file_id, source, user, start, cache_encrypted, flow)
+            await conn.send_frame(FILE_END, file_id=file_id, seq=source.chunk_count)
+            await repair_chunks(conn, file_id, filename, source, user, encrypted, flow, verdict)
     except:
         logging.error(f"[ERROR SENDING {filename} to {user['email']}]")
         return
+    finally:
+        tracer.end_transfer()
+        client_replies.pop(file_id, None)
+        release_source(source)
+
+
+async def repair_chunks(conn, file_id, filename, source, user, encrypted, flow, verdict):
+    # The client answers each FILE_END with a bitmap of the chunks that failed
+    # verification against the source's digests. Only those are sent again,
+    # followed by another FILE_END, until none fail or MAX_REPAIR_ROUNDS have
+    # been tried. The client acknowledges the file only once every chunk
+    # checks out, so a transfer given up on stays pending; so does one the
+    # client failed to write, which it answers with no bitmap at all.
+    for attempt in range(MAX_REPAIR_ROUNDS + 1):
+        with tracer.span('verify'):
+            bitmap = await asyncio.wait_for(verdict, REPLY_TIMEOUT)
+        if bitmap is None:
+            logging.error(f"[{user['email']} FAILED TO WRITE {filename}, LEAVING IT PENDING]")
+            return
+        indexes = bitmap_indexes(bitmap, source.chunk_count)
+        if not indexes:
+            return
+        if attempt == MAX_REPAIR_ROUNDS:
+            logging.error(f"[GIVING UP ON {filename} TO {user['email']}: {len(indexes)} CHUNKS STILL FAIL "
+                          f"VERIFICATION]")
+            return
+        logging.warning(f"[RESENDING {len(indexes)} OF {source.chunk_count} CHUNKS OF {filename} TO "
+                        f"{user['email']} THAT FAILED VERIFICATION]")
+        CHUNKS_RESENT.inc(len(indexes))
+        verdict = await_reply(conn, file_id)
+        if encrypted:
+            chunks = encrypted_chunks(source, user, io_executor, crypto_executor, indexes=indexes)
+            await send_chunks(conn, file_id, chunks, indexes, flow)
+        else:
+            await send_plain(conn, file_id, source, indexes, flow)
+        await conn.send_frame(FILE_END, file_id=file_id, seq=source.chunk_count)
 
 
+async def send_dedup_to_client(conn, manifest, user, distribution, encrypted=True):
+    # Sends the manifest, waits for the client to say which chunks it can't
+    # find locally, and sends only those.
+    file_id = next(file_ids)
+    tracer.begin_transfer(file_id, manifest.filename, user['email'])
+    try:
+        groups = directory.get_user_groups(user['email'])
+        async with scheduler.transfer(distribution, user['email'], manifest.size, groups) as flow:
+            need = await_reply(conn, file_id)
+            meta = {'filename': manifest.filename, 'size': manifest.size, 'encrypted': encrypted,
+                    'dedup': True, 'chunks': manifest.chunk_count}
+            await conn.send_frame(FILE_START, encode_meta(meta), file_id=file_id)
+            for seq, batch in manifest.batches(MAX_PAYLOAD):
+                await conn.send_frame(MANIFEST, batch, file_id=file_id, seq=seq)
+            with tracer.span('need'):
+                bitmap = await asyncio.wait_for(need, REPLY_TIMEOUT)
+            indexes = bitmap_indexes(bitmap, manifest.chunk_count)
+            needed_bytes = sum(manifest.records[index][1] for index in indexes)
+            logging.info(f"[SENDING {manifest.filename} TO {user['email']}: {len(indexes)} OF "
+                         f"{manifest.chunk_count} CHUNKS, {needed_bytes} OF {manifest.size} BYTES]")
+            if encrypted:
+                chunks = encrypted_chunks(manifest, user, io_executor, crypto_executor, indexes=indexes)
+            else:
+                chunks = plain_chunks(manifest, io_executor, crypto_executor, indexes)
+            await send_chunks(conn, file_id, chunks, indexes, flow)
+            await conn.send_frame(FILE_END, file_id=file_id, seq=manifest.chunk_count)
+    except:
+        logging.error(f"[ERROR SENDING {manifest.filename} to {user['email']}]")
+    finally:
+        tracer.end_transfer()
+        client_replies.pop(file_id, None)
+
+
+async def send_delta_to_client(conn, filename, user, distribution, encrypted=True):
+    # Asks the client for the block signatures of its copy of filename and
+    # sends the new version as literal data plus runs of the client's own
+    # blocks. A client without a copy sends no signatures and gets the whole
+    # file as literals.
+    file_id = next(file_ids)
+    tracer.begin_transfer(file_id, filename, user['email'])
+    literals = None
+    try:
+        size = os.path.getsize(filename)
+        groups = directory.get_user_groups(user['email'])
+        async with scheduler.transfer(distribution, user['email'], size, groups) as flow:
+            reply = await_reply(conn, file_id)
+            block_size = block_size_for(size)
+            meta = {'filename': filename, 'size': size, 'encrypted': encrypted, 'delta': True,
+                    'block_size': block_size}
+            await conn.send_frame(FILE_START, encode_meta(meta), file_id=file_id)
+            with tracer.span('signatures'):
+                signatures = await asyncio.wait_for(reply, REPLY_TIMEOUT)
+            with tracer.span('delta'):
+                instructions, digest = await file_delta(filename, signatures, block_size)
+            literals = Literals(filename, instructions)
+            logging.info(f"[SENDING DELTA OF {filename} TO {user['email']}: {literals.size} OF {size} BYTES AS "
+                         f"LITERALS]")
+            if encrypted:
+                chunks = encrypted_chunks(literals, user, io_executor, crypto_executor)
+            else:
+                chunks = plain_chunks(literals, io_executor, crypto_executor, range(literals.chunk_count))
+            seq = 0
+            runs = []
+            runs_per_frame = CHUNK_SIZE // COPY_RUN.size
+            try:
+                for kind, first, count in instructions:
+                    if kind == 'copy':
+                        runs.append((first, count))
+                        if len(runs) < runs_per_frame:
+                            continue
+                    if runs:
+                        await conn.send_frame(COPY, pack_copies(runs), file_id=file_id, seq=seq)
+                        seq += 1
+                        runs = []
+                    if kind == 'literal':
+                        flags, chunk = await chunks.__anext__()
+                        await conn.writable()
+                        async with scheduler.grant(flow, len(chunk)):
+                            await conn.send_frame(FILE_DATA, chunk, file_id=file_id, seq=seq, flags=flags)
+                        seq += 1
+                if runs:
+                    await conn.send_frame(COPY, pack_copies(runs), file_id=file_id, seq=seq)
+                    seq += 1
+            finally:
+                await chunks.aclose()
+            await conn.send_frame(FILE_END, encode_meta({'sha256': digest}), file_id=file_id, seq=seq)
+    except:
+        logging.error(f"[ERROR SENDING DELTA OF {filename} to {user['email']}]")
+    finally:
+        tracer.end_transfer()
+        client_replies.pop(file_id, None)
+        if literals is not None:
+            conn.after_queued(literals.close)
+
+
+def await_reply(conn, file_id):
+    # A future for the NEED or SIGNATURE frames the client sends back for
+    # file_id. Their seq is a byte offset into the reply, and the one flagged
+    # LAST_REPLY completes it, with None if it is also flagged WRITE_FAILED.
+    future = asyncio.get_running_loop().create_future()
+    client_replies[file_id] = {'conn': conn, 'payload': bytearray(), 'future': future}
+    return future
+
+
+def receive_reply(conn, frame):
+    reply = client_replies.get(frame.file_id)
+    if reply is None or reply['conn'] is not conn or reply['future'].done():
+        return
+    payload = reply['payload']
+    if len(payload) < frame.seq:
+        payload.extend(bytes(frame.seq - len(payload)))
+    payload[frame.seq:frame.seq + len(frame.payload)] = frame.payload
+    if frame.flags & WRITE_FAILED:
+        reply['future'].set_result(None)
+    elif frame.flags & LAST_REPLY:
+        reply['future'].set_result(bytes(payload))
+
+
+async def start_swarm(filename, members, distribution):
+    swarm = Swarm(next(file_ids), filename, acquire_source(filename), members, distribution)
+    swarm.digests = (await source_digests(swarm.source)).digests
+    swarms[swarm.id] = swarm
+    for slot, member in enumerate(members):
+        start_transfer(send_swarm_to_client(member['conn'], swarm, slot, member['user'], distribution))
+    return swarm
+
+
+async def send_swarm_to_client(conn, swarm, slot, user, distribution):
+    tracer.begin_transfer(swarm.id, swarm.filename, user['email'])
+    try:
+        groups = directory.get_user_groups(user['email'])
+        slot_size = swarm.source.size // len(swarm.members)
+        async with scheduler.transfer(distribution, user['email'], slot_size, groups) as flow:
+            logging.info(f"[SWARMING {swarm.filename} TO {user['email']} (SLOT {slot} OF {len(swarm.members)})]")
+            await conn.send_frame(FILE_START, encode_meta(swarm.meta(slot, user)), file_id=swarm.id)
+            for seq, batch in swarm.map_batches(MAX_PAYLOAD):
+                await conn.send_frame(SWARM_MAP, batch, file_id=swarm.id, seq=seq)
+            pieces = swarm.slot_pieces(slot)
+            chunks = encrypted_chunks(swarm.source, swarm.user, io_executor, crypto_executor, indexes=pieces)
+            try:
+                indexes = iter(pieces)
+                async for flags, encrypted_chunk in chunks:
+                    await conn.writable()
+                    async with scheduler.grant(flow, len(encrypted_chunk)):
+                        await conn.send_frame(FILE_DATA, encrypted_chunk, file_id=swarm.id, seq=next(indexes),
+                                              flags=flags)
+                    swarm.server_bytes += len(encrypted_chunk)
+            finally:
+                await chunks.aclose()
+            await conn.send_frame(FILE_END, file_id=swarm.id, seq=swarm.source.chunk_count)
+    except:
+        logging.error(f"[ERROR SWARMING {swarm.filename} to {user['email']}]")
+    finally:
+        tracer.end_transfer()
+
+
+async def send_swarm_piece(conn, email, swarm_id, index):
+    # The server is the seed of last resort for pieces no peer could provide.
+    # Each piece is a transfer task of its own, scheduled with the swarm's
+    # distribution like the pushes.
+    swarm = swarms.get(swarm_id)
+    if swarm is None or not 0 <= index < swarm.source.chunk_count:
+        return
+    if email not in swarm.recipients:
+        logging.warning(f"[{email} ASKED FOR A PIECE OF SWARM {swarm_id} THEY ARE NOT IN]")
+        return
+    tracer.begin_transfer(swarm.id, swarm.filename, email)
+    try:
+        groups = directory.get_user_groups(email)
+        async with scheduler.transfer(swarm.distribution, email, swarm.source.size, groups) as flow:
+            flags, chunk = await read_and_encrypt(swarm.source, index, swarm.user, io_executor, crypto_executor)
+            await conn.writable()
+            async with scheduler.grant(flow, len(chunk)):
+                await conn.send_frame(FILE_DATA, chunk, file_id=swarm.id, seq=index, flags=flags)
+            swarm.server_bytes += len(chunk)
+    except:
+        logging.error(f"[ERROR SENDING PIECE {index} OF {swarm.filename} to {email}]")
+    finally:
+        tracer.end_transfer()
+
+
+def finish_swarm_member(email, filename=None):
+    for swarm in list(swarms.values()):
+        if email not in swarm.pending:
+            continue
+        if filename is not None and swarm.filename != filename:
+            continue
+        if swarm.member_done(email):
+            del swarms[swarm.id]
+            logging.info(f"[SWARM {swarm.filename} DONE: SERVER SENT {swarm.server_bytes} BYTES "
+                         f"TO {len(swarm.members)} RECIPIENTS OF {swarm.source.size} BYTES]")
+            release_source(swarm.source)
 
-def handle_admin_request(request, conn, sender):
+
+async def handle_admin_request(request, conn, sender):
     if request['request_type'] == 'create-group':
         group_name = request['param']
-        verdict = database.insert_group(group_name)
+        verdict = await run_db(directory.insert_group, group_name)
         if verdict:
-            conn.send(f"Group {group_name} created successfully!".encode(FORMAT))
+            await conn.send_control(f"Group {group_name} created successfully!")
         else:
-            conn.send(f"Group {group_name} creation failed!".encode(FORMAT))
+            await conn.send_control(f"Group {group_name} creation failed!")
         return
 
     if request['request_type'] == 'delete-group':
         group_name = request['param']
-        verdict = database.delete_group(group_name)
+        verdict = await run_db(directory.delete_group, group_name)
         if verdict:
-            conn.send(f"Group {group_name} deleted successfully!".encode(FORMAT))
+            await conn.send_control(f"Group {group_name} deleted successfully!")
         else:
-            conn.send(f"Group {group_name} deletion failed!".encode(FORMAT))
+            await conn.send_control(f"Group {group_name} deletion failed!")
         return
 
     if request['request_type'] == 'list-users':
-        users = database.get_users_list()
-        conn.send(numerize_list(users).encode(FORMAT))
+        users = directory.get_users_list()
+        await conn.send_control(numerize_list(users))
         return
 
     if request['request_type'] == 'view-requests':
-        join_requests = database.get_join_requests()
-        conn.send(numerize_list(join_requests).encode(FORMAT))
+        join_requests = await run_db(database.get_join_requests)
+        await conn.send_control(numerize_list(join_requests))
         return
 
     if request['request_type'] == 'add':
         email = request['param'][0]
         group_name = request['param'][1]
-        verdict = database.add_user_to_group(email, group_name)
+        verdict = await run_db(directory.add_user_to_group, email, group_name)
         if verdict:
-            conn.send(f"{email} added to group {group_name}".encode(FORMAT))
+            await conn.send_control(f"{email} added to group {group_name}")
         else:
-            conn.send(f"{email} couldn't be added to {group_name}".encode(FORMAT))
+            await conn.send_control(f"{email} couldn't be added to {group_name}")
         return
 
     if request['request_type'] == 'remove':
         email = request['param'][0]
         group_name = request['param'][1]
-        verdict = database.remove_user_from_group(email, group_name)
+        verdict = await run_db(directory.remove_user_from_group, email, group_name)
         if verdict:
-            conn.send(f"{email} removed from group {group_name}".encode(FORMAT))
+            await conn.send_control(f"{email} removed from group {group_name}")
         else:
-            conn.send(f"{email} couldn't be removed from {group_name}".encode(FORMAT))
+            await conn.send_control(f"{email} couldn't be removed from {group_name}")
         return
 
-    if request['request_type'] == 'init':
-        filename = request['param']
-        if not os.path.isfile(filename):
-            conn.send(f"FILE NOT FOUND: {filename}".encode(FORMAT))
+    if request['request_type'] == 'auth-stats':
+        await conn.send_control(login_admission.summary())
+        return
+
+    if request['request_type'] == 'transfer-stats':
+        await conn.send_control(scheduler.summary())
+        return
+
+    if request['request_type'] == 'rate-stats':
+        await conn.send_control(shaper.summary())
+        return
+
+    if request['request_type'] == 'stats':
+        text = registry.render(request['param'])
+        if len(text) > CHUNK_SIZE:
+            # Keep the reply within one control frame the client will accept.
+            text = text[:text.rfind('\n', 0, CHUNK_SIZE) + 1] + "# ... truncated, pass a metric name prefix\n"
+        await conn.send_control('\n' + text)
+        return
+
+    if request['request_type'] == 'trace':
+        if request['param'] == 'start':
+            tracer.start()
+            await conn.send_control("Tracing transfers; `trace stop` writes what was recorded")
+            return
+        if not tracer.enabled:
+            await conn.send_control("Tracing is not running")
+            return
+        spans = tracer.stop()
+        path = await asyncio.get_running_loop().run_in_executor(io_executor, write_trace, spans)
+        await conn.send_control(f"Wrote {len(spans)} spans to {path} (open in ui.perfetto.dev or chrome://tracing)")
+        return
+
+    if request['request_type'] == 'revoke-sessions':
+        target = request['param']
+        if target == 'all':
+            await asyncio.get_running_loop().run_in_executor(io_executor, sessions.rotate)
+            await conn.send_control("Revoked every session token; everyone logs in with their password next time")
+        elif await run_db(directory.revoke_sessions, target):
+            await conn.send_control(f"Revoked the session tokens of {target}")
+        else:
+            await conn.send_control(f"No user {target}")
+        return
+
+    if request['request_type'] == 'profile':
+        if request['param'] == 'start':
+            if profiler.start():
+                await conn.send_control("Profiling; `profile stop` writes the sampled stacks")
+            else:
+                await conn.send_control("The profiler is already running")
+            return
+        counts = profiler.stop()
+        if counts is None:
+            await conn.send_control("The profiler is not running")
             return
-        groups = request['groups']
-        emails = database.get_all_users_from_groups(groups)
+        path = await asyncio.get_running_loop().run_in_executor(io_executor, write_profile, counts)
+        await conn.send_control(f"Wrote {profiler.samples} samples to {path} (collapsed stacks for flamegraph.pl "
+                                f"or speedscope)")
+        return
 
-        for user in emails:
-            database.add_pending_file(user, filename)
+    if request['request_type'] == 'set-rate':
+        scope, name, rate = request['param']
+        if scope == 'global':
+            shaper.set_global_rate(rate)
+        elif scope == 'recipient':
+            shaper.set_recipient_rate(None if name == 'default' else name, rate)
+        else:
+            shaper.set_group_rate(name, rate)
+        target = scope if name is None else f"{scope} {name}"
+        await conn.send_control(f"Rate limit for {target} set to {format_limit(rate)}")
+        return
 
-        for email in emails:
-            if email in online:
-                user = online[email]
-                executor.submit(send_file_to_client, user['conn'], filename, user['user'])
+    if request['request_type'] == 'set-encryption':
+        group_name, mode = request['param']
+        verdict = await run_db(directory.set_group_encryption, group_name, mode == 'on')
+        if verdict:
+            await conn.send_control(f"Encryption for {group_name} turned {mode}")
+        else:
+            await conn.send_control(f"Couldn't change encryption for {group_name}")
+        return
 
-        conn.send(f"Initiated {filename} to {', '.join(groups)}".encode(FORMAT))
+    if request['request_type'] in ('init', 'init-swarm', 'init-dedup', 'init-delta'):
+        filename = request['param']
+        bundle = None
+        if is_bundle(filename):
+            if request['request_type'] != 'init':
+                await conn.send_control(f"{request['request_type']} takes a single file; use init for {filename}")
+                return
+            # Walking a large directory is slow; do it once, off the event loop,
+            # and share the bundle between the recipients.
+            loop = asyncio.get_running_loop()
+            bundle = await loop.run_in_executor(io_executor, acquire_source, filename)
+            if not bundle.file_count:
+                release_source(bundle)
+                await conn.send_control(f"FILE NOT FOUND: {filename}")
+                return
+        elif not os.path.isfile(filename):
+            await conn.send_control(f"FILE NOT FOUND: {filename}")
+            return
+        try:
+            groups = request['groups']
+            encrypted = directory.groups_require_encryption(groups)
+            recipients = directory.recipients(groups)
+            manifest = None
+            if request['request_type'] == 'init-dedup':
+                loop = asyncio.get_running_loop()
+                manifest, new_bytes = await loop.run_in_executor(io_executor, chunk_store.add_file, filename)
+                logging.info(f"[REGISTERED {filename} AS MANIFEST {manifest.id}: {manifest.chunk_count} CHUNKS, "
+                             f"{new_bytes} OF {manifest.size} BYTES NEW]")
+            manifest_id = manifest.id if manifest is not None else None
+            delta = request['request_type'] == 'init-delta'
+            if not await run_db(database.add_pending_files, [user_id for user_id, _ in recipients], filename, encrypted,
+                                manifest_id, delta):
+                await conn.send_control(f"Couldn't queue {filename}")
+                return
+            emails = [email for _, email in recipients]
+            distribution = scheduler.distribution(f"{filename} to {', '.join(groups)}", request['priority'])
+
+            recipients = [online[email] for email in emails if email in online]
+            if request['request_type'] == 'init-swarm':
+                members = [user for user in recipients if user['peer_port']]
+                if len(members) >= 2:
+                    await start_swarm(filename, members, distribution)
+                    recipients = [user for user in recipients if not user['peer_port']]
+
+            for user in recipients:
+                if manifest is not None:
+                    start_transfer(send_dedup_to_client(user['conn'], manifest, user['user'], distribution, encrypted))
+                    continue
+                if delta:
+                    start_transfer(send_delta_to_client(user['conn'], filename, user['user'], distribution, encrypted))
+                    continue
+                source = retain_source(bundle) if bundle is not None else acquire_source(filename)
+                start_transfer(send_file_to_client(user['conn'], filename, source, user['user'], distribution,
+                                                  encrypted=encrypted))
+
+            if manifest is not None:
+                await conn.send_control(f"Initiated {filename} to {', '.join(groups)} "
+                                        f"({new_bytes} of {manifest.size} bytes new to the chunk store)")
+                return
+            if bundle is not None:
+                await conn.send_control(f"Initiated {filename} ({bundle.file_count} files, {bundle.size} bytes) to "
+                                        f"{', '.join(groups)}")
+                return
+            await conn.send_control(f"Initiated {filename} to {', '.join(groups)}")
 
+        finally:
+            if bundle is not None:
+                release_source(bundle)
 
-def handle_regular_request(request, conn, sender):
+async def handle_regular_request(request, conn, sender):
     if request['request_type'] == 'list-groups':
-        groups = database.get_groups_list()
-        conn.send(numerize_list(groups).encode(FORMAT))
+        groups = directory.get_groups_list()
+        await conn.send_control(numerize_list(groups))
         return
 
     if request['request_type'] == 'my-groups':
-        groups = database.get_user_groups(sender['email'])
-        conn.send(numerize_list(groups).encode(FORMAT))
+        groups = directory.get_user_groups(sender['email'])
+        await conn.send_control(numerize_list(groups))
         return
 
     if request['request_type'] == 'join-group':
         if sender['is_admin']:
-            conn.send("Admin cannot join groups!".encode(FORMAT))
+            await conn.send_control("Admin cannot join groups!")
             return
         group_name = request['param']
-        verdict = database.create_join_request(sender['email'], group_name)
+        verdict = await run_db(database.create_join_request, sender['email'], group_name)
         if verdict:
-            conn.send(f"Requested to join group {group_name}".encode(FORMAT))
+            await conn.send_control(f"Requested to join group {group_name}")
         else:
-            conn.send(f"Request to join {group_name} failed".encode(FORMAT))
+            await conn.send_control(f"Request to join {group_name} failed")
 
     if request['request_type'] == 'received-file':
         if sender['is_admin']:
-            conn.send("Admin cannot receive files!".encode(FORMAT))
+            await conn.send_control("Admin cannot receive files!")
             return
         filename = request['param']
-        verdict = database.remove_pending_file(sender['email'], filename)
+        verdict = await run_db(database.remove_pending_file, sender['email'], filename)
         if verdict:
             print(f"[UPDATE: {filename} RECEIVED BY {sender['email']}]")
+        finish_swarm_member(sender['email'], filename)
+        return
+
+    if request['request_type'] == 'peer-port':
+        if sender['email'] in online:
+            online[sender['email']]['peer_port'] = request['param']
+        return
+
+    if request['request_type'] == 'swarm-piece':
+        swarm_id, index = request['param']
+        start_transfer(send_swarm_piece(conn, sender['email'], swarm_id, index))
+        return
+
+    if request['request_type'] == 'checkpoint':
+        if sender['is_admin']:
+            return
+        filename, offset, chunk_hash = request['param']
+        await run_db(database.update_pending_progress, sender['email'], filename, offset, chunk_hash)
         return
 
 
-def handle_client(conn, addr):
+async def authenticate(conn):
+    # A client may offer a session token first; if it is no good, the client
+    # gets one more frame to log in with email and password.
+    frame = await conn.read_frame()
+    if frame is None or frame.type != CONTROL:
+        return None
+    text = frame.text()
+    if text.startswith('session '):
+        session = sessions.verify(text[len('session '):])
+        if session is not None:
+            # The token must name a user the directory still knows, and have
+            # been issued since their sessions were last revoked.
+            email, generation = session
+            record = directory.get_user(email) or await run_db(directory.load_user, email)
+            if record is not None and record['session_generation'] == generation:
+                return email
+        await conn.send_control('Invalid session!')
+        frame = await conn.read_frame()
+        if frame is None or frame.type != CONTROL:
+            return None
+        text = frame.text()
+
+    email, password = text.split(':')
+
+    print(f"Verifying authentication request from {email}...")
+    try:
+        verified = await verify_user(email, password)
+    except LoginRejected:
+        logging.warning(f"[LOGIN QUEUE FULL, TURNING AWAY {email}]")
+        await conn.send_control('Server busy, try again later.')
+        return None
+    if not verified:
+        print(f"Authentication request from {email} failed.")
+        await conn.send_control('Invalid credentials!')
+        return None
+    return email
+
+
+async def handle_client(reader, writer):
+    conn = Connection(reader, writer)
     user = {
         "email": "",
         "is_admin": False,
@@ -170,70 +820,93 @@ def handle_client(conn, addr):
     }
 
     try:
-        data = conn.recv(1024).decode(FORMAT)
-        if not data:
-            conn.close()
+        email = await authenticate(conn)
+        if email is None:
+            await conn.close()
             return
 
-        email, password = data.split(':')
+        logging.info(f"[{email} ONLINE]")
 
-        print(f"Verifying authentication request from {email}...")
-        if not database.verify_user(email=email, password=password):
-            print(f"Authentication request from {email} failed.")
-            conn.sendall(b'Invalid credentials!')
-            conn.close()
+        record = directory.get_user(email)
+        if record is None:
+            record = await run_db(directory.load_user, email)
+        if record is None:
+            await conn.close()
             return
 
-        logging.info(f"[{email} ONLINE]")
-
         user["email"] = email
-        user['key'] = database.get_user_private_key(email)
-        user["is_admin"] = database.is_admin(email=email)
+        user['key'] = record['key']
+        user["is_admin"] = record['is_admin']
 
         if user["is_admin"]:
-            conn.sendall(b"Connection Established. Admin Access Granted!")
+            await conn.send_control("Connection Established. Admin Access Granted!")
+            await conn.send_control(f"session-token {sessions.issue(email, record['session_generation'])}")
         else:
-            online[email] = {'conn': conn, 'user': user}
-            conn.sendall(b'Connection Established.')
-            executor.submit(apply_pending_files, conn, user)
-
+            online[email] = {'conn': conn, 'user': user, 'host': conn.addr[0], 'peer_port': None}
+            await conn.send_control('Connection Established.')
+            await conn.send_control(f"session-token {sessions.issue(email, record['session_generation'])}")
+            start_transfer(apply_pending_files(conn, user))
 
         while True:
-            client_message = conn.recv(1024).decode(FORMAT)
-            if not client_message:
-                remove_connection(email)
-                conn.close()
+            frame = await conn.read_frame()
+            if frame is None:
+                remove_connection(email, conn)
+                await conn.close()
                 return
+            if frame.type in (NEED, SIGNATURE):
+                receive_reply(conn, frame)
+                continue
+            if frame.type != CONTROL:
+                continue
+
+            client_message = frame.text()
 
             print(f"[MESSAGE] {email}: {client_message}")
             parsed = parse_request(client_message)
             if not parsed['valid']:
-                conn.sendall(b'Message Received. Not a Command!')
+                await conn.send_control('Message Received. Not a Command!')
                 continue
 
             if parsed['admin-only']:
                 if not user['is_admin']:
-                    conn.sendall(b'Invalid Command!')
+                    await conn.send_control('Invalid Command!')
                 else:
-                    handle_admin_request(parsed, conn, user)
+                    await handle_admin_request(parsed, conn, user)
             else:
-                handle_regular_request(parsed, conn, user)
+                await handle_regular_request(parsed, conn, user)
     except:
-        conn.sendall(b"Invalid Request!")
-        remove_connection(user['email'])
-        conn.close()
+        try:
+            await conn.send_control("Invalid Request!")
+        except:
+            pass
+        remove_connection(user['email'], conn)
+        await conn.close()
         return
 
 
-def start_server():
-    server.listen()
+async def start_server():
+    raise_fd_limit()
+    await login_admission.start()
+    # Like the bcrypt pool, fork the delta workers before any threads exist.
+    await asyncio.get_running_loop().run_in_executor(delta_executor, warm_up)
+    if METRICS_PORT:
+        # Optional; a taken port must not keep the file server from starting.
+        try:
+            await serve_metrics(METRICS_HOST, METRICS_PORT)
+            logging.info(f"[METRICS ON http://{METRICS_HOST}:{METRICS_PORT}/metrics]")
+        except OSError as e:
+            logging.warning(f"[METRICS ENDPOINT DISABLED, CANNOT LISTEN ON {METRICS_HOST}:{METRICS_PORT}: {e}]")
+
+    server = await asyncio.start_server(handle_client, SERVER, PORT, limit=STREAM_LIMIT, backlog=LISTEN_BACKLOG)
     logging.info(f"[SERVER LISTENING ON {SERVER}:{PORT}]")
 
-    while True:
-        conn, addr = server.accept()
-        client_thread = threading.Thread(target=handle_client, args=(conn, addr))
-        client_thread.start()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        login_admission.shutdown()
+        delta_executor.shutdown(cancel_futures=True)
 
 
 if __name__ == '__main__':
-    start_server()
+    asyncio.run(start_server())
@@ -0,0 +1,64 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+from constants import FORMAT, SESSION_SECRET_FILE, SESSION_TTL
+
+
+def load_secret(path):
+    try:
+        with open(path, 'rb') as file:
+            secret = file.read()
+        if len(secret) >= 32:
+            return secret
+    except OSError:
+        pass
+    return new_secret(path)
+
+
+def new_secret(path):
+    secret = os.urandom(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(secret)
+    return secret
+
+
+class SessionManager:
+    # Signed, short-lived session tokens:
+    # "<email, base64>.<generation>.<expiry>.<hmac>". Checking one is a single
+    # HMAC, so reconnects skip bcrypt entirely. The secret is kept on disk so
+    # tokens survive a server restart. verify only checks the signature and
+    # expiry; the caller compares the generation with the user's current one,
+    # which revoking the user's sessions bumps. rotate() replaces the secret
+    # and with it every token issued so far.
+
+    def __init__(self, secret_file=SESSION_SECRET_FILE, ttl=SESSION_TTL):
+        self.secret_file = secret_file
+        self.secret = load_secret(secret_file)
+        self.ttl = ttl
+
+    def rotate(self):
+        self.secret = new_secret(self.secret_file)
+
+    def _sign(self, message):
+        return hmac.new(self.secret, message.encode(FORMAT), hashlib.sha256).hexdigest()
+
+    def issue(self, email, generation):
+        encoded = base64.urlsafe_b64encode(email.encode(FORMAT)).decode(FORMAT)
+        message = f"{encoded}.{generation}.{int(time.time()) + self.ttl}"
+        return f"{message}.{self._sign(message)}"
+
+    def verify(self, token):
+        # (email, generation) for a genuine, unexpired token, else None.
+        try:
+            encoded, generation, expiry, signature = token.split('.')
+            if not hmac.compare_digest(signature, self._sign(f"{encoded}.{generation}.{expiry}")):
+                return None
+            if int(expiry) < time.time():
+                return None
+            return base64.urlsafe_b64decode(encoded.encode(FORMAT)).decode(FORMAT), int(generation)
+        except (ValueError, UnicodeDecodeError):
+            return None
@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+from constants import CHUNK_SIZE, GLOBAL_RATE_LIMIT, RECIPIENT_RATE_LIMIT, RATE_BURST_SECONDS, RATE_WINDOW
+
+
+def format_limit(rate):
+    return format_rate(rate) if rate else "unlimited"
+
+
+def format_rate(rate):
+    for unit in ('B', 'KiB', 'MiB'):
+        if rate < 1024:
+            return f"{rate:.1f}{unit}/s"
+        rate /= 1024
+    return f"{rate:.1f}GiB/s"
+
+
+class RateMeter:
+    # Bytes per second over the last full window.
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.total = 0
+        self.rate = 0.0
+
+    def record(self, size):
+        self._roll()
+        self.bytes += size
+        self.total += size
+
+    def current(self):
+        self._roll()
+        return self.rate
+
+    def _roll(self):
+        now = time.monotonic()
+        elapsed = now - self.start
+        if elapsed >= self.window:
+            self.rate = self.bytes / elapsed
+            self.start = now
+            self.bytes = 0
+
+
+class TokenBucket:
+    # Tokens are bytes and refill continuously from the monotonic clock. A
+    # send takes its tokens up front, even if that leaves the bucket in debt,
+    # and then sleeps until the debt is paid off. Sleeping late therefore
+    # never adds up to a rate error, and chunks larger than the burst still
+    # go through. A rate of 0 means unlimited; the bucket then only measures.
+
+    def __init__(self, rate=0):
+        self.meter = RateMeter()
+        self.updated = time.monotonic()
+        self.tokens = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        # Debt carries over a change, so lowering a limit can't let a burst through.
+        self.rate = rate
+        self.burst = max(2 * CHUNK_SIZE, rate * RATE_BURST_SECONDS)
+        self.tokens = self.burst if self.tokens is None else min(self.tokens, self.burst)
+
+    def reserve(self, size):
+        # Returns how long the caller has to wait before sending size bytes.
+        self.meter.record(size)
+        now = time.monotonic()
+        if not self.rate:
+            self.updated = now
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthShaper:
+    # Egress limits at three levels: everything the server sends, each
+    # recipient, and the combined traffic to each group's members. A send is
+    # charged to every bucket that applies to it and waits for the slowest.
+    # Limits can be changed while transfers are running.
+
+    def __init__(self, global_rate=GLOBAL_RATE_LIMIT, recipient_rate=RECIPIENT_RATE_LIMIT):
+        self.total = TokenBucket(global_rate)
+        self.recipient_rate = recipient_rate
+        self.recipient_rates = {}
+        self.recipients = {}
+        self.groups = {}
+
+    def set_global_rate(self, rate):
+        self.total.set_rate(rate)
+
+    def set_recipient_rate(self, email, rate):
+        # email None sets the default for every recipient without a limit of their own.
+        if email is None:
+            self.recipient_rate = rate
+            for email, bucket in self.recipients.items():
+                if email not in self.recipient_rates:
+                    bucket.set_rate(rate)
+            return
+        if rate:
+            self.recipient_rates[email] = rate
+        else:
+            self.recipient_rates.pop(email, None)
+        if email in self.recipients:
+            self.recipients[email].set_rate(self.recipient_rates.get(email, self.recipient_rate))
+
+    def set_group_rate(self, group_name, rate):
+        if rate:
+            if group_name in self.groups:
+                self.groups[group_name].set_rate(rate)
+            else:
+                self.groups[group_name] = TokenBucket(rate)
+        else:
+            self.groups.pop(group_name, None)
+
+    def _buckets(self, email, groups):
+        yield self.total
+        bucket = self.recipients.get(email)
+        if bucket is None:
+            bucket = self.recipients[email] = TokenBucket(self.recipient_rates.get(email, self.recipient_rate))
+        yield bucket
+        for group_name in groups:
+            bucket = self.groups.get(group_name)
+            if bucket is not None:
+                yield bucket
+
+    async def throttle(self, email, groups, size):
+        delay = max(bucket.reserve(size) for bucket in self._buckets(email, groups))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def forget(self, email):
+        if email not in self.recipient_rates:
+            self.recipients.pop(email, None)
+
+    def summary(self):
+        lines = [f"\nglobal: limit={format_limit(self.total.rate)} achieved={format_rate(self.total.meter.current())}",
+                 f"default per recipient: {format_limit(self.recipient_rate)}"]
+        for group_name, bucket in self.groups.items():
+            lines.append(f"group {group_name}: limit={format_limit(bucket.rate)} "
+                         f"achieved={format_rate(bucket.meter.current())}")
+        for email, bucket in self.recipients.items():
+            lines.append(f"{email}: limit={format_limit(bucket.rate)} achieved={format_rate(bucket.meter.current())}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,55 @@
+import os
+
+from utils import encrypt_file
+from integrity import DIGEST_SIZE
+
+
+class Swarm:
+    # A swarm distribution of one file to the recipients that are online and
+    # can accept peer connections. Pieces are the file's chunks. The server
+    # pushes piece i only to the member in slot i % len(members); members fetch
+    # every other piece from the member that owns its slot, and fall back to
+    # asking the server. Pieces are encrypted once with a per-swarm key that
+    # each member receives encrypted with their own key.
+
+    def __init__(self, swarm_id, filename, source, members, distribution):
+        self.id = swarm_id
+        self.filename = filename
+        self.source = source
+        self.distribution = distribution
+        self.key = os.urandom(32)
+        self.user = {'email': f'swarm:{swarm_id}', 'key': self.key}
+        self.members = members
+        self.recipients = frozenset(member['user']['email'] for member in members)
+        self.pending = set(self.recipients)
+        self.digests = b''
+        self.server_bytes = 0
+
+    def slot_pieces(self, slot):
+        return range(slot, self.source.chunk_count, len(self.members))
+
+    def peers(self):
+        return [
+            {'slot': slot, 'host': member['host'], 'port': member['peer_port']}
+            for slot, member in enumerate(self.members)
+        ]
+
+    def meta(self, slot, user):
+        return {
+            'filename': self.filename,
+            'size': self.source.size,
+            'swarm': True,
+            'pieces': self.source.chunk_count,
+            'swarm_key': encrypt_file(self.key, user['key']).hex(),
+            'slot': slot,
+            'peers': self.peers(),
+        }
+
+    def map_batches(self, batch_size):
+        step = batch_size - batch_size % DIGEST_SIZE
+        for seq, start in enumerate(range(0, len(self.digests), step)):
+            yield seq, self.digests[start:start + step]
+
+    def member_done(self, email):
+        self.pending.discard(email)
+        return not self.pending
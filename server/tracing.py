@@ -0,0 +1,186 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+
+from constants import TRACE_DIR, TRACE_MAX_SPANS, PROFILE_INTERVAL
+
+# Opt-in tracing of the stages of every transfer, and a sampling profiler,
+# both switched on and off at runtime by admin commands.
+#
+# A transfer tags its task with begin_transfer; tasks it starts inherit the
+# tag, and wrap() carries it into executor threads. While tracing is off,
+# span() hands back one shared no-op context manager and wrap() returns the
+# function unchanged, so the instrumented code pays one attribute check.
+
+current_transfer = contextvars.ContextVar('current_transfer', default=None)
+NO_SPAN = nullcontext()
+
+
+class Tracer:
+    def __init__(self, max_spans=TRACE_MAX_SPANS):
+        self.enabled = False
+        self.spans = deque(maxlen=max_spans)
+        self.origin = time.perf_counter()
+
+    def start(self):
+        self.spans.clear()
+        self.origin = time.perf_counter()
+        self.enabled = True
+
+    def stop(self):
+        # Returns the spans recorded since start.
+        self.enabled = False
+        spans = list(self.spans)
+        self.spans.clear()
+        return spans
+
+    def begin_transfer(self, file_id, filename, recipient):
+        current_transfer.set((file_id, filename, recipient, time.perf_counter()))
+
+    def end_transfer(self):
+        transfer = current_transfer.get()
+        if self.enabled and transfer is not None:
+            # A transfer already running when tracing started shows from then on.
+            self._record('transfer', None, transfer, max(transfer[3], self.origin), None)
+
+    def span(self, stage, detail=None):
+        # Times a stage awaited on the event loop, on the transfer's own track.
+        if not self.enabled:
+            return NO_SPAN
+        return self._span(stage, detail, current_transfer.get(), None)
+
+    def wrap(self, stage, function, detail=None):
+        # function, timed on the thread that ends up running it.
+        if not self.enabled:
+            return function
+        transfer = current_transfer.get()
+
+        def traced(*args, **kwargs):
+            with self._span(stage, detail, transfer, threading.current_thread()):
+                return function(*args, **kwargs)
+        return traced
+
+    @contextmanager
+    def _span(self, stage, detail, transfer, thread):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(stage, detail, transfer, started, thread)
+
+    def _record(self, stage, detail, transfer, started, thread):
+        if self.enabled:
+            self.spans.append((stage, detail, transfer, started - self.origin, time.perf_counter() - started,
+                               None if thread is None else (thread.ident, thread.name)))
+
+
+def chrome_trace(spans):
+    # Spans as Chrome trace events, for chrome://tracing or ui.perfetto.dev.
+    # Each transfer gets a track for the stages it awaits on the event loop;
+    # executor threads get a track each for the work they do for transfers.
+    events = []
+    tracks = {}
+    for stage, detail, transfer, started, duration, thread in spans:
+        args = {}
+        if transfer is not None:
+            file_id, filename, recipient, _ = transfer
+            args = {'file_id': file_id, 'file': filename, 'recipient': recipient}
+        if detail is not None:
+            args['detail'] = detail
+        if thread is not None:
+            pid, key, name = 1, thread[0], thread[1]
+        elif transfer is not None:
+            pid, key, name = 2, (transfer[0], transfer[2]), f"{transfer[1]} -> {transfer[2]} (#{transfer[0]})"
+        else:
+            pid, key, name = 2, None, 'event loop'
+        tid = tracks.get((pid, key))
+        if tid is None:
+            tid = tracks[(pid, key)] = len(tracks) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        events.append({'name': stage, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': round(started * 1e6, 1),
+                       'dur': round(duration * 1e6, 1), 'args': args})
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'executor threads'}})
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': 2, 'args': {'name': 'transfers'}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+class SamplingProfiler:
+    # Samples the stack of every thread each `interval` seconds from a
+    # background thread that only exists while profiling. The stacks are
+    # counted in the collapsed format flamegraph.pl and speedscope read:
+    # thread;outermost;...;innermost count
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            return False
+        self.counts = Counter()
+        self.samples = 0
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        # Returns the collapsed stacks sampled since start.
+        if not self.running:
+            return None
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        return self.counts
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+
+def output_path(prefix, extension):
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    return os.path.join(TRACE_DIR, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+
+def write_trace(spans):
+    path = output_path('trace', 'json')
+    with open(path, 'w') as file:
+        json.dump(chrome_trace(spans), file)
+    return path
+
+
+def write_profile(counts):
+    path = output_path('profile', 'folded')
+    with open(path, 'w') as file:
+        for stack, count in counts.most_common():
+            file.write(f"{stack} {count}\n")
+    return path
+
+
+tracer = Tracer()
+profiler = SamplingProfiler()
@@ -1,3 +1,4 @@
+import hashlib
 import bcrypt
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
@@ -5,6 +6,11 @@ from cryptography.hazmat.backends import default_backend
 from constants import FIXED_SALT
 from Crypto.Cipher import AES
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 def hash_password(password):
     salt = bcrypt.gensalt()
@@ -41,6 +47,25 @@ def decrypt_file(file_bytes, key):
     return cipher.decrypt(file_bytes)
 
 
+def chunk_digest(chunk):
+    return hashlib.sha256(chunk).hexdigest()
+
+
+RATE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(text):
+    # Bytes per second, with an optional K/M/G suffix; 0 or 'off' is unlimited.
+    if text == 'off':
+        return 0
+    multiplier = RATE_UNITS.get(text[-1].upper(), 1)
+    if multiplier != 1:
+        text = text[:-1]
+    rate = int(float(text) * multiplier)
+    assert rate >= 0
+    return rate
+
+
 def parse_request(text):
     details = {'valid': True,
                'request_type': '',
@@ -76,6 +101,27 @@ def parse_request(text):
             details['admin-only'] = False
             return details
 
+        if major == 'peer-port':
+            assert len(commands) == 2
+            details['request_type'] = 'peer-port'
+            details['param'] = int(commands[1])
+            details['admin-only'] = False
+            return details
+
+        if major == 'swarm-piece':
+            assert len(commands) == 3
+            details['request_type'] = 'swarm-piece'
+            details['param'] = (int(commands[1]), int(commands[2]))
+            details['admin-only'] = False
+            return details
+
+        if major == 'checkpoint':
+            assert len(commands) == 4
+            details['request_type'] = 'checkpoint'
+            details['param'] = (commands[1], int(commands[2]), commands[3])
+            details['admin-only'] = False
+            return details
+
 
 
         details['admin-only'] = True
@@ -99,6 +145,44 @@ def parse_request(text):
             details['request_type'] = 'view-requests'
             return details
 
+        if major == 'auth-stats':
+            details['request_type'] = 'auth-stats'
+            return details
+
+        if major == 'transfer-stats':
+            details['request_type'] = 'transfer-stats'
+            return details
+
+        if major == 'rate-stats':
+            details['request_type'] = 'rate-stats'
+            return details
+
+        if major == 'stats':
+            assert len(commands) <= 2
+            details['request_type'] = 'stats'
+            details['param'] = commands[1] if len(commands) == 2 else ''
+            return details
+
+        if major == 'revoke-sessions':
+            assert len(commands) == 2
+            details['request_type'] = 'revoke-sessions'
+            details['param'] = commands[1]
+            return details
+
+        if major in ('trace', 'profile'):
+            assert len(commands) == 2
+            assert commands[1] in ('start', 'stop')
+            details['request_type'] = major
+            details['param'] = commands[1]
+            return details
+
+        if major == 'set-rate':
+            assert commands[1] in ('global', 'recipient', 'group')
+            assert len(commands) == (3 if commands[1] == 'global' else 4)
+            details['request_type'] = 'set-rate'
+            details['param'] = (commands[1], commands[2] if len(commands) == 4 else None, parse_rate(commands[-1]))
+            return details
+
         if major == 'add':
             details['request_type'] = 'add'
             assert len(commands) == 3
@@ -111,9 +195,20 @@ def parse_request(text):
             details['param'] = (commands[1], commands[2])
             return details
 
-        if major == 'init':
+        if major == 'set-encryption':
+            assert len(commands) == 3
+            assert commands[2] in ('on', 'off')
+            details['request_type'] = 'set-encryption'
+            details['param'] = (commands[1], commands[2])
+            return details
+
+        if major in ('init', 'init-swarm', 'init-dedup', 'init-delta'):
+            details['priority'] = 'normal'
+            if commands[-1].startswith('priority='):
+                details['priority'] = commands.pop()[len('priority='):]
+                assert details['priority'] in ('high', 'normal', 'bulk')
             assert len(commands) >= 3
-            details['request_type'] = 'init'
+            details['request_type'] = major
             groups = commands[2:]
             details['param'] = commands[1]
             details['groups'] = groups
@@ -133,3 +228,15 @@ def numerize_list(arr):
         result += f"{idx}. {str(i)}\n"
         idx += 1
     return result
+
+
+def raise_fd_limit():
+    # Each connected client holds a file descriptor; lift the soft limit to the hard one.
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass